@@ -0,0 +1,139 @@
+from Asset import Asset
+from Database import Database
+from SQLiteDatabase import TransactionListener
+from User import User
+
+'''
+Keeps the balances and holdings that Bank touches in memory, so each account is read from the database once, however many sales it is part of.
+Changes are checked the same way the database would check them, and only written, all at once, just before the database commits. Ledger entries wait with them.
+Savepoints are followed, so rolling one back also undoes whatever was changed in memory since it started. A full rollback forgets everything.
+Accounts are keyed by (user_id, asset_id), and an asset_id of 0 means coins, like in the ledger.
+'''
+class AccountCache(TransactionListener):
+    def __init__(self, database : Database) -> None:
+        self.database = database
+        self._clear()
+
+    def _clear(self):
+        #[available, escrow] for every account touched since the last commit
+        self._accounts : dict[tuple[int, int], list[int]] = {}
+        #What the database had for each account when it was loaded, so only the differences are written
+        self._loaded : dict[tuple[int, int], tuple[int, int]] = {}
+        self._user_names : dict[int, str] = {}
+        #(account, available, escrow) before every change made inside a savepoint, so savepoints can be undone
+        self._journal : list[tuple[tuple[int, int], int, int]] = []
+        #Journal and ledger lengths when each open savepoint started
+        self._marks : list[tuple[int, int]] = []
+        self._ledger : list[tuple] = []
+        self._time_id = None
+
+    def _get_account(self, user : User, asset : Asset) -> list[int]:
+        key = (user.id, asset.id if asset is not None else 0)
+        if (key not in self._accounts):
+            if (asset is None):
+                loaded = tuple(self.database.get_balances(user))
+            else:
+                loaded = tuple(self.database.get_owned_asset_balances(user, asset))
+            self._loaded[key] = loaded
+            self._accounts[key] = list(loaded)
+        return self._accounts[key]
+
+    '''
+    Loads every one of the accounts that isn't cached yet, in one query for coins and one for shares, instead of one query each.
+    '''
+    def load(self, users : list[User], holdings : list[tuple[User, Asset]]):
+        user_ids = list({user.id for user in users if (user.id, 0) not in self._accounts})
+        holding_ids = list({(user.id, asset.id) for user, asset in holdings if (user.id, asset.id) not in self._accounts})
+        loaded = dict.fromkeys([(user_id, 0) for user_id in user_ids] + holding_ids, (0, 0))
+        if (len(user_ids) != 0):
+            for user_id, available, escrow in self.database.get_balances_of(user_ids):
+                loaded[(user_id, 0)] = (available, escrow)
+        if (len(holding_ids) != 0):
+            for user_id, asset_id, available, escrow in self.database.get_owned_asset_balances_of(holding_ids):
+                loaded[(user_id, asset_id)] = (available, escrow)
+        for key, balances in loaded.items():
+            self._loaded[key] = balances
+            self._accounts[key] = list(balances)
+
+    '''
+    Gets (available, escrow) for the user's coins, or their shares of asset.
+    '''
+    def get_balances(self, user : User, asset : Asset = None) -> tuple[int, int]:
+        return tuple(self._get_account(user, asset))
+
+    '''
+    Same as Database.change_balance and Database.change_owned_assets: if anything is being taken away, nothing changes and None is returned unless the available amount stays at or above minimum_balance and escrow stays at or above zero.
+    Otherwise, returns the new (available, escrow).
+    '''
+    def change(self, user : User, asset : Asset, difference : int = 0, escrow_difference : int = 0, minimum_balance : int = 0) -> tuple[int, int]:
+        account = self._get_account(user, asset)
+        available, escrow = account[0] + difference, account[1] + escrow_difference
+        if ((difference < 0 or escrow_difference < 0) and (available < minimum_balance or escrow < 0)):
+            return None
+        if (len(self._marks) != 0):
+            self._journal.append(((user.id, asset.id if asset is not None else 0), account[0], account[1]))
+        account[0], account[1] = available, escrow
+        if (asset is None):
+            self._user_names[user.id] = user.name
+        return (available, escrow)
+
+    '''
+    Holds ledger entries, as (user_id, asset_id, account, delta, reason, command_id), until the next write. The current time_id is added to each.
+    '''
+    def add_ledger_entries(self, entries : list[tuple[int, int, str, int, str, int]]):
+        if (self._time_id is None):
+            self._time_id = self.database.get_current_time_id()
+        self._ledger.extend((self._time_id,) + entry for entry in entries)
+
+    '''
+    Writes every changed account, and the waiting ledger entries, in one batch each. Everything stays cached.
+    Can't be done inside a savepoint, since rolling it back afterwards would undo the write but not the cache.
+    '''
+    def flush(self):
+        assert len(self._marks) == 0, "Can't write the cache inside a savepoint."
+        balance_rows = []
+        asset_rows = []
+        for key, (available, escrow) in self._accounts.items():
+            loaded_available, loaded_escrow = self._loaded[key]
+            if (available == loaded_available and escrow == loaded_escrow):
+                continue
+            user_id, asset_id = key
+            if (asset_id == 0):
+                balance_rows.append((user_id, self._user_names[user_id], available - loaded_available, escrow - loaded_escrow))
+            else:
+                asset_rows.append((user_id, asset_id, available - loaded_available, escrow - loaded_escrow))
+            self._loaded[key] = (available, escrow)
+        if (len(balance_rows) != 0):
+            self.database.add_to_balances(balance_rows)
+        if (len(asset_rows) != 0):
+            self.database.add_to_owned_assets(asset_rows)
+        if (len(self._ledger) != 0):
+            self.database.add_ledger_entries(self._ledger)
+        self._ledger = []
+        self._journal = []
+
+    def before_commit(self):
+        self.flush()
+        #Once committed, other connections can change these accounts, so they are loaded again next time.
+        self._clear()
+
+    def after_rollback(self):
+        self._clear()
+
+    def savepoint_started(self):
+        self._marks.append((len(self._journal), len(self._ledger)))
+
+    def savepoint_released(self):
+        if (len(self._marks) != 0):
+            self._marks.pop()
+        if (len(self._marks) == 0):
+            self._journal = []
+
+    def savepoint_rolled_back(self):
+        if (len(self._marks) == 0):
+            return
+        journal_length, ledger_length = self._marks.pop()
+        while (len(self._journal) > journal_length):
+            key, available, escrow = self._journal.pop()
+            self._accounts[key][0], self._accounts[key][1] = available, escrow
+        del self._ledger[ledger_length:]
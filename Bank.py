@@ -1,32 +1,108 @@
+from contextlib import contextmanager
 from dataclasses import dataclass
+from AccountCache import AccountCache
 from Asset import Asset
 from Command import Command
 from Database import Database
 from Log import Log, LogMessageType
+from MarketResult import Fill
+from Portfolio import Portfolio
 from User import User
 from RDramaAPIInterface import RDramaAPIInterface
 
+'''
+The accounts that ledger entries move coins and shares between. Every user has all three, for coins and for every asset.
+'''
+class LedgerAccount:
+    AVAILABLE = "AVAILABLE"
+    ESCROW = "ESCROW"
+    #Where deposits come from, withdrawals go to, and new shares are issued from. It goes negative as value enters the exchange.
+    OUTSIDE = "OUTSIDE"
+
+class LedgerReason:
+    DEPOSIT = "DEPOSIT"
+    WITHDRAWAL = "WITHDRAWAL"
+    ISSUE = "ISSUE"
+    TO_ESCROW = "TO_ESCROW"
+    FROM_ESCROW = "FROM_ESCROW"
+    SALE = "SALE"
+
+'''
+Moves money and assets between accounts.
+Every change to a balance or holding is a single statement that refuses to leave it negative, so nothing has to be read first.
+Every change is also written to the ledger, in pairs that add up to zero, so the ledger can be summed up to get anyone's balances at any turn.
+Inside cached_accounts(), the same checks are done in memory instead, and everything is written in one batch when the database commits.
+'''
 class Bank:
     CLASS_NAME = "BANK"
     def __init__(self, database : Database, log : Log) -> None:
         self.database = database
         self.log = log
+        self._cache : AccountCache = None
+
+    '''
+    Inside this block, every account is read once and then kept in memory, and changes are only written just before the database commits, or when the block ends.
+    A rollback, of the transaction or of a savepoint, throws away whatever it undid.
+    '''
+    @contextmanager
+    def cached_accounts(self):
+        if (self._cache is not None):
+            yield
+            return
+        self._cache = AccountCache(self.database)
+        self.database.add_transaction_listener(self._cache)
+        try:
+            yield
+            #Anything that wasn't committed inside the block still has to reach the database.
+            self._cache.flush()
+        finally:
+            self.database.remove_transaction_listener(self._cache)
+            self._cache = None
+
+    '''
+    Writes whatever is cached to the database, without committing, so queries that read the tables directly see it.
+    '''
+    def flush(self):
+        if (self._cache is not None):
+            self._cache.flush()
+
+    def _change_balance(self, user : User, balance_difference : int = 0, escrow_difference : int = 0, minimum_balance : int = 0) -> tuple:
+        if (self._cache is not None):
+            return self._cache.change(user, None, balance_difference, escrow_difference, minimum_balance)
+        return self.database.change_balance(user, balance_difference, escrow_difference, minimum_balance)
+
+    def _change_owned_assets(self, user : User, asset : Asset, difference : int = 0, escrow_difference : int = 0) -> tuple:
+        if (self._cache is not None):
+            return self._cache.change(user, asset, difference, escrow_difference)
+        return self.database.change_owned_assets(user, asset, difference, escrow_difference)
+
+    '''
+    Writes one operation's ledger entries, as (user, asset, account, difference, reason, command), in one batch. An asset of None means coins.
+    '''
+    def _write_ledger(self, entries : list[tuple[User, Asset, str, int, str, Command]]):
+        rows = [(user.id, asset.id if asset is not None else 0, account, difference, reason, command.id if command is not None else None) for user, asset, account, difference, reason, command in entries if difference != 0]
+        if (len(rows) == 0):
+            return
+        elif (self._cache is not None):
+            self._cache.add_ledger_entries(rows)
+        else:
+            time_id = self.database.get_current_time_id()
+            self.database.add_ledger_entries([(time_id,) + row for row in rows])
     
     '''
     Transfers money from giver's escrow to receiver's balance
     '''
-    def transfer(self, giver : User, receiver : User, amount : int):
-        giver_initial_balance_in_escrow = self.database.get_balance_in_escrow(giver)
-        receiver_initial_balance = self.database.get_balance(receiver)
-
-        giver_new_balance_in_escrow = giver_initial_balance_in_escrow - amount
-        receiver_new_balance = receiver_initial_balance + amount
+    def transfer(self, giver : User, receiver : User, amount : int, reason : str = LedgerReason.SALE, giver_command : Command = None, receiver_command : Command = None):
+        new_giver_balances = self._change_balance(giver, escrow_difference=-amount)
 
         #Sanity Check
-        assert giver_new_balance_in_escrow >= 0, "That would leave the user with negative escrow balance."
-        
-        self.database.set_balance_in_escrow(giver, giver_new_balance_in_escrow)
-        self.database.set_balance(receiver, receiver_new_balance)
+        assert new_giver_balances is not None, "That would leave the user with negative escrow balance."
+
+        self._change_balance(receiver, balance_difference=amount)
+        self._write_ledger([
+            (giver, None, LedgerAccount.ESCROW, -amount, reason, giver_command),
+            (receiver, None, LedgerAccount.AVAILABLE, amount, reason, receiver_command)
+        ])
 
         self.log.add_log_message(self.CLASS_NAME, LogMessageType.BANK, f"Transferred {amount} from {giver.name} to {receiver.name}.")
 
@@ -35,9 +111,11 @@ class Bank:
     '''
     def deposit(self, depositor : User, amount : int):
         assert amount >= 0, "Can't deposit a negative amount of money."
-        depositor_initial_balance = self.database.get_balance(depositor)
-        new_depositor_balance = depositor_initial_balance + amount
-        self.database.set_balance(depositor, new_depositor_balance)
+        self._change_balance(depositor, balance_difference=amount)
+        self._write_ledger([
+            (depositor, None, LedgerAccount.OUTSIDE, -amount, LedgerReason.DEPOSIT, None),
+            (depositor, None, LedgerAccount.AVAILABLE, amount, LedgerReason.DEPOSIT, None)
+        ])
 
         self.log.add_log_message(self.CLASS_NAME, LogMessageType.BANK, f"Deposited {amount} into {depositor.name}'s account.")
 
@@ -46,117 +124,259 @@ class Bank:
     '''
     def withdrawal(self, withdrawer : User, amount : int):
         assert amount >= 0, "Can't withdraw a negative amount of money."
-        withdrawer_initial_balance = self.database.get_balance(withdrawer)
-        new_withdrawer_balance = withdrawer_initial_balance - amount
-        assert new_withdrawer_balance >= 0, "That would leave the withdrawer with a negative balance."
-        self.database.set_balance(withdrawer, new_withdrawer_balance)
+        new_withdrawer_balances = self._change_balance(withdrawer, balance_difference=-amount)
+        assert new_withdrawer_balances is not None, "That would leave the withdrawer with a negative balance."
+        self._write_ledger([
+            (withdrawer, None, LedgerAccount.AVAILABLE, -amount, LedgerReason.WITHDRAWAL, None),
+            (withdrawer, None, LedgerAccount.OUTSIDE, amount, LedgerReason.WITHDRAWAL, None)
+        ])
         self.log.add_log_message(self.CLASS_NAME, LogMessageType.BANK, f"Withdrew {amount} from {withdrawer.name}'s account.")
 
     '''
     Gets the current balance of the user's account.
     '''
     def get_balance(self, user : User):
+        if (self._cache is not None):
+            return self._cache.get_balances(user)[0]
         return self.database.get_balance(user)
 
+    '''
+    Gets all of the user's coins and shares at once, with what the shares are worth at their latest prices.
+    '''
+    def get_portfolio(self, user : User) -> Portfolio:
+        return self.database.get_portfolio(user)
+
     '''
     Gets whether or not a user owns an asset.
     '''
     def has_asset(self, user : User, asset : Asset):
-        return self.database.get_owned_assets(user, asset) > 0
+        return self.get_number_of_assets(user, asset) > 0
 
     def get_number_of_assets(self, user: User, asset : Asset):
+        if (self._cache is not None):
+            return self._cache.get_balances(user, asset)[0]
         return self.database.get_owned_assets(user, asset)
     
     def get_number_of_assets_in_escrow(self, user: User, asset : Asset):
+        if (self._cache is not None):
+            return self._cache.get_balances(user, asset)[1]
         return self.database.get_owned_assets_in_escrow(user, asset)
 
     '''
-    Takes asset from giver's escrow, gives it to receiver's account.
+    Takes asset(s) from giver's escrow, gives them to receiver's account.
     '''
-    def transfer_asset(self, giver : User, receiver : User, asset : Asset):
-        initial_giver_number_owned_in_escrow = self.database.get_owned_assets_in_escrow(giver, asset)
-        initial_receiver_number_owned = self.database.get_owned_assets(receiver, asset)
+    def transfer_asset(self, giver : User, receiver : User, asset : Asset, amount : int = 1, reason : str = LedgerReason.SALE, giver_command : Command = None, receiver_command : Command = None):
+        assert amount > 0, "Cannot transfer a negative number of assets."
 
-        new_giver_number_owned_in_escrow = initial_giver_number_owned_in_escrow - 1
-        new_receiver_number_owned = initial_receiver_number_owned + 1
+        new_giver_numbers_owned = self._change_owned_assets(giver, asset, escrow_difference=-amount)
 
-        assert new_giver_number_owned_in_escrow >= 0, "That would leave the giver with less than 0 in escrow"
+        assert new_giver_numbers_owned is not None, "That would leave the giver with less than 0 in escrow"
 
-        self.database.set_owned_assets_in_escrow(giver, asset, new_giver_number_owned_in_escrow)
-        self.database.set_owned_assets(receiver, asset, new_receiver_number_owned)
+        self._change_owned_assets(receiver, asset, difference=amount)
+        self._write_ledger([
+            (giver, asset, LedgerAccount.ESCROW, -amount, reason, giver_command),
+            (receiver, asset, LedgerAccount.AVAILABLE, amount, reason, receiver_command)
+        ])
 
-        self.log.add_log_message(self.CLASS_NAME, LogMessageType.BANK, f"Transferred 1 {asset.name} from {giver.name} to {receiver.name}.")
+        self.log.add_log_message(self.CLASS_NAME, LogMessageType.BANK, f"Transferred {amount} {asset.name} from {giver.name} to {receiver.name}.")
     
-    def transfer_asset_to_escrow(self, user : User, asset : Asset, amount : int):
+    def transfer_asset_to_escrow(self, user : User, asset : Asset, amount : int, command : Command = None):
         assert amount > 0, "Cannot transfer a negative number of assets."
 
-        initial_giver_number_owned_in_escrow = self.database.get_owned_assets_in_escrow(user, asset)
-        initial_giver_number_owned = self.database.get_owned_assets(user, asset)
-
-        new_giver_number_owned_in_escrow = initial_giver_number_owned_in_escrow + amount
-        new_giver_number_owned = initial_giver_number_owned - amount
-
-        assert new_giver_number_owned >= 0, "That would leave the giver with less than zero owned."
+        new_numbers_owned = self._change_owned_assets(user, asset, difference=-amount, escrow_difference=amount)
 
-        self.database.set_owned_assets_in_escrow(user, asset, new_giver_number_owned_in_escrow)
-        self.database.set_owned_assets(user, asset, new_giver_number_owned)
+        assert new_numbers_owned is not None, "That would leave the giver with less than zero owned."
+        self._write_ledger([
+            (user, asset, LedgerAccount.AVAILABLE, -amount, LedgerReason.TO_ESCROW, command),
+            (user, asset, LedgerAccount.ESCROW, amount, LedgerReason.TO_ESCROW, command)
+        ])
 
         self.log.add_log_message(self.CLASS_NAME, LogMessageType.BANK, f"Transfer {amount} {asset.name} to {user.name}'s escrow")
     
-    def transfer_asset_from_escrow(self, user : User, asset : Asset, amount : int):
+    def transfer_asset_from_escrow(self, user : User, asset : Asset, amount : int, command : Command = None):
         assert amount > 0, "Cannot transfer a negative number of assets"
 
-        initial_giver_number_owned_in_escrow = self.database.get_owned_assets_in_escrow(user, asset)
-        initial_giver_number_owned = self.database.get_owned_assets(user, asset)
-
-        new_giver_number_owned_in_escrow = initial_giver_number_owned_in_escrow - amount
-        new_giver_number_owned = initial_giver_number_owned + amount
-
-        assert new_giver_number_owned_in_escrow >= 0, "That would leave the giver with less than zero in escrow"
+        new_numbers_owned = self._change_owned_assets(user, asset, difference=amount, escrow_difference=-amount)
 
-        self.database.set_owned_assets_in_escrow(user, asset, new_giver_number_owned_in_escrow)
-        self.database.set_owned_assets(user, asset, new_giver_number_owned)
+        assert new_numbers_owned is not None, "That would leave the giver with less than zero in escrow"
+        self._write_ledger([
+            (user, asset, LedgerAccount.ESCROW, -amount, LedgerReason.FROM_ESCROW, command),
+            (user, asset, LedgerAccount.AVAILABLE, amount, LedgerReason.FROM_ESCROW, command)
+        ])
 
         self.log.add_log_message(self.CLASS_NAME, LogMessageType.BANK, f"Transfer {amount} {asset.name} from {user.name}'s escrow")
 
-    def transfer_from_escrow(self, user: User, to_transfer : int):
+    def transfer_from_escrow(self, user: User, to_transfer : int, command : Command = None):
         assert to_transfer > 0, "Cannot transfer a negative amount of money."
 
-        initial_balance_in_escrow = self.database.get_balance_in_escrow(user)
-        initial_balance = self.database.get_balance(user)
+        new_balances = self._change_balance(user, balance_difference=to_transfer, escrow_difference=-to_transfer)
 
-        new_balance_in_escrow = initial_balance_in_escrow - to_transfer
-        new_balance = initial_balance + to_transfer
-
-        assert new_balance_in_escrow >= 0, "That would leave the user with less than zero in escrow"
-        self.database.set_balance(user, new_balance)
-        self.database.set_balance_in_escrow(user, new_balance_in_escrow)
+        assert new_balances is not None, "That would leave the user with less than zero in escrow"
+        self._write_ledger([
+            (user, None, LedgerAccount.ESCROW, -to_transfer, LedgerReason.FROM_ESCROW, command),
+            (user, None, LedgerAccount.AVAILABLE, to_transfer, LedgerReason.FROM_ESCROW, command)
+        ])
 
         self.log.add_log_message(self.CLASS_NAME, LogMessageType.BANK, f"Transfer {to_transfer} from {user.name}'s escrow")
     
-    def transfer_to_escrow(self, user: User, to_transfer : int):
+    def transfer_to_escrow(self, user: User, to_transfer : int, command : Command = None):
         assert to_transfer > 0, "Cannot transfer a negative amount of money."
 
-        initial_balance_in_escrow = self.database.get_balance_in_escrow(user)
-        initial_balance = self.database.get_balance(user)
-
-        new_balance_in_escrow = initial_balance_in_escrow + to_transfer
-        new_balance = initial_balance - to_transfer
+        #The balance has to stay above zero, not just at or above it.
+        new_balances = self._change_balance(user, balance_difference=-to_transfer, escrow_difference=to_transfer, minimum_balance=1)
 
-        assert new_balance > 0, "That would leave the giver with less than zero in account"
-        self.database.set_balance(user, new_balance)
-        self.database.set_balance_in_escrow(user, new_balance_in_escrow)
+        assert new_balances is not None, "That would leave the giver with less than zero in account"
+        self._write_ledger([
+            (user, None, LedgerAccount.AVAILABLE, -to_transfer, LedgerReason.TO_ESCROW, command),
+            (user, None, LedgerAccount.ESCROW, to_transfer, LedgerReason.TO_ESCROW, command)
+        ])
 
         self.log.add_log_message(self.CLASS_NAME, LogMessageType.BANK, f"Transfer {to_transfer} to {user.name}'s escrow")
 
     '''
-    Seller sells asset to buyer for price.
+    Loads every account the fills touch, in one query for coins and one for shares, so settling them doesn't have to read anything. Only does anything inside cached_accounts().
+    '''
+    def load_accounts(self, fills : list[Fill]):
+        if (self._cache is None):
+            return
+        self._cache.load(
+            [fill.buy_command.user for fill in fills] + [fill.sell_command.user for fill in fills],
+            [(fill.buy_command.user, fill.buy_command.asset) for fill in fills] + [(fill.sell_command.user, fill.sell_command.asset) for fill in fills]
+        )
+
+    '''
+    Settles a single sale: the buyer pays the sale price out of escrow, gets back whatever their max price left over, and the seller's shares go to the buyer.
+    Every change is made in the account cache, so inside cached_accounts() it is written in the same batch as the rest of the tick's. Outside of it, it is written straight away.
+    If it raises, having failed halfway through, nothing it did is kept: an AssertionError means it couldn't be settled.
+    To also undo it if something after it goes wrong, run both in a database savepoint, which the account cache follows.
+    '''
+    def settle_fill(self, fill : Fill):
+        with self._cache_savepoint():
+            changes, ledger_entries = self._get_fill_changes(fill)
+            buyer_changes, seller_changes = changes[0], changes[1]
+            #The buyer's escrow has to cover the whole fill at their max price, and the seller's has to cover the shares.
+            new_buyer_balances = self._cache.change(*buyer_changes)
+            assert new_buyer_balances is not None, "That would leave the user with negative escrow balance."
+            new_seller_numbers_owned = self._cache.change(*seller_changes)
+            assert new_seller_numbers_owned is not None, "That would leave the giver with less than 0 in escrow"
+            for user, asset, difference, escrow_difference in changes[2:]:
+                self._cache.change(user, asset, difference, escrow_difference)
+            self._write_ledger(ledger_entries)
+            self._log_fill(fill)
+
+    '''
+    Settles many sales at once, like settle_fill. What the fills do to each account is added up first, so every account is checked and changed once, and the ledger entries are written in one batch.
+    Nothing is changed unless every account comes out of it with nothing negative. Otherwise, an AssertionError says which one wouldn't.
+    A sale only ever takes coins and shares out of escrow, so checking the totals is the same as checking every fill in turn.
+    '''
+    def settle_fills(self, fills : list[Fill]):
+        with self._cache_savepoint():
+            self.load_accounts(fills)
+            #(user, asset, difference, escrow difference) for every account the fills touch. An asset of None means coins.
+            netted : dict[tuple[int, int], list] = {}
+            all_ledger_entries = []
+            for fill in fills:
+                changes, ledger_entries = self._get_fill_changes(fill)
+                for user, asset, difference, escrow_difference in changes:
+                    key = (user.id, asset.id if asset is not None else 0)
+                    if (key not in netted):
+                        netted[key] = [user, asset, 0, 0]
+                    netted[key][2] += difference
+                    netted[key][3] += escrow_difference
+                all_ledger_entries.extend(ledger_entries)
+
+            for user, asset, difference, escrow_difference in netted.values():
+                available, escrow = self._cache.get_balances(user, asset)
+                assert available + difference >= 0 and escrow + escrow_difference >= 0, f"That would leave {user.name} with less than 0 {asset.name if asset is not None else 'coins'} available or in escrow."
+            for user, asset, difference, escrow_difference in netted.values():
+                self._cache.change(user, asset, difference, escrow_difference)
+            self._write_ledger(all_ledger_entries)
+            for fill in fills:
+                self._log_fill(fill)
+
+    '''
+    Runs the block with the account cache, and undoes whatever the block changed in it, in memory, if it fails halfway through.
+    '''
+    @contextmanager
+    def _cache_savepoint(self):
+        with self.cached_accounts():
+            self._cache.savepoint_started()
+            try:
+                yield
+            except BaseException:
+                self._cache.savepoint_rolled_back()
+                raise
+            else:
+                self._cache.savepoint_released()
+
+    '''
+    Works out what a sale does: the (user, asset, difference, escrow difference) for each of the four accounts it changes, buyer's coins and seller's shares first, and its ledger entries.
+    '''
+    def _get_fill_changes(self, fill : Fill) -> tuple[list[tuple[User, Asset, int, int]], list[tuple[User, Asset, str, int, str, Command]]]:
+        buy_command, sell_command = fill.buy_command, fill.sell_command
+        buyer, seller, asset = buy_command.user, sell_command.user, sell_command.asset
+        paid = fill.sale_price * fill.quantity
+        refunded = (fill.max_price - fill.sale_price) * fill.quantity
+        changes = [
+            (buyer, None, refunded, -(paid + refunded)),
+            (seller, asset, 0, -fill.quantity),
+            (seller, None, paid, 0),
+            (buyer, asset, fill.quantity, 0)
+        ]
+        ledger_entries = [
+            (buyer, None, LedgerAccount.ESCROW, -paid, LedgerReason.SALE, buy_command),
+            (seller, None, LedgerAccount.AVAILABLE, paid, LedgerReason.SALE, sell_command),
+            (seller, asset, LedgerAccount.ESCROW, -fill.quantity, LedgerReason.SALE, sell_command),
+            (buyer, asset, LedgerAccount.AVAILABLE, fill.quantity, LedgerReason.SALE, buy_command),
+            (buyer, None, LedgerAccount.ESCROW, -refunded, LedgerReason.FROM_ESCROW, buy_command),
+            (buyer, None, LedgerAccount.AVAILABLE, refunded, LedgerReason.FROM_ESCROW, buy_command)
+        ]
+        return changes, ledger_entries
+
+    def _log_fill(self, fill : Fill):
+        buyer, seller, asset = fill.buy_command.user, fill.sell_command.user, fill.sell_command.asset
+        paid = fill.sale_price * fill.quantity
+        refunded = (fill.max_price - fill.sale_price) * fill.quantity
+        self.log.add_log_message(self.CLASS_NAME, LogMessageType.BANK, f"Sold {fill.quantity} {asset.name} from {seller.name} to {buyer.name} for {paid}, refunding {refunded} into {buyer.name}'s account")
+
+    '''
+    Creates amount new shares of asset, and puts them in user's escrow, for an IPO.
+    '''
+    def issue_asset(self, user : User, asset : Asset, amount : int, command : Command = None):
+        assert amount > 0, "Cannot issue a negative number of assets."
+        self._change_owned_assets(user, asset, escrow_difference=amount)
+        self._write_ledger([
+            (user, asset, LedgerAccount.OUTSIDE, -amount, LedgerReason.ISSUE, command),
+            (user, asset, LedgerAccount.ESCROW, amount, LedgerReason.ISSUE, command)
+        ])
+        self.log.add_log_message(self.CLASS_NAME, LogMessageType.BANK, f"Issued {amount} {asset.name} to {user.name}'s escrow")
+
+    '''
+    Checks that no coins or shares were made up or lost, and returns a line for every problem found (so nothing means all is well):
+     - Every account's escrow matches its open commands.
+     - Every account's balances match the latest snapshot plus the ledger since. Snapshots are worked out from the ledger too, so this covers every change ever made.
+     - Every turn's ledger entries add up to zero, for each asset. Only turns after the last reconcile are checked, so this stays fast as the ledger grows.
+    The counting is all done by SQLite, so only the problems are ever loaded.
     '''
-    def sell_asset(self, buyer : User, seller : User, asset : Asset, price : int, buyer_max_price : int):
-        self.log.add_log_message(self.CLASS_NAME, LogMessageType.BANK, f"Performing sale of {asset.name}")
-        self.transfer(buyer, seller, price)
-        self.transfer_asset(seller, buyer, asset)
-        if (buyer_max_price > price):
-            self.log.add_log_message(self.CLASS_NAME, LogMessageType.BANK, f"Refunding {buyer_max_price - price} into {buyer.name}'s account")
-            remaining_in_escrow = buyer_max_price - price
-            self.transfer_from_escrow(buyer, remaining_in_escrow)
+    def reconcile(self) -> list[str]:
+        problems = []
+        asset_names = {asset.id : asset.name for asset in self.database.get_all_assets()}
+        asset_names[0] = "coins"
+
+        #One read transaction, so every check sees the same state.
+        with self.database.savepoint("reconcile"):
+            for user_id, asset_id, difference in self.database.get_escrow_discrepancies():
+                problems.append(f"User {user_id} has {difference} more {asset_names.get(asset_id, asset_id)} in escrow than their commands account for.")
+            for user_id, asset_id, available_difference, escrow_difference in self.database.get_ledger_discrepancies():
+                problems.append(f"User {user_id} has {available_difference} more {asset_names.get(asset_id, asset_id)} available and {escrow_difference} more in escrow than the ledger says.")
+
+            last_reconciled_time_id = self.database.get_last_reconciled_time_id()
+            current_time_id = self.database.get_current_time_id()
+            for time_id, asset_id, created in self.database.get_unbalanced_ledger_turns(last_reconciled_time_id):
+                problems.append(f"During turn {time_id}, {created} {asset_names.get(asset_id, asset_id)} were created out of nothing.")
+
+            #Turns are only skipped next time once they are known to be fine. The current turn can still get new entries.
+            if (len(problems) == 0):
+                self.database.set_last_reconciled_time_id(current_time_id - 1)
+        self.database.commit()
+        return problems
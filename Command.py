@@ -12,6 +12,10 @@ class Command:
     def id(self) -> int:
         return self._id
 
+    @id.setter
+    def id(self, new_id : int):
+        self._id = new_id
+
     @property
     def user(self) -> User:
         return self._user
@@ -27,8 +31,9 @@ class Command:
         return self.user_friendly_description
 
 class ExpiringCommand(Command):
-    def __init__(self, id : int, time_remaining : int, user : User, user_friendly_description : str):
+    def __init__(self, id : int, time_remaining : int, user : User, user_friendly_description : str, quantity : int = 1):
         self._time_remaining = time_remaining
+        self._quantity = quantity
         super().__init__(id, user, f"{user_friendly_description} ({time_remaining} TURNS LEFT)")
 
     @property
@@ -39,9 +44,20 @@ class ExpiringCommand(Command):
     def time_remaining(self, new_time_remaining :int):
         self._time_remaining = new_time_remaining
 
+    '''
+    The number of shares that have not been filled yet.
+    '''
+    @property
+    def quantity(self) -> int:
+        return self._quantity
+
+    @quantity.setter
+    def quantity(self, new_quantity : int):
+        self._quantity = new_quantity
+
 class BuyCommand(ExpiringCommand):
-    def __init__(self, id : int, time_remaining : int, user : User, asset: Asset, max_price : int):
-        super().__init__(id, time_remaining, user, f"BUY {asset.name} FOR <= {max_price}")
+    def __init__(self, id : int, time_remaining : int, user : User, asset: Asset, max_price : int, quantity : int = 1):
+        super().__init__(id, time_remaining, user, f"BUY {asset.name} FOR <= {max_price}", quantity)
         self._max_price = max_price
         self._asset = asset
     
@@ -54,8 +70,8 @@ class BuyCommand(ExpiringCommand):
         return self._asset
 
 class SellCommand(ExpiringCommand):
-    def __init__(self, id : int, time_remaining : int, user : User, asset: Asset, price : int):
-        super().__init__(id, time_remaining, user, f"SELL {asset.name} FOR >= {price}")
+    def __init__(self, id : int, time_remaining : int, user : User, asset: Asset, price : int, quantity : int = 1):
+        super().__init__(id, time_remaining, user, f"SELL {asset.name} FOR >= {price}", quantity)
         self._price = price
         self._asset = asset
 
@@ -1,31 +1,111 @@
 from Asset import Asset
 from Command import BuyCommand, Command, ExpiringCommand, SellCommand
 from Database import Database
+from OrderBook import OrderBook
+from SQLiteDatabase import TransactionListener
 from User import User
 
-class CommandQueue:
+'''
+Every command that is still open, kept in memory together with an order book per asset.
+Savepoints are followed, like in AccountCache, so rolling one back also undoes whatever it did to the commands in memory. A full rollback reloads everything.
+'''
+class CommandQueue(TransactionListener):
     
     def __init__(self, database : Database):
         self.database = database
-        self.commands : list[Command] = self.database.get_commands()
-        self.has_gotten_commands = True
+        #(command, whether it was in the queue, quantity, time_remaining) before every change made inside a savepoint
+        self._journal : list[tuple[Command, bool, int, int]] = []
+        #Journal length when each open savepoint started
+        self._marks : list[int] = []
+        self.refresh()
+        self.database.add_transaction_listener(self)
 
     def refresh(self):
         self.has_gotten_commands = True
-        self.commands = self.database.get_commands()
+        #The journal refers to the commands that are about to be thrown away
+        self._journal = []
+        self._marks = [0 for _ in self._marks]
+        #Used as an ordered set, so deleting a command doesn't have to search for it.
+        self.commands : dict[Command, None] = dict.fromkeys(self.database.get_commands())
+        self.books : dict[Asset, OrderBook] = {}
+        for command in self.commands:
+            self._add_to_book(command)
+
+    def add_command(self, command : Command) -> int:
+        return self.add_commands([command])[0]
 
-    def add_command(self, command : Command):
-        self.database.add_command(command)
-        self.commands.append(command)
+    '''
+    Adds all of the commands at once, with a single insert. Once this returns, every command has its id. Returns the ids, in order.
+    '''
+    def add_commands(self, commands : list[Command]) -> list[int]:
+        ids = self.database.add_commands(commands)
+        for command in commands:
+            self._remember(command)
+            self.commands[command] = None
+            self._add_to_book(command)
+        return ids
 
     def get_commands(self) -> list[Command]:
         if (not self.has_gotten_commands):
             self.refresh()
-        return self.commands
+        return list(self.commands)
 
     def delete_command(self, to_delete : Command):
+        self._remember(to_delete)
         self.database.delete_command(to_delete)
-        self.commands.remove(to_delete)
+        self._forget(to_delete)
+
+    '''
+    Deletes all of the commands at once, with a single statement.
+    '''
+    def delete_commands(self, to_delete : list[Command]):
+        for command in to_delete:
+            self._remember(command)
+        self.database.delete_commands(to_delete)
+        for command in to_delete:
+            self._forget(command)
+
+    def _forget(self, to_forget : Command):
+        del self.commands[to_forget]
+        if (self.is_in_book(to_forget)):
+            self.books[to_forget.asset].remove(to_forget)
+
+    '''
+    Gets the live order book for an asset. The book is kept up to date as commands are added, filled, and deleted, so don't modify it directly.
+    '''
+    def get_book(self, asset : Asset) -> OrderBook:
+        assert isinstance(asset, Asset), "Only assets have order books."
+        if (asset not in self.books):
+            self.books[asset] = OrderBook(asset)
+        return self.books[asset]
+
+    def get_books(self) -> dict[Asset, OrderBook]:
+        return self.books
+
+    def _add_to_book(self, command : Command):
+        if (self.is_in_book(command)):
+            self.get_book(command.asset).add(command)
+
+    '''
+    Whether the command belongs in its asset's order book. Commands that have run out are only waiting to be refunded and deleted, so they are never matched.
+    '''
+    def is_in_book(self, command : Command) -> bool:
+        return isinstance(command, ExpiringCommand) and command.time_remaining > 0
+
+    '''
+    Marks some of the shares of the command as filled. Returns whether or not the command was completely filled (and therefore deleted)
+    '''
+    def fill_command(self, to_fill : ExpiringCommand, quantity : int) -> bool:
+        assert 0 < quantity <= to_fill.quantity, "Can't fill more shares than the command has left."
+        self._remember(to_fill)
+        if (quantity == to_fill.quantity):
+            self.delete_command(to_fill)
+            return True
+        else:
+            self.database.set_quantity(to_fill, to_fill.quantity - quantity)
+            to_fill.quantity = to_fill.quantity - quantity
+            self.books[to_fill.asset].change_quantity(to_fill, -quantity)
+            return False
 
     def get_transactions_for_user(self, user: User, asset : Asset) -> list[Command]:
         to_return = []
@@ -40,23 +120,79 @@ class CommandQueue:
                 to_return.append(command)
         return to_return
 
+    #Expired commands that are waiting to be refunded can't trade any more, so they don't count.
     def is_selling_asset(self, user : User, asset : Asset) -> bool:
-        return len([i for i in self.commands if i.user == user and isinstance(i, SellCommand) and i.asset == asset]) != 0
+        return len([i for i in self.commands if i.user == user and isinstance(i, SellCommand) and i.asset == asset and self.is_in_book(i)]) != 0
 
     def is_buying_asset(self, user : User, asset : Asset) -> bool:
-        return len([i for i in self.commands if i.user == user and isinstance(i, BuyCommand) and i.asset == asset]) != 0
+        return len([i for i in self.commands if i.user == user and isinstance(i, BuyCommand) and i.asset == asset and self.is_in_book(i)]) != 0
 
 
     '''
-    Returns whether or not we are deleting this
+    Takes a turn off every command, and returns the ones that have run out, so what they had in escrow can be refunded.
+    They are taken out of the order books straight away, but stay in the queue and the database until they are deleted with their refund. A command whose refund failed is returned again next turn.
+    The database does it in two statements, however many commands there are.
     '''
-    def deduct_time(self, to_deduct : ExpiringCommand):
-        if (to_deduct not in self.commands):
-            return False
-        elif (to_deduct.time_remaining == 1):
-            self.delete_command(to_deduct)
-            return True
+    def expire_commands(self) -> list[ExpiringCommand]:
+        expired_ids = set(self.database.deduct_time_from_all_commands())
+        expired_commands : list[ExpiringCommand] = []
+        for command in self.get_commands():
+            if (not isinstance(command, ExpiringCommand)):
+                continue
+            self._remember(command)
+            was_in_book = self.is_in_book(command)
+            command.time_remaining = command.time_remaining-1
+            if (command.id in expired_ids):
+                expired_commands.append(command)
+                if (was_in_book):
+                    self.books[command.asset].remove(command)
+        return expired_commands
+
+    '''
+    Saves how the command is before it changes, if it can still be rolled back to.
+    '''
+    def _remember(self, command : Command):
+        if (len(self._marks) == 0):
+            return
+        if (isinstance(command, ExpiringCommand)):
+            self._journal.append((command, command in self.commands, command.quantity, command.time_remaining))
         else:
-            self.database.set_time_remaining(to_deduct, to_deduct.time_remaining-1)
-            self.commands[self.commands.index(to_deduct)].time_remaining = to_deduct.time_remaining-1
-            return False
\ No newline at end of file
+            self._journal.append((command, command in self.commands, None, None))
+
+    def after_rollback(self):
+        self.refresh()
+
+    def savepoint_started(self):
+        self._marks.append(len(self._journal))
+
+    def savepoint_released(self):
+        if (len(self._marks) != 0):
+            self._marks.pop()
+        if (len(self._marks) == 0):
+            self._journal = []
+
+    def savepoint_rolled_back(self):
+        if (len(self._marks) == 0):
+            return
+        journal_length = self._marks.pop()
+        if (len(self._journal) == journal_length):
+            return
+        changed_assets : set[Asset] = set()
+        while (len(self._journal) > journal_length):
+            command, was_in_queue, quantity, time_remaining = self._journal.pop()
+            if (isinstance(command, ExpiringCommand)):
+                command.quantity, command.time_remaining = quantity, time_remaining
+                changed_assets.add(command.asset)
+            if (was_in_queue):
+                self.commands[command] = None
+            else:
+                self.commands.pop(command, None)
+        #Put back in the order they were placed in, which is also the order they queue in within a price level
+        self.commands = dict.fromkeys(sorted(self.commands, key=lambda command: command.id))
+        for asset in changed_assets:
+            self.books[asset] = OrderBook(asset)
+        for command in self.commands:
+            if (self.is_in_book(command) and command.asset in changed_assets):
+                self.books[command.asset].add(command)
+        if (len(self._marks) == 0):
+            self._journal = []
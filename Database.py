@@ -1,37 +1,71 @@
-import sqlite3
+import json
 
 from Command import BuyCommand, Command, ExpiringCommand, SellCommand
+from Portfolio import Holding, Portfolio
 from PricePoint import PricePoint
 from User import User
 from Asset import Asset
 
 from os.path import exists, join, realpath
 
-from Util import get_real_filename
-
-class Database:
+from SQLiteDatabase import SQLiteDatabase
+from Util import add_column_if_does_not_exist
+
+'''
+Migration 6: the last command id handed out. Every id already used, by an open command or in the ledger, counts as handed out.
+'''
+def add_last_command_id(connection):
+    add_column_if_does_not_exist(connection, "state", "last_command_id", "integer NOT NULL DEFAULT 0")
+    connection.execute('''UPDATE state SET last_command_id = max(last_command_id,
+        (SELECT coalesce(max(command_id), 0) FROM commands),
+        (SELECT coalesce(max(command_id), 0) FROM ledger))''')
+
+#Changes to the schema, oldest first. See Util.migrate. Only ever add to the end.
+#Anything added to setup_database.sql needs a migration too, or databases that are already set up won't get it.
+MIGRATIONS = [
+    #1: Partially filled commands. Databases created before this don't have the column.
+    lambda connection: add_column_if_does_not_exist(connection, "commands", "quantity", "integer NOT NULL DEFAULT 1"),
+    #2: Indexes for the queries that run every turn.
+    [
+        "CREATE INDEX IF NOT EXISTS commands_by_asset ON commands (asset_id, command_type, amount)",
+        "CREATE INDEX IF NOT EXISTS commands_by_user ON commands (user_id, asset_id)",
+        "CREATE INDEX IF NOT EXISTS prices_by_asset ON prices (asset_id, time_id)",
+        "CREATE INDEX IF NOT EXISTS trades_by_time ON trades (time_id, asset_id)"
+    ],
+    #3: The ledger and balance snapshots. The tables themselves come from setup_database.sql.
+    [
+        "CREATE INDEX IF NOT EXISTS ledger_by_account ON ledger (user_id, asset_id, time_id)",
+        "CREATE INDEX IF NOT EXISTS ledger_by_time ON ledger (time_id)",
+        "CREATE INDEX IF NOT EXISTS balance_snapshots_by_account ON balance_snapshots (user_id, asset_id, time_id)",
+        #Opening balances, as of the end of last turn, since nothing before now is in the ledger.
+        '''INSERT OR REPLACE INTO balance_snapshots (time_id, user_id, asset_id, available, escrow)
+            SELECT (SELECT coalesce(max(current_time_id), 0) - 1 FROM state), user_id, 0, coalesce(balance, 0), coalesce(balance_in_escrow, 0) FROM users
+            UNION ALL
+            SELECT (SELECT coalesce(max(current_time_id), 0) - 1 FROM state), user_id, asset_id, coalesce(amount, 0), coalesce(amount_in_escrow, 0) FROM owned_assets'''
+    ],
+    #4: Where the reconcile job got up to.
+    lambda connection: add_column_if_does_not_exist(connection, "state", "last_reconciled_time_id", "integer"),
+    #5: The notification journal. The table itself comes from setup_database.sql.
+    lambda connection: add_column_if_does_not_exist(connection, "state", "imported_logged_notifications", "integer NOT NULL DEFAULT 0"),
+    #6: Where command ids got up to, so they are never reused.
+    add_last_command_id
+]
+
+class Database(SQLiteDatabase):
     def __init__(self, filename : str) -> None:
-        self._con = sqlite3.connect(get_real_filename(filename), timeout=120)
-        with open(get_real_filename("setup_database.sql")) as sql_file:
-            self._con.executescript(sql_file.read())
-    
+        super().__init__(filename, "setup_database.sql", MIGRATIONS)
+        #See get_current_time_id. Only ever set inside a transaction.
+        self._current_time_id : int = None
+
     def commit(self):
-        self.con.commit()
+        super().commit()
+        #Once committed, another process can move time on
+        self._current_time_id = None
 
     def rollback(self):
-        self.con.rollback()
-
-    def close(self):
-        self.con.close()
-
-    @property
-    def con(self) -> sqlite3.Connection:
-        return self._con
+        super().rollback()
+        self._current_time_id = None
 
-    @property
-    def cursor(self) -> sqlite3.Cursor:
-        return self.con.cursor()
-    
     def get_commands(self) -> list[Command]:
         rows = self.get_rows('''SELECT 
                 commands.command_id,
@@ -41,20 +75,22 @@ class Database:
                 commands.amount, 
                 assets.asset_id, 
                 assets.name, 
-                commands.expiring_in 
+                commands.expiring_in,
+                commands.quantity 
             FROM ((commands
                 INNER JOIN users ON commands.user_id = users.user_id)
-                INNER JOIN assets ON commands.asset_id = assets.asset_id)''')
+                INNER JOIN assets ON commands.asset_id = assets.asset_id)
+            ORDER BY commands.command_id''')
         to_return = []
         for row in rows:
-            command_id, user_id, user_name, command_type, amount, asset_id, asset_name, expiring_in = row
+            command_id, user_id, user_name, command_type, amount, asset_id, asset_name, expiring_in, quantity = row
             user = User(user_id, user_name)
             asset = Asset(asset_id, asset_name)
 
             if (command_type == 0):
-                command = BuyCommand(command_id, expiring_in, user, asset, amount)
+                command = BuyCommand(command_id, expiring_in, user, asset, amount, quantity)
             elif (command_type == 1):
-                command = SellCommand(command_id, expiring_in, user, asset, amount)
+                command = SellCommand(command_id, expiring_in, user, asset, amount, quantity)
             else:
                 print("Unknown type")
             to_return.append(command)
@@ -63,45 +99,70 @@ class Database:
     def delete_command(self, command : Command):
         self.run_command("DELETE FROM commands WHERE command_id = ?", command.id)
 
-    def add_command(self, command : Command):
-        #Sanity check: the command should not exist in the table!
-        row = self.get_only_row("SELECT * FROM commands WHERE command_id = ?", command.id)
-        if (row is not None):
-            raise BaseException("That command already exists!")
-
-        self.add_or_update_user(command.user)
-        
-        expiring_in = None
-        if (isinstance(command, ExpiringCommand)):
-            expiring_in = command.time_remaining
-
-        amount = None
-        if (isinstance(command, BuyCommand)):
-            command_type = 0
-            amount = command.max_price
-        elif (isinstance(command, SellCommand)):
-            command_type = 1
-            amount = command.price
-
-        self.run_command('''INSERT INTO commands 
-            (user_id,
+    def delete_commands(self, commands : list[Command]):
+        self.cursor.executemany("DELETE FROM commands WHERE command_id = ?", [(command.id,) for command in commands])
+
+    def add_command(self, command : Command) -> int:
+        return self.add_commands([command])[0]
+
+    '''
+    Inserts all of the commands with a single executemany, and gives each of them its id. Returns the ids, in order.
+    Ids come from a counter in state, not from the commands that are left, so an id is never used twice, even once its command is gone.
+    '''
+    def add_commands(self, commands : list[Command]) -> list[int]:
+        users : dict[int, User] = {command.user.id : command.user for command in commands}
+        for user in users.values():
+            self.add_or_update_user(user)
+        self.create_state_row_if_does_not_exist()
+        last_id = self.get_only_cell("UPDATE state SET last_command_id = last_command_id + ? RETURNING last_command_id", len(commands))
+        ids = list(range(last_id - len(commands) + 1, last_id + 1))
+
+        rows = []
+        for id, command in zip(ids, commands):
+            expiring_in = None
+            quantity = 1
+            if (isinstance(command, ExpiringCommand)):
+                expiring_in = command.time_remaining
+                quantity = command.quantity
+
+            amount = None
+            if (isinstance(command, BuyCommand)):
+                command_type = 0
+                amount = command.max_price
+            elif (isinstance(command, SellCommand)):
+                command_type = 1
+                amount = command.price
+            rows.append((id, command.user.id, command_type, amount, command.asset.id, expiring_in, quantity))
+
+        self.cursor.executemany('''INSERT INTO commands 
+            (command_id,
+            user_id,
             command_type,
             amount,
             asset_id,
-            expiring_in)
-        VALUES (?, ?, ?, ?, ?)''', (command.user.id, command_type, amount, command.asset.id, expiring_in))
-
-    def set_time_remaining(self, command : Command, new_time_remaining : int):
-        self.run_command("UPDATE commands SET expiring_in = ? WHERE command_id = ?", new_time_remaining, command.id)
+            expiring_in,
+            quantity)
+        VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+        #So that the commands can be filled or deleted before they are read back from the database
+        for id, command in zip(ids, commands):
+            command.id = id
+        return ids
+
+    '''
+    Takes a turn off every command, in one statement however many commands there are. Returns the ids of the commands that have run out, including ones that ran out before and haven't been refunded and deleted yet.
+    '''
+    def deduct_time_from_all_commands(self) -> list[int]:
+        self.run_command("UPDATE commands SET expiring_in = expiring_in - 1 WHERE expiring_in IS NOT NULL")
+        return [row[0] for row in self.get_rows("SELECT command_id FROM commands WHERE expiring_in <= 0")]
+
+    def set_quantity(self, command : Command, new_quantity : int):
+        self.run_command("UPDATE commands SET quantity = ? WHERE command_id = ?", new_quantity, command.id)
 
     def add_or_update_user(self, user : User, do_update : bool = True):
-        results = self.get_only_cell("SELECT user_name FROM users WHERE user_id = ?", user.id)
-        if (results is None):
-            # Need to create user
-            self.run_command("INSERT INTO users (user_id, user_name) VALUES (?, ?)", (user.id, user.name))
-        elif (results != user.name and do_update):
-            #Need to update name
-            self.run_command("UPDATE users SET user_name = ? WHERE user_id = ?", (user.name, user.id))
+        if (do_update):
+            self.run_command("INSERT INTO users (user_id, user_name) VALUES (?, ?) ON CONFLICT (user_id) DO UPDATE SET user_name = excluded.user_name", user.id, user.name)
+        else:
+            self.run_command("INSERT INTO users (user_id, user_name) VALUES (?, ?) ON CONFLICT (user_id) DO NOTHING", user.id, user.name)
 
     def add_asset(self, name):
         self.run_command("INSERT INTO assets (name) VALUES (?)", name)
@@ -120,18 +181,25 @@ class Database:
             to_return.append(Asset(id, name)) 
         return to_return
 
-    def create_owned_asset_row_if_does_not_exist(self, user : User, asset : Asset):
-        result = self.get_only_row("SELECT * FROM owned_assets WHERE user_id = ? AND asset_id = ?", user.id, asset.id)
-        if (result == None):
-            self.run_command("INSERT INTO owned_assets (user_id, asset_id) VALUES (?, ?)", user.id, asset.id)
-
-    def set_owned_assets(self, user : User, asset : Asset, number : int = 1):
-        self.create_owned_asset_row_if_does_not_exist(user, asset)        
-        self.run_command("UPDATE owned_assets SET amount = ? WHERE user_id = ? AND asset_id = ?", number, user.id, asset.id)
-
-    def set_owned_assets_in_escrow(self, user: User, asset: Asset, number : int = 1):
-        self.create_owned_asset_row_if_does_not_exist(user, asset)        
-        self.run_command("UPDATE owned_assets SET amount_in_escrow = ? WHERE user_id = ? AND asset_id = ?", number, user.id, asset.id)
+    '''
+    Same as change_balance, but for how many shares of asset the user owns, and has in escrow. Neither can end up below zero.
+    '''
+    def change_owned_assets(self, user : User, asset : Asset, difference : int = 0, escrow_difference : int = 0) -> tuple[int, int]:
+        if (difference < 0 or escrow_difference < 0):
+            rows = self.get_rows('''UPDATE owned_assets SET
+                    amount = coalesce(amount, 0) + ?1,
+                    amount_in_escrow = coalesce(amount_in_escrow, 0) + ?2
+                WHERE user_id = ?3 AND asset_id = ?4
+                    AND coalesce(amount, 0) + ?1 >= 0
+                    AND coalesce(amount_in_escrow, 0) + ?2 >= 0
+                RETURNING amount, amount_in_escrow''', difference, escrow_difference, user.id, asset.id)
+        else:
+            rows = self.get_rows('''INSERT INTO owned_assets (user_id, asset_id, amount, amount_in_escrow) VALUES (?1, ?2, ?3, ?4)
+                ON CONFLICT (user_id, asset_id) DO UPDATE SET
+                    amount = coalesce(amount, 0) + excluded.amount,
+                    amount_in_escrow = coalesce(amount_in_escrow, 0) + excluded.amount_in_escrow
+                RETURNING amount, amount_in_escrow''', user.id, asset.id, difference, escrow_difference)
+        return rows[0] if len(rows) != 0 else None
 
     def get_owned_assets(self, user: User, asset : Asset):
         return self.get_only_cell_or_zero("SELECT amount FROM owned_assets WHERE user_id = ? AND asset_id = ?", user.id, asset.id)
@@ -139,6 +207,37 @@ class Database:
     def get_owned_assets_in_escrow(self, user: User, asset : Asset):
         return self.get_only_cell_or_zero("SELECT amount_in_escrow FROM owned_assets WHERE user_id = ? AND asset_id = ?", user.id, asset.id)
 
+    '''
+    Gets the user's coins and every asset they have any shares of, with each asset's latest price, in one query.
+    '''
+    def get_portfolio(self, user : User) -> Portfolio:
+        rows = self.get_rows('''SELECT 0, NULL, coalesce(balance, 0), coalesce(balance_in_escrow, 0), NULL FROM users WHERE user_id = ?1
+            UNION ALL
+            SELECT
+                assets.asset_id,
+                assets.name,
+                coalesce(owned_assets.amount, 0),
+                coalesce(owned_assets.amount_in_escrow, 0),
+                (SELECT prices.price FROM prices
+                    WHERE prices.asset_id = assets.asset_id AND prices.time_id <= (SELECT coalesce(max(current_time_id), 0) FROM state)
+                    ORDER BY prices.time_id DESC
+                    LIMIT 1)
+            FROM owned_assets
+            INNER JOIN assets
+            ON owned_assets.asset_id = assets.asset_id
+            WHERE
+                owned_assets.user_id = ?1 AND
+                coalesce(owned_assets.amount, 0) + coalesce(owned_assets.amount_in_escrow, 0) != 0
+            ORDER BY 1''', user.id)
+
+        portfolio = Portfolio()
+        for asset_id, name, available, in_escrow, price in rows:
+            if (asset_id == 0):
+                portfolio.balance, portfolio.balance_in_escrow = available, in_escrow
+            else:
+                portfolio.holdings.append(Holding(Asset(asset_id, name), available, in_escrow, price))
+        return portfolio
+
     def set_price(self, pricepoint : PricePoint):
         time_id = pricepoint.time_id
         asset_id = pricepoint.asset.id
@@ -212,19 +311,184 @@ class Database:
             pricepoint = PricePoint(time_id, asset, price, day_average_price, week_average_price, month_average_price)
             return pricepoint
 
+    def add_trade(self, asset : Asset, price : int, quantity : int):
+        self.run_command("INSERT INTO trades (time_id, asset_id, price, quantity) VALUES (?, ?, ?, ?)", self.get_current_time_id(), asset.id, price, quantity)
+
+    '''
+    Gets the average price per share that the asset traded at during the turn, or None if it didn't trade.
+    '''
+    def get_average_trade_price(self, time_id : int, asset : Asset) -> float:
+        return self.get_only_cell("SELECT SUM(price * quantity) * 1.0 / SUM(quantity) FROM trades WHERE time_id = ? AND asset_id = ?", time_id, asset.id)
+
     def get_balance(self, user: User):
         return self.get_only_cell_or_zero("SELECT balance FROM users WHERE user_id = ?", user.id)
     
     def get_balance_in_escrow(self, user: User):
         return self.get_only_cell_or_zero("SELECT balance_in_escrow FROM users WHERE user_id = ?", user.id)
 
-    def set_balance(self, user: User, amount : int):
-        self.add_or_update_user(user)
-        self.run_command("UPDATE users SET balance = ? WHERE user_id = ?", amount, user.id)
-    
-    def set_balance_in_escrow(self, user: User, amount : int):
-        self.add_or_update_user(user)
-        self.run_command("UPDATE users SET balance_in_escrow = ? WHERE user_id = ?", amount, user.id)
+    '''
+    Adds balance_difference to the user's balance and escrow_difference to their balance in escrow, in a single statement. Either can be negative.
+    When money is taken out, nothing is changed if that would leave the balance below minimum_balance, or the balance in escrow below zero. In that case, None is returned.
+    Otherwise, returns the new balance and balance in escrow.
+    '''
+    def change_balance(self, user : User, balance_difference : int = 0, escrow_difference : int = 0, minimum_balance : int = 0) -> tuple[int, int]:
+        if (balance_difference < 0 or escrow_difference < 0):
+            #A user that doesn't exist yet has nothing to take out, so there is nothing to insert.
+            rows = self.get_rows('''UPDATE users SET
+                    balance = coalesce(balance, 0) + ?1,
+                    balance_in_escrow = coalesce(balance_in_escrow, 0) + ?2
+                WHERE user_id = ?3
+                    AND coalesce(balance, 0) + ?1 >= ?4
+                    AND coalesce(balance_in_escrow, 0) + ?2 >= 0
+                RETURNING balance, balance_in_escrow''', balance_difference, escrow_difference, user.id, minimum_balance)
+        else:
+            rows = self.get_rows('''INSERT INTO users (user_id, user_name, balance, balance_in_escrow) VALUES (?1, ?2, ?3, ?4)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    user_name = excluded.user_name,
+                    balance = coalesce(balance, 0) + excluded.balance,
+                    balance_in_escrow = coalesce(balance_in_escrow, 0) + excluded.balance_in_escrow
+                RETURNING balance, balance_in_escrow''', user.id, user.name, balance_difference, escrow_difference)
+        return rows[0] if len(rows) != 0 else None
+
+    '''
+    Adds entries to the ledger, as (time_id, user_id, asset_id, account, delta, reason, command_id).
+    '''
+    def add_ledger_entries(self, entries : list[tuple[int, int, int, str, int, str, int]]):
+        self.cursor.executemany('''INSERT INTO ledger (time_id, user_id, asset_id, account, delta, reason, command_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)''', entries)
+
+    '''
+    Saves everyone's balances and holdings, as they are at the end of turn time_id, worked out from the previous snapshot and the ledger entries since.
+    Nothing is copied from users and owned_assets, so anything that changed them without going through the ledger still shows up in reconcile.
+    '''
+    def take_balance_snapshot(self, time_id : int):
+        self.run_command('''WITH previous AS (SELECT coalesce(max(time_id), -1) AS time_id FROM balance_snapshots WHERE time_id < ?1)
+            INSERT OR REPLACE INTO balance_snapshots (time_id, user_id, asset_id, available, escrow)
+            SELECT ?1, user_id, asset_id, sum(available), sum(escrow) FROM (
+                SELECT user_id, asset_id, available, escrow FROM balance_snapshots WHERE time_id = (SELECT time_id FROM previous)
+                UNION ALL
+                SELECT user_id, asset_id,
+                    sum(CASE WHEN account = 'AVAILABLE' THEN delta ELSE 0 END),
+                    sum(CASE WHEN account = 'ESCROW' THEN delta ELSE 0 END)
+                FROM ledger WHERE time_id > (SELECT time_id FROM previous) AND time_id <= ?1 GROUP BY user_id, asset_id)
+            GROUP BY user_id, asset_id''', time_id)
+
+    '''
+    Works out what a user had available and in escrow at the end of turn time_id, from the latest snapshot before then and the ledger entries since.
+    An asset of None means coins.
+    '''
+    def get_balances_at(self, user : User, asset : Asset, time_id : int) -> tuple[int, int]:
+        asset_id = asset.id if asset is not None else 0
+        snapshot = self.get_only_row('''SELECT time_id, available, escrow FROM balance_snapshots
+            WHERE user_id = ? AND asset_id = ? AND time_id <= ?
+            ORDER BY time_id DESC LIMIT 1''', user.id, asset_id, time_id)
+        snapshot_time_id, available, escrow = snapshot if snapshot is not None else (-1, 0, 0)
+        available_since, escrow_since = self.get_only_row('''SELECT
+                coalesce(sum(CASE WHEN account = 'AVAILABLE' THEN delta END), 0),
+                coalesce(sum(CASE WHEN account = 'ESCROW' THEN delta END), 0)
+            FROM ledger
+            WHERE user_id = ? AND asset_id = ? AND time_id > ? AND time_id <= ?''', user.id, asset_id, snapshot_time_id, time_id)
+        return available + available_since, escrow + escrow_since
+
+    '''
+    Finds every account whose escrow doesn't match its open commands: coins against max price times quantity of its BUY commands, and shares against the quantity of its SELL commands.
+    Returns (user_id, asset_id, how much more is in escrow than there should be). An asset_id of 0 means coins.
+    '''
+    def get_escrow_discrepancies(self) -> list[tuple[int, int, int]]:
+        return self.get_rows('''SELECT user_id, asset_id, sum(escrow) FROM (
+                SELECT user_id, 0 AS asset_id, coalesce(balance_in_escrow, 0) AS escrow FROM users
+                UNION ALL
+                SELECT user_id, asset_id, coalesce(amount_in_escrow, 0) FROM owned_assets
+                UNION ALL
+                SELECT user_id, 0, -sum(amount * quantity) FROM commands WHERE command_type = 0 GROUP BY user_id
+                UNION ALL
+                SELECT user_id, asset_id, -sum(quantity) FROM commands WHERE command_type = 1 GROUP BY user_id, asset_id)
+            GROUP BY user_id, asset_id
+            HAVING sum(escrow) != 0''')
+
+    '''
+    Finds every account whose balances don't match the latest balance snapshot plus the ledger entries since.
+    Returns (user_id, asset_id, how much more is available than there should be, how much more is in escrow than there should be). An asset_id of 0 means coins.
+    '''
+    def get_ledger_discrepancies(self) -> list[tuple[int, int, int, int]]:
+        snapshot_time_id = self.get_only_cell("SELECT coalesce(max(time_id), -1) FROM balance_snapshots")
+        return self.get_rows('''SELECT user_id, asset_id, sum(available), sum(escrow) FROM (
+                SELECT user_id, 0 AS asset_id, coalesce(balance, 0) AS available, coalesce(balance_in_escrow, 0) AS escrow FROM users
+                UNION ALL
+                SELECT user_id, asset_id, coalesce(amount, 0), coalesce(amount_in_escrow, 0) FROM owned_assets
+                UNION ALL
+                SELECT user_id, asset_id, -available, -escrow FROM balance_snapshots WHERE time_id = ?1
+                UNION ALL
+                SELECT user_id, asset_id,
+                    -sum(CASE WHEN account = 'AVAILABLE' THEN delta ELSE 0 END),
+                    -sum(CASE WHEN account = 'ESCROW' THEN delta ELSE 0 END)
+                FROM ledger WHERE time_id > ?1 GROUP BY user_id, asset_id)
+            GROUP BY user_id, asset_id
+            HAVING sum(available) != 0 OR sum(escrow) != 0''', snapshot_time_id)
+
+    '''
+    Finds the turns after time_id in which coins or shares of an asset were created or destroyed, ie, the ledger entries don't add up to zero.
+    Returns (time_id, asset_id, how much was created).
+    '''
+    def get_unbalanced_ledger_turns(self, time_id : int) -> list[tuple[int, int, int]]:
+        return self.get_rows('''SELECT time_id, asset_id, sum(delta) FROM ledger
+            WHERE time_id > ?
+            GROUP BY time_id, asset_id
+            HAVING sum(delta) != 0''', time_id)
+
+    def get_last_reconciled_time_id(self) -> int:
+        return self.get_only_cell("SELECT coalesce(max(last_reconciled_time_id), -1) FROM state")
+
+    def set_last_reconciled_time_id(self, time_id : int):
+        self.create_state_row_if_does_not_exist()
+        self.run_command("UPDATE state SET last_reconciled_time_id = ?", time_id)
+
+    '''
+    Gets the user's balance and balance in escrow, in one query.
+    '''
+    def get_balances(self, user : User) -> tuple[int, int]:
+        row = self.get_only_row("SELECT coalesce(balance, 0), coalesce(balance_in_escrow, 0) FROM users WHERE user_id = ?", user.id)
+        return row if row is not None else (0, 0)
+
+    '''
+    Gets how many shares of asset the user has available and in escrow, in one query.
+    '''
+    def get_owned_asset_balances(self, user : User, asset : Asset) -> tuple[int, int]:
+        row = self.get_only_row("SELECT coalesce(amount, 0), coalesce(amount_in_escrow, 0) FROM owned_assets WHERE user_id = ? AND asset_id = ?", user.id, asset.id)
+        return row if row is not None else (0, 0)
+
+    '''
+    Gets (user_id, balance, balance in escrow) for every one of the users that exists, in one query.
+    '''
+    def get_balances_of(self, user_ids : list[int]) -> list[tuple[int, int, int]]:
+        return self.get_rows('''SELECT user_id, coalesce(balance, 0), coalesce(balance_in_escrow, 0) FROM users
+            WHERE user_id IN (SELECT value FROM json_each(?))''', json.dumps(user_ids))
+
+    '''
+    Gets (user_id, asset_id, amount, amount in escrow) for every one of the (user_id, asset_id) holdings that exists, in one query.
+    '''
+    def get_owned_asset_balances_of(self, holdings : list[tuple[int, int]]) -> list[tuple[int, int, int, int]]:
+        return self.get_rows('''SELECT user_id, asset_id, coalesce(amount, 0), coalesce(amount_in_escrow, 0) FROM owned_assets
+            WHERE (user_id, asset_id) IN (SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?))''', json.dumps(holdings))
+
+    '''
+    Adds to many users' balances at once, given (user_id, user_name, balance difference, escrow difference). Nothing is checked, so check first.
+    '''
+    def add_to_balances(self, rows : list[tuple[int, str, int, int]]):
+        self.cursor.executemany('''INSERT INTO users (user_id, user_name, balance, balance_in_escrow) VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                user_name = excluded.user_name,
+                balance = coalesce(balance, 0) + excluded.balance,
+                balance_in_escrow = coalesce(balance_in_escrow, 0) + excluded.balance_in_escrow''', rows)
+
+    '''
+    Same as add_to_balances, but for holdings, given (user_id, asset_id, difference, escrow difference).
+    '''
+    def add_to_owned_assets(self, rows : list[tuple[int, int, int, int]]):
+        self.cursor.executemany('''INSERT INTO owned_assets (user_id, asset_id, amount, amount_in_escrow) VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id, asset_id) DO UPDATE SET
+                amount = coalesce(amount, 0) + excluded.amount,
+                amount_in_escrow = coalesce(amount_in_escrow, 0) + excluded.amount_in_escrow''', rows)
 
     def create_state_row_if_does_not_exist(self):
         row = self.get_only_row("SELECT * FROM state")
@@ -238,39 +502,46 @@ class Database:
     def get_last_processed_notification_id(self):
         return self.get_only_cell_or_zero("SELECT last_processed_notification_id FROM state")
 
+    '''
+    Records that a notification was handled, and how it went. The notification is stored as JSON.
+    '''
+    def add_processed_notification(self, notification : dict, outcome : str):
+        self.run_command('''INSERT OR REPLACE INTO processed_notifications (notification_id, type, user_id, outcome, payload, time_id)
+            VALUES (?, ?, ?, ?, ?, ?)''', int(notification['id']), notification.get('type'), int(notification.get('user_id') or 0), outcome, json.dumps(notification, default=str), self.get_current_time_id())
+
+    '''
+    Records notifications that were handled before there was a journal, as (notification_id, type, user_id, payload). Ones already in the journal are left alone.
+    '''
+    def add_logged_notifications(self, notifications : list[tuple[int, str, int, str]], outcome : str):
+        self.cursor.executemany('''INSERT OR IGNORE INTO processed_notifications (notification_id, type, user_id, outcome, payload, time_id)
+            VALUES (?, ?, ?, ?, ?, NULL)''', [(notification_id, type, user_id, outcome, payload) for notification_id, type, user_id, payload in notifications])
+
+    def is_notification_processed(self, notification_id : int) -> bool:
+        return self.get_only_row("SELECT 1 FROM processed_notifications WHERE notification_id = ?", notification_id) is not None
+
+    def get_processed_notification_ids(self) -> set[int]:
+        return {row[0] for row in self.get_rows("SELECT notification_id FROM processed_notifications")}
+
+    def get_imported_logged_notifications(self) -> bool:
+        return self.get_only_cell_or_zero("SELECT imported_logged_notifications FROM state") != 0
+
+    def set_imported_logged_notifications(self):
+        self.create_state_row_if_does_not_exist()
+        self.run_command("UPDATE state SET imported_logged_notifications = 1")
+
     def set_current_time_id(self, time_id : int):
         self.create_state_row_if_does_not_exist()
         self.run_command("UPDATE state SET current_time_id = ?", time_id)
+        self._current_time_id = time_id
 
+    '''
+    Gets the current turn. Inside a transaction it is only read once, since everything that is logged asks for it.
+    Outside of one, every SELECT sees the latest commit, so another process could move time on between two reads, and it is read every time.
+    '''
     def get_current_time_id(self) -> int:
-        return self.get_only_cell_or_zero("SELECT current_time_id FROM state")
-
-    def unpack_nested_tuple(self, my_tuple):
-        if (len(my_tuple) != 1 or type(my_tuple[0]) is not tuple):
-            return (my_tuple)
-        else:
-            return self.unpack_nested_tuple(my_tuple[0])
-
-    def run_command(self, command, *args):
-        return self.cursor.execute(command, self.unpack_nested_tuple(args))
-    
-    def get_rows(self, command, *args):
-        return self.run_command(command, args).fetchall()
-    
-    def get_only_row(self, command, *args):
-        to_return = self.run_command(command, args).fetchone()
-        return to_return
-    
-    def get_only_cell(self, command, *args):
-        row = self.get_only_row(command, args)
-        if (row is None):
-            return None
-        assert (len(row) == 1)
-        return row[0]
-    
-    def get_only_cell_or_zero(self, command, *args):
-        result = self.get_only_cell(command, args)
-        if (result is None):
-            return 0
-        else:
-            return result
\ No newline at end of file
+        if (self._current_time_id is not None):
+            return self._current_time_id
+        current_time_id = self.get_only_cell_or_zero("SELECT current_time_id FROM state")
+        if (self.con.in_transaction):
+            self._current_time_id = current_time_id
+        return current_time_id
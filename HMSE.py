@@ -1,15 +1,26 @@
 TEST = False
+#How many processes process() uses to match assets in parallel. None matches every asset in this process.
+CLEARING_PROCESSES = None
+#If True, BUY and SELL commands are matched against the resting commands as soon as they are placed, and process() only expires commands and records prices.
+CONTINUOUS_MATCHING = False
+#Every this many turns, process() saves everyone's balances, so a balance at any turn only needs the ledger entries since the last snapshot.
+BALANCE_SNAPSHOT_INTERVAL = 24
 
 import ast
+from concurrent.futures import ProcessPoolExecutor
+from itertools import zip_longest
+import json
 from pprint import pprint
+import re
 import sys
 import traceback
 
-from numpy import average
 from Asset import Asset
-from Command import BuyCommand, Command, ExpiringCommand, SellCommand
+from Command import BuyCommand, ExpiringCommand, SellCommand
 from CommandQueue import CommandQueue
 from Log import Log, LogMessageType
+from MarketResult import Fill, MarketResult
+from MarketSnapshot import MarketSnapshot
 from MessageManager import MessageManager, MessageType
 from Parser import Parser
 from Bank import Bank
@@ -17,6 +28,7 @@ from Database import Database
 from PriceTracker import PriceTracker
 from RDramaAPIInterface import TEST_AUTH_TOKEN, RDramaAPIInterface
 from Randsey import Randsey
+from SQLiteDatabase import TransactionListener
 from StockExchange import StockExchange
 from TickerGenerator import TickerGenerator
 from User import User
@@ -26,13 +38,43 @@ from os.path import exists, join, realpath
 from Util import get_real_filename
 
 
+'''
+How handling a notification went, as recorded in the notification journal.
+'''
+class NotificationOutcome:
+    HANDLED = "HANDLED"
+    EXCEPTION = "EXCEPTION"
+
+'''
+Writes a notification's journal row just before every commit that writes something while it is being handled, including the ones handle_command makes.
+That way the row is committed together with whatever the notification changed, and a notification is never half handled and then handled again.
+A commit with nothing in it doesn't take the write lock, so read-only commands, like BALANCE and MARKET, are answered without waiting for a tick to finish. Their row is written once they have been answered.
+'''
+class NotificationJournalWriter(TransactionListener):
+    def __init__(self, database : Database, notification) -> None:
+        self.database = database
+        self.notification = notification
+        self.outcome = NotificationOutcome.HANDLED
+        #Set once the notification has been answered, so the row is written even if nothing else is
+        self.answered = False
+        #Whether the row in the database is up to date
+        self.written = False
+
+    def before_commit(self):
+        if (self.database.con.in_transaction or (self.answered and not self.written)):
+            self.database.add_processed_notification(self.notification, self.outcome)
+            self.written = True
+
+    def after_rollback(self):
+        self.written = False
+
 '''
 The real driver of HMSE.
 '''
 class HMSE:
     CLASS_NAME = "HMSE"
 
-    def __init__(self, api : RDramaAPIInterface, database : Database, bank : Bank, parser : Parser, commandQueue : CommandQueue, log : Log):
+    def __init__(self, api : RDramaAPIInterface, database : Database, bank : Bank, parser : Parser, commandQueue : CommandQueue, log : Log, clearing_processes : int = None, continuous_matching : bool = False):
         self.all_assets = database.get_all_assets()
         self.api = api
         self.bank = bank
@@ -41,10 +83,15 @@ class HMSE:
         self.commandQueue = commandQueue
         self.randsey = Randsey(self.all_assets)
         self.messageManager = MessageManager(api, self.randsey) 
+        #Messages about something that gets rolled back are never sent
+        self.database.add_transaction_listener(self.messageManager)
         self.priceTracker = PriceTracker(self.database)
         self.stockExchange = StockExchange()
+        self.marketSnapshot = MarketSnapshot(self.stockExchange, self.commandQueue, self.all_assets)
         self.log = log
         self.tickerGenerator = TickerGenerator(self.priceTracker, self.all_assets)
+        self.clearing_processes = clearing_processes
+        self.continuous_matching = continuous_matching
 
     '''
     Handles all notifications.
@@ -53,25 +100,25 @@ class HMSE:
         try:
             last_processed_notification_id = self.database.get_last_processed_notification_id()
             notifications = self.api.get_parsed_notification(last_processed_notification_id)
-            new_notifications = [i['id'] for i in notifications]
-            if (new_notifications != []):
-                new_last_processed_notification_id = new_notifications[0]
-                self.database.set_last_processed_notification_id(new_last_processed_notification_id)
-            else:
-                new_last_processed_notification_id = last_processed_notification_id
-
         except BaseException as e:
 
             self.log.add_log_message(self.CLASS_NAME, LogMessageType.EXCEPTION, f"Exception occurred in last_processed_notification_id: {e}")
             self.database.rollback()
             return
-        finally:
-            self.database.commit()
         
         print(f"Got {len(notifications)} notifications")
         for notification in notifications:
             self.handle_notification(notification)
 
+        #Only written once every notification has been answered, so no answer waits for a tick to finish. If this stops halfway, the journal stops the next run from handling any notification twice.
+        if (notifications != []):
+            self.database.set_last_processed_notification_id(notifications[0]['id'])
+            self.database.commit()
+
+        if (self.continuous_matching):
+            #Let the owners of the resting commands that were matched know
+            self.send_queued_messages()
+
     '''
     Handles a single notification
     '''
@@ -80,33 +127,19 @@ class HMSE:
             user = User(notification['user_id'], notification['user_name'])
         else:
             user = None
+        #Notifications without an id can't be told apart, so they are never journaled or skipped.
+        notification_id = int(notification.get('id') or 0)
+        if (notification_id != 0 and self.database.is_notification_processed(notification_id)):
+            print(f"Skipping notification {notification_id}, it was already handled")
+            return
         self.log.add_log_message(self.CLASS_NAME, LogMessageType.PROCESS_NOTIFICATION, str(notification), user=user)
 
+        journal_writer = None
+        if (notification_id != 0):
+            journal_writer = NotificationJournalWriter(self.database, notification)
+            self.database.add_transaction_listener(journal_writer)
         try:
-            if notification['type'] == 'transfer':
-                self.bank.deposit(user, notification['amount'])
-                message = f"Deposited {notification['amount']} in your account.\n\n"
-                message += special_message
-                message += self.randsey.get_randsey_says(user)
-                self.api.send_message(user.name, message)
-                self.log.add_log_message(self.CLASS_NAME, LogMessageType.DEPOSIT, str(notification['amount']), user=user)
-            elif notification['type'] == 'post_mention':
-                self.api.reply_to_comment_easy(notification['id'], notification['post_id'], ":randsey: You rang?")
-            elif notification['type'] == 'follow':
-                self.api.send_message(user.name, f":randsey: *If it isn't {user.name}. Don't expect any special favors.* {self.randsey.get_randsey_says(user)}")
-            elif notification['type'] == 'unfollow':
-                self.api.send_message(user.name, f":randsey: *Well, fuck you too, I guess.* {self.randsey.get_randsey_says(user)}")
-            elif notification['type'] == 'comment_reply':
-                for reply in notification['replies']:
-                    user = User(int(reply['user_id']), reply['user_name'])
-                    response = self.handle_command(user, reply['message'])
-                    self.api.reply_to_comment_easy(reply['id'], notification['post_id'], response, special_message)
-            elif notification['type'] == 'direct_message':
-                response = self.handle_command(user, notification['message_html'], special_message=special_message)
-                self.api.reply_to_direct_message(notification['id'], str(response))
-            elif notification['type'] == 'comment_mention':
-                response = self.handle_command(user, notification['message'], special_message=special_message)
-                self.api.reply_to_comment_easy(notification['id'], notification['post_id'], str(response))
+            self._handle_notification(notification, user, special_message)
         except BaseException as e:
             print(f"=====Exception occurred!=====")
             print("While processing this notification:")
@@ -115,8 +148,65 @@ class HMSE:
             print(traceback.format_exc())
             self.log.add_log_message(self.CLASS_NAME, LogMessageType.EXCEPTION, f"While processing notification: {traceback.format_exc()}")
             self.database.rollback()
-        else:
+            if (journal_writer is not None):
+                journal_writer.outcome = NotificationOutcome.EXCEPTION
+        try:
+            if (journal_writer is not None):
+                journal_writer.answered = True
             self.database.commit()
+        finally:
+            if (journal_writer is not None):
+                self.database.remove_transaction_listener(journal_writer)
+
+    '''
+    Does whatever the notification asks for. Commits are left to handle_notification and handle_command.
+    '''
+    def _handle_notification(self, notification, user : User, special_message : str):
+        if notification['type'] == 'transfer':
+            self.bank.deposit(user, notification['amount'])
+            message = f"Deposited {notification['amount']} in your account.\n\n"
+            message += special_message
+            message += self.randsey.get_randsey_says(user)
+            self.api.send_message(user.name, message)
+            self.log.add_log_message(self.CLASS_NAME, LogMessageType.DEPOSIT, str(notification['amount']), user=user)
+        elif notification['type'] == 'post_mention':
+            self.api.reply_to_comment_easy(notification['id'], notification['post_id'], ":randsey: You rang?")
+        elif notification['type'] == 'follow':
+            self.api.send_message(user.name, f":randsey: *If it isn't {user.name}. Don't expect any special favors.* {self.randsey.get_randsey_says(user)}")
+        elif notification['type'] == 'unfollow':
+            self.api.send_message(user.name, f":randsey: *Well, fuck you too, I guess.* {self.randsey.get_randsey_says(user)}")
+        elif notification['type'] == 'comment_reply':
+            for reply in notification['replies']:
+                user = User(int(reply['user_id']), reply['user_name'])
+                response = self.handle_command(user, reply['message'])
+                self.api.reply_to_comment_easy(reply['id'], notification['post_id'], response, special_message)
+        elif notification['type'] == 'direct_message':
+            response = self.handle_command(user, notification['message_html'], special_message=special_message)
+            self.api.reply_to_direct_message(notification['id'], str(response))
+        elif notification['type'] == 'comment_mention':
+            response = self.handle_command(user, notification['message'], special_message=special_message)
+            self.api.reply_to_comment_easy(notification['id'], notification['post_id'], str(response))
+
+    '''
+    Copies the notifications that were handled before there was a journal from the log into the journal. Only does anything the first time it is called.
+    '''
+    def import_logged_notifications(self):
+        if (self.database.get_imported_logged_notifications()):
+            return
+        logged_notifications = []
+        for i in self.log.get_log_messages(LogMessageType.PROCESS_NOTIFICATION):
+            try:
+                notification = ast.literal_eval(i['message'].replace("'", '"'))
+                the_id = int(notification['id'])
+                if the_id != 0:
+                    logged_notifications.append((the_id, notification.get('type'), i['user_id'], json.dumps(notification, default=str)))
+            except:
+                print("Unprocessable: ")
+                pprint(i)
+        #Whether they went through or not wasn't recorded, but they were handled, so they count as processed.
+        self.database.add_logged_notifications(logged_notifications, NotificationOutcome.HANDLED)
+        self.database.set_imported_logged_notifications()
+        self.database.commit()
     '''
     handles command, returns some messaging around what happened.
     '''
@@ -125,43 +215,45 @@ class HMSE:
         to_return = ""
 
         try:
-            if (command['type'] == "BALANCE"):
-                #todo: add more information about owned stocks
-                balance = self.database.get_balance(user)
-                balance_in_escrow = self.database.get_balance_in_escrow(user)
-                to_return = f"Currently, you have {balance + balance_in_escrow} coins in your account. Of these, {balance} are available, and the rest are in escrow."
-
-                headers = ["What", "Available", "In Escrow", "Total"]
+            #Every command that names an asset gets the same error if there is no such asset
+            if ('asset' in command and self.database.get_asset_with_name(command['asset'].upper()) is None):
+                to_return = f"There is no asset called {command['asset']}. Use @hmse ticker to see them all."
+            elif (command['type'] == "BALANCE"):
+                #Everything comes from one query, however many assets there are
+                portfolio = self.bank.get_portfolio(user)
+                balance = portfolio.balance
+                balance_in_escrow = portfolio.balance_in_escrow
+                to_return = f"Currently, you have {balance + balance_in_escrow} coins in your account. Of these, {balance} are available, and the rest are in escrow. At the latest prices, everything you own is worth {portfolio.value} coins."
+
+                headers = ["What", "Available", "In Escrow", "Total", "Value"]
                 rows = []
                 rows.append (
                     [
                         "(coins)",
                         balance,
                         balance_in_escrow,
+                        balance + balance_in_escrow,
                         balance + balance_in_escrow
                     ]
                 )
 
-                for asset in self.all_assets:
-                    owned_available = self.bank.get_number_of_assets(user, asset)
-                    owned_in_escrow = self.bank.get_number_of_assets_in_escrow(user, asset)
-                    owned_total = owned_available + owned_in_escrow
-
-                    if (owned_total != 0):
-                        rows.append(
-                            [
-                                asset.name,
-                                owned_available,
-                                owned_in_escrow,
-                                owned_total
-                            ]
-                        )
+                for holding in portfolio.holdings:
+                    rows.append(
+                        [
+                            holding.asset.name,
+                            holding.available,
+                            holding.in_escrow,
+                            holding.total,
+                            holding.value
+                        ]
+                    )
 
                 rows.append(
                     [
                         "BITCHES",
                         0,
                         0,
+                        0,
                         0
                     ]
                 )
@@ -173,16 +265,19 @@ class HMSE:
                 count = int(command['count'])
                 time_remaining = min(int(command['time_remaining']), 24)
 
-                if (self.bank.get_balance(user) < max_price * count): #Make sure that user has enough for max...
+                if (time_remaining < 1):
+                    to_return = "Orders have to last at least 1 turn."
+                elif (self.bank.get_balance(user) < max_price * count): #Make sure that user has enough for max...
                     to_return = "You don't have enough money! lmao"
                 elif (self.commandQueue.is_selling_asset(user, asset)):
                     to_return = "You aren't allowed to buy and sell an asset at the same time, Schlomo."
                 else:
-                    self.bank.transfer_to_escrow(user, max_price * count)
-                    for i in range(count):
-                        command = BuyCommand(None, time_remaining, user, asset, max_price)
-                        self.commandQueue.add_command(command)
+                    command = BuyCommand(None, time_remaining, user, asset, max_price, count)
+                    self.commandQueue.add_command(command)
+                    self.bank.transfer_to_escrow(user, max_price * count, command)
                     to_return = f"Placed a BUY order for {count} share(s) of {asset.name} for a maximum price of {max_price}, expiring in {time_remaining} turns."
+                    if (self.continuous_matching):
+                        to_return += self.match_incoming_command(command)
                     self.log.add_log_message(self.CLASS_NAME, LogMessageType.PLACE_BUY_COMMANDS, to_return, user=user)
             elif (command['type'] == "SELL"):
                 asset = self.database.get_asset_with_name(command['asset'].upper())
@@ -190,16 +285,19 @@ class HMSE:
                 count = int(command['count'])
                 time_remaining = min(int(command['time_remaining']), 24)
 
-                if (self.bank.get_number_of_assets(user, asset) < count): #Make sure that user has enough assets...
+                if (time_remaining < 1):
+                    to_return = "Orders have to last at least 1 turn."
+                elif (self.bank.get_number_of_assets(user, asset) < count): #Make sure that user has enough assets...
                     to_return = "You don't have enough shares! lmao"
                 elif (self.commandQueue.is_buying_asset(user, asset)):
                     to_return = "You aren't allowed to buy and sell an asset at the same time, Schlomo."
                 else:
-                    self.bank.transfer_asset_to_escrow(user, asset, count)
-                    for i in range(count):
-                        command = SellCommand(None, time_remaining, user, asset, price)
-                        self.commandQueue.add_command(command)
+                    command = SellCommand(None, time_remaining, user, asset, price, count)
+                    self.commandQueue.add_command(command)
+                    self.bank.transfer_asset_to_escrow(user, asset, count, command)
                     to_return = f"Placed a SELL order for {count} share(s) of {asset.name} for a minimum price of {price}, expiring in {time_remaining} turns."
+                    if (self.continuous_matching):
+                        to_return += self.match_incoming_command(command)
                     self.log.add_log_message(self.CLASS_NAME, LogMessageType.PLACE_SELL_COMMANDS, to_return, user=user)
             elif (command['type'] == "CANCEL"):
                 asset = self.database.get_asset_with_name(command['asset'].upper())
@@ -207,13 +305,13 @@ class HMSE:
 
                 for i in commands:
                     if (isinstance(i, BuyCommand)):
-                        self.bank.transfer_from_escrow(user, i.max_price)
+                        self.bank.transfer_from_escrow(user, i.max_price * i.quantity, i)
                         self.commandQueue.delete_command(i)
-                        to_return += f"Canceled {i}. Refunded {i.max_price}\n"
+                        to_return += f"Canceled {i}. Refunded {i.max_price * i.quantity}\n"
                     elif (isinstance(i, SellCommand)):
-                        self.bank.transfer_asset_from_escrow(user, asset, 1)
+                        self.bank.transfer_asset_from_escrow(user, asset, i.quantity, i)
                         self.commandQueue.delete_command(i)
-                        to_return += f"Canceled {i}. Refunded 1 {asset.name}\n"
+                        to_return += f"Canceled {i}. Refunded {i.quantity} {asset.name}\n"
                     else:
                         to_return += f"Couldn't cancel {i}.\n"
                 self.log.add_log_message(self.CLASS_NAME, LogMessageType.CANCEL_COMMANDS, to_return, user=user)
@@ -226,33 +324,41 @@ class HMSE:
                     self.api.give_coins(user.name, amount)
                     to_return = f"Withdrew {amount}."
                     self.log.add_log_message(self.CLASS_NAME, LogMessageType.WITHDRAWAL, to_return, user=user)
+            elif (command['type'] == "MARKET" and re.fullmatch(r"-?[0-9]+", str(command['depth'])) is None):
+                to_return = f"The depth has to be a whole number of price levels, like depth=5. \"{command['depth']}\" isn't one."
             elif (command['type'] == "MARKET"):
                 asset = self.database.get_asset_with_name(command['asset'].upper())
-                market_status = self.stockExchange.get_sales(self.commandQueue.get_commands(), self.all_assets)[asset]
+                book = self.commandQueue.get_book(asset)
+                market_status = self.marketSnapshot.get_asset_sales(asset)
                 
-                to_return = f"There are {len(market_status['sell_offers'])} sellers and {len(market_status['buy_offers'])} buyers. "
-                if (market_status['buyers_market']):
+                to_return = f"There are {book.asks.count} sellers offering {book.asks.quantity} share(s) and {book.bids.count} buyers wanting {book.bids.quantity} share(s). "
+                if (market_status.buyers_market):
                     to_return+="That makes the market a *buyer's market*, meaning that the buyer will pay the seller's price."
                 else:
                     to_return+="That makes the market a *seller's market*, meaning that the buyer will pay the buyer's max price."
                 
                 to_return += "\n\n"
-                buy_offers = [i.max_price for i in market_status['buy_offers']]
-                sell_offers = [i.price for i in market_status['sell_offers']]
-                completed_sale_max_prices = [i['max_price'] for i in market_status['completed_sales']]
-                completed_sale_sellers_prices = [i['price'] for i in market_status['completed_sales']]
-                if (buy_offers != []):
-                    buy_offers.sort()
-                    to_return += f"Highest Bid: {buy_offers[-1]}\n\n"
-                if (completed_sale_max_prices != []):
-                    completed_sale_max_prices.sort()
-                    to_return += f"Lowest Winning Bid: {completed_sale_max_prices[0]}\n\n"
-                if (sell_offers != []):
-                    sell_offers.sort()
-                    to_return += f"Lowest Asking Price: {sell_offers[0]}\n\n"
-                if (completed_sale_sellers_prices != []):
-                    completed_sale_sellers_prices.sort()
-                    to_return += f"Highest Winning Asking Price: {completed_sale_sellers_prices[0]}\n\n"    
+                #Sales are made from the best bid and the best ask downwards, so the last sale has the lowest winning bid and the highest winning asking price.
+                completed_sales = market_status.completed_sales
+                if (book.best_bid is not None):
+                    to_return += f"Highest Bid: {book.best_bid.max_price}\n\n"
+                if (completed_sales != []):
+                    to_return += f"Lowest Winning Bid: {completed_sales[-1].max_price}\n\n"
+                if (book.best_ask is not None):
+                    to_return += f"Lowest Asking Price: {book.best_ask.price}\n\n"
+                if (completed_sales != []):
+                    to_return += f"Highest Winning Asking Price: {completed_sales[-1].price}\n\n"
+
+                #Market depth: the best price levels on each side, side by side.
+                bid_levels, ask_levels = book.get_depth(max(0, min(int(command['depth']), 20)))
+                if (bid_levels != [] or ask_levels != []):
+                    headers = ["Buyers", "Shares", "Bid", "Ask", "Shares", "Sellers"]
+                    rows = []
+                    for bid_level, ask_level in zip_longest(bid_levels, ask_levels):
+                        row = [bid_level.count, bid_level.quantity, bid_level.price] if bid_level is not None else ["", "", ""]
+                        row += [ask_level.price, ask_level.quantity, ask_level.count] if ask_level is not None else ["", "", ""]
+                        rows.append(row)
+                    to_return += tabulate(rows, headers=headers, tablefmt='html')
             elif (command['type'] == "TICKER"):
                 to_return = self.tickerGenerator.generate()
             elif (command['type'] == "TREND"):
@@ -298,213 +404,307 @@ class HMSE:
     '''
     def process(self):
         self.log.add_log_message(self.CLASS_NAME, LogMessageType.PROCESS, "Processing...")
-        commands = self.commandQueue.get_commands()
-
-        #Perform all transactions
-        pprint(self.stockExchange.get_sales(commands, self.all_assets)) #TODO
-        self.handle_transactions(commands)
+        #Take the write lock up front, so nothing else can change an account while it is cached.
+        self.database.begin_immediate()
+        #Every account is read once, and written once, when the tick commits.
+        with self.bank.cached_accounts():
+            #Perform all transactions. Matching can be spread over processes, but sales are always settled here, one asset at a time, in order.
+            #With continuous matching, commands were already matched when they were placed.
+            if (not self.continuous_matching):
+                if (self.clearing_processes is not None):
+                    with ProcessPoolExecutor(self.clearing_processes) as pool:
+                        sales = self.marketSnapshot.get_sales(pool=pool)
+                else:
+                    sales = self.marketSnapshot.get_sales()
+                pprint(sales) #TODO
+                self.handle_transactions(sales)
+            else:
+                #Incoming commands are matched as they are placed, but books that were already crossed (IPOs, or commands placed before continuous matching was turned on) never get an incoming command to match them. Those are cleared here.
+                crossed_assets = [asset for asset, book in self.commandQueue.get_books().items() if book.is_crossed()]
+                if (crossed_assets != []):
+                    self.handle_transactions(self.marketSnapshot.get_sales(crossed_assets))
+            self.update_prices()
 
-        #Deduct time on all commands that need it
-        expiring_commands : list[ExpiringCommand] = list(filter(lambda a : issubclass(type(a), ExpiringCommand), commands))
-        for expiring_command in expiring_commands:
+            #Deduct time on all commands, and refund the ones that expired
             try:
-                has_expired = self.commandQueue.deduct_time(expiring_command)
-                if (has_expired):
-                    if (isinstance(expiring_command, BuyCommand)):
-                        #Return amount in escrow
-                        self.bank.transfer_from_escrow(expiring_command.user, expiring_command.max_price)
-                        self.messageManager.send_message_queued(expiring_command.user, expiring_command, MessageType.INFO, "BUY operation expired. :marseylaugh:")
-                        self.log.add_log_message(self.CLASS_NAME, LogMessageType.EXPIRED, f"Refunding {expiring_command.max_price}", user = expiring_command.user)
-                    elif (isinstance(expiring_command, SellCommand)):
-                        #Return asset in escrow
-                        self.bank.transfer_asset_from_escrow(expiring_command.user, expiring_command.asset, 1)
-                        self.messageManager.send_message_queued(expiring_command.user, expiring_command, MessageType.INFO, "SELL operation expired. :marseylaugh:")
-                        self.log.add_log_message(self.CLASS_NAME, LogMessageType.EXPIRED, f"Refunding 1 {expiring_command.asset.name}", user = expiring_command.user)
+                with self.database.savepoint("expiry"):
+                    expired_commands = self.commandQueue.expire_commands()
             except BaseException as e:
-                self.database.rollback()
                 print(f"=====Exception occurred!=====")
-                print("While attempting to make a command expire:")
-                pprint(expiring_command)
+                print("While attempting to make commands expire:")
                 print(f"We got: \"{e}\"")
                 print(traceback.format_exc())
                 self.log.add_log_message(self.CLASS_NAME, LogMessageType.EXCEPTION, str(traceback.format_exc()))
             else:
-                self.database.commit()
+                self.refund_expired_commands(expired_commands)
 
-        for queued_message in self.messageManager.get_all_queued_messages():
+            #Increment time
+            current_time = self.database.get_current_time_id()
+            if (current_time % BALANCE_SNAPSHOT_INTERVAL == 0):
+                #The snapshot is worked out from the ledger, so the cached entries have to be in it
+                self.bank.flush()
+                self.database.take_balance_snapshot(current_time)
+            self.database.set_current_time_id(current_time+1)
+
+            #The whole tick is one transaction, so it is only written to disk once. Messages go out once it is.
+            self.database.commit()
+        self.send_queued_messages()
+
+    '''
+    Deletes the expired commands and gives back what they had in escrow. Refunds are added up first, so each user gets one refund of coins, and one refund per asset they were selling.
+    Each user's commands are deleted in the same savepoint as their refund. If the refund fails, the commands stay, out of the order books, and are refunded next turn.
+    '''
+    def refund_expired_commands(self, expired_commands : list[ExpiringCommand]):
+        commands_by_user : dict[int, list[ExpiringCommand]] = {}
+        for expired_command in expired_commands:
+            commands_by_user.setdefault(expired_command.user.id, []).append(expired_command)
+
+        for user_commands in commands_by_user.values():
+            user = user_commands[0].user
+            coin_refund = 0
+            share_refunds : dict[Asset, int] = {}
+            for expired_command in user_commands:
+                if (isinstance(expired_command, BuyCommand)):
+                    coin_refund += expired_command.max_price * expired_command.quantity
+                elif (isinstance(expired_command, SellCommand)):
+                    share_refunds[expired_command.asset] = share_refunds.get(expired_command.asset, 0) + expired_command.quantity
             try:
-                user : User = queued_message['user']
-                message : str = queued_message['message']
-                self.api.send_message(user.name, message)
+                with self.database.savepoint("refund"):
+                    self.commandQueue.delete_commands(user_commands)
+                    if (coin_refund != 0):
+                        #Return amount in escrow
+                        self.bank.transfer_from_escrow(user, coin_refund)
+                        self.log.add_log_message(self.CLASS_NAME, LogMessageType.EXPIRED, f"Refunding {coin_refund}", user = user)
+                    for asset, amount in share_refunds.items():
+                        #Return asset in escrow
+                        self.bank.transfer_asset_from_escrow(user, asset, amount)
+                        self.log.add_log_message(self.CLASS_NAME, LogMessageType.EXPIRED, f"Refunding {amount} {asset.name}", user = user)
+                    for expired_command in user_commands:
+                        if (isinstance(expired_command, BuyCommand)):
+                            self.messageManager.send_message_queued(user, expired_command, MessageType.INFO, "BUY operation expired. :marseylaugh:")
+                        else:
+                            self.messageManager.send_message_queued(user, expired_command, MessageType.INFO, "SELL operation expired. :marseylaugh:")
             except BaseException as e:
                 print(f"=====Exception occurred!=====")
-                print("While processing sending digest:")
-                pprint(queued_message)
+                print(f"While attempting to refund {user.name} for expired commands:")
                 print(f"We got: \"{e}\"")
                 print(traceback.format_exc())
-                self.log.add_log_message(self.CLASS_NAME, LogMessageType.EXCEPTION, str(traceback.format_exc()))
-        
-        #Increment time
-        current_time = self.database.get_current_time_id()
-        self.database.set_current_time_id(current_time+1)
-        self.database.commit()
-
-    def handle_transactions(self, commands: list[Command]):
-        sales = self.stockExchange.get_sales(commands, [Asset(1, "PUTIN"), Asset(2, "ANTIFA")])
+                self.log.add_log_message(self.CLASS_NAME, LogMessageType.EXCEPTION, f"Refund for {user_commands} will be retried next turn: {traceback.format_exc()}", user = user)
 
-        for asset, asset_sales in sales.items():
-            self.log.add_log_message(self.CLASS_NAME, LogMessageType.PROCESS, f"Processing {asset.name}...")
-            for completed_sale in asset_sales['completed_sales']:
-                try:
-                    if (asset_sales['buyers_market']):
-                        market_explanation = "Buyer's Market. Buyer pays seller's listed price."
-                    else:
-                        market_explanation = "Seller's Marker. Buyer pays buyer's max price."
-
-                    sale_price :int = completed_sale['sale_price']
-                    buy_offer : BuyCommand = completed_sale['buy_command']
-                    sell_offer : SellCommand = completed_sale['sell_command']
-                    buyer = buy_offer.user
-                    seller = sell_offer.user
-                    buyer_max_price = buy_offer.max_price
-
-                    self.log.add_log_message(self.CLASS_NAME, LogMessageType.COMPLETED_SALE, f"{seller.name} sold {buyer.name} a share of {asset.name} for {sale_price} in a {market_explanation} Sell Offer = {sell_offer}, Buy Offer = {buy_offer}")
-
-                    self.bank.sell_asset(buyer, seller, asset, sale_price, buyer_max_price)
-                    self.messageManager.send_message_queued(seller, sell_offer, MessageType.SUCCESS, f"Sold ${asset.name} for {sale_price}. ({market_explanation})")
-                    self.messageManager.send_message_queued(buyer, buy_offer, MessageType.SUCCESS, f"Bought ${asset.name} for {sale_price}. ({market_explanation})")
-                    self.commandQueue.delete_command(sell_offer)
-                    self.commandQueue.delete_command(buy_offer)
-                except AssertionError as assertionError:
-                    buy_offer : BuyCommand = completed_sale['buy_command']
-                    sell_offer : SellCommand = completed_sale['sell_command']
-                    buyer = buy_offer.user
-                    seller = sell_offer.user
-                    self.messageManager.send_message_queued(seller, sell_offer, MessageType.ERROR, f"Jewish tricks detected! The Jewish Trick was: {assertionError}. If you weren't the Jew, it was probably @{buyer.name}. ✡")
-                    self.messageManager.send_message_queued(buyer, buy_offer, MessageType.ERROR, f"Jewish tricks detected! The Jewish Trick was: {assertionError}. If you weren't the Jew, it was probably @{seller.name}. ✡")
-                    
-                    self.log.add_log_message(self.CLASS_NAME, LogMessageType.JEWRY, f"Jewish trick. buy offer = {buy_offer}, sell offer = {sell_offer}, buyer = {buyer.name}, seller = {seller.name}, exception = {assertionError}")
-                    print(f"WARNING: Jewish trick detected {assertionError}")
-                    self.database.rollback()
-                except BaseException as baseException:
-                    self.database.rollback()
-                    print(f"=====Exception occurred!=====")
-                    print("While processing this sale:")
-                    pprint(completed_sale)
-                    print(f"We got: \"{baseException}\"")
-                    print(traceback.format_exc())
-                    self.log.add_log_message(self.CLASS_NAME, LogMessageType.EXCEPTION, str(traceback.format_exc()))
+    '''
+    Settles the sales from a cleared market. Each asset's sales are settled together with Bank.settle_fills, and written in one batch when the tick commits.
+    If any of them fails, they are all undone and settled again one at a time, so only the ones that fail are dropped.
+    '''
+    def handle_transactions(self, sales : dict[Asset, MarketResult]):
+        with self.bank.cached_accounts():
+            for asset, asset_sales in sales.items():
+                self.log.add_log_message(self.CLASS_NAME, LogMessageType.PROCESS, f"Processing {asset.name}...")
+                if (asset_sales.buyers_market):
+                    market_explanation = "Buyer's Market. Buyer pays seller's listed price."
                 else:
-                    self.database.commit()
-
-            for outbidded_buy_command in asset_sales['failed_sales']['outbidded']:
-                self.messageManager.send_message_queued(outbidded_buy_command.user, outbidded_buy_command, MessageType.INFO, "You were outbidded. Consider increasing your max price.")
-                self.log.add_log_message(self.CLASS_NAME, LogMessageType.FAILED_SALE, f"OUTBIDDED - {outbidded_buy_command}", user = outbidded_buy_command.user)
-            for outpriced_sell_command in asset_sales['failed_sales']['outpriced']:
-                self.messageManager.send_message_queued(outpriced_sell_command.user, outpriced_sell_command, MessageType.INFO, "You were outpriced. Consider decreasing the listed price of the asset.")
-                self.log.add_log_message(self.CLASS_NAME, LogMessageType.FAILED_SALE, f"OUTPRICED - {outpriced_sell_command}", user = outpriced_sell_command.user)
-            for no_sellers_buy_command in asset_sales['failed_sales']['no_sellers']:
-                self.messageManager.send_message_queued(no_sellers_buy_command.user, no_sellers_buy_command, MessageType.INFO, "Dead market. It seems no-one is selling. Consider shilling about how the asset will crash soon.")
-                self.log.add_log_message(self.CLASS_NAME, LogMessageType.FAILED_SALE, f"DEAD MARKET - {no_sellers_buy_command}", user = no_sellers_buy_command.user)
-            for no_buyers_sell_command in asset_sales['failed_sales']['no_buyers']:
-                self.messageManager.send_message_queued(no_buyers_sell_command.user, no_buyers_sell_command, MessageType.INFO, "Dead market. It seems no-one is buying. Consider shilling about how the asset will go to the 🌛 soon.")
-                self.log.add_log_message(self.CLASS_NAME, LogMessageType.FAILED_SALE, f"DEAD MARKET - {no_buyers_sell_command}", user = no_buyers_sell_command.user)
-            for stingy_buy_command in asset_sales['failed_sales']['stingy']:
-                self.messageManager.send_message_queued(stingy_buy_command.user, stingy_buy_command, MessageType.WARNING, f"It was a buyer's market, and the price was still too high for you. Learn how the market works, retard.")
-                self.log.add_log_message(self.CLASS_NAME, LogMessageType.FAILED_SALE, f"STINGY - {stingy_buy_command}", user = stingy_buy_command.user)
+                    market_explanation = "Seller's Marker. Buyer pays buyer's max price."
+                try:
+                    with self.database.savepoint("sales"):
+                        self.bank.settle_fills(asset_sales.completed_sales)
+                        for completed_sale in asset_sales.completed_sales:
+                            self.record_sale(asset, completed_sale, market_explanation)
+                    completed_sales = []
+                except BaseException:
+                    #The sales that fail are reported below
+                    completed_sales = asset_sales.completed_sales
+                for completed_sale in completed_sales:
+                    try:
+                        #If the sale fails, only the sale is undone: in the database, in the account cache, in the command queue, and its messages. The rest of the tick carries on.
+                        with self.database.savepoint("sale"):
+                            self.settle_sale(asset, completed_sale, market_explanation)
+                    except AssertionError as assertionError:
+                        buy_offer : BuyCommand = completed_sale.buy_command
+                        sell_offer : SellCommand = completed_sale.sell_command
+                        buyer = buy_offer.user
+                        seller = sell_offer.user
+                        self.messageManager.send_message_queued(seller, sell_offer, MessageType.ERROR, f"Jewish tricks detected! The Jewish Trick was: {assertionError}. If you weren't the Jew, it was probably @{buyer.name}. ✡")
+                        self.messageManager.send_message_queued(buyer, buy_offer, MessageType.ERROR, f"Jewish tricks detected! The Jewish Trick was: {assertionError}. If you weren't the Jew, it was probably @{seller.name}. ✡")
+                        
+                        self.log.add_log_message(self.CLASS_NAME, LogMessageType.JEWRY, f"Jewish trick. buy offer = {buy_offer}, sell offer = {sell_offer}, buyer = {buyer.name}, seller = {seller.name}, exception = {assertionError}")
+                        print(f"WARNING: Jewish trick detected {assertionError}")
+                    except BaseException as baseException:
+                        print(f"=====Exception occurred!=====")
+                        print("While processing this sale:")
+                        pprint(completed_sale)
+                        print(f"We got: \"{baseException}\"")
+                        print(traceback.format_exc())
+                        self.log.add_log_message(self.CLASS_NAME, LogMessageType.EXCEPTION, str(traceback.format_exc()))
+
+                for outbidded_buy_command in asset_sales.failed_sales.outbidded:
+                    self.messageManager.send_message_queued(outbidded_buy_command.user, outbidded_buy_command, MessageType.INFO, "You were outbidded. Consider increasing your max price.")
+                    self.log.add_log_message(self.CLASS_NAME, LogMessageType.FAILED_SALE, f"OUTBIDDED - {outbidded_buy_command}", user = outbidded_buy_command.user)
+                for outpriced_sell_command in asset_sales.failed_sales.outpriced:
+                    self.messageManager.send_message_queued(outpriced_sell_command.user, outpriced_sell_command, MessageType.INFO, "You were outpriced. Consider decreasing the listed price of the asset.")
+                    self.log.add_log_message(self.CLASS_NAME, LogMessageType.FAILED_SALE, f"OUTPRICED - {outpriced_sell_command}", user = outpriced_sell_command.user)
+                for no_sellers_buy_command in asset_sales.failed_sales.no_sellers:
+                    self.messageManager.send_message_queued(no_sellers_buy_command.user, no_sellers_buy_command, MessageType.INFO, "Dead market. It seems no-one is selling. Consider shilling about how the asset will crash soon.")
+                    self.log.add_log_message(self.CLASS_NAME, LogMessageType.FAILED_SALE, f"DEAD MARKET - {no_sellers_buy_command}", user = no_sellers_buy_command.user)
+                for no_buyers_sell_command in asset_sales.failed_sales.no_buyers:
+                    self.messageManager.send_message_queued(no_buyers_sell_command.user, no_buyers_sell_command, MessageType.INFO, "Dead market. It seems no-one is buying. Consider shilling about how the asset will go to the 🌛 soon.")
+                    self.log.add_log_message(self.CLASS_NAME, LogMessageType.FAILED_SALE, f"DEAD MARKET - {no_buyers_sell_command}", user = no_buyers_sell_command.user)
+                for stingy_buy_command in asset_sales.failed_sales.stingy:
+                    self.messageManager.send_message_queued(stingy_buy_command.user, stingy_buy_command, MessageType.WARNING, f"It was a buyer's market, and the price was still too high for you. Learn how the market works, retard.")
+                    self.log.add_log_message(self.CLASS_NAME, LogMessageType.FAILED_SALE, f"STINGY - {stingy_buy_command}", user = stingy_buy_command.user)
+
+    '''
+    Settles a single sale (see StockExchange.get_sales for what it contains): moves the money and the shares, fills both commands, and lets both users know.
+    Both batch and continuous matching settle every sale here.
+    '''
+    def settle_sale(self, asset : Asset, completed_sale : Fill, market_explanation : str):
+        self.bank.settle_fill(completed_sale)
+        self.record_sale(asset, completed_sale, market_explanation)
+
+    '''
+    Everything about a sale except moving the money and the shares: logs and records the trade, fills both commands, and lets both users know.
+    '''
+    def record_sale(self, asset : Asset, completed_sale : Fill, market_explanation : str):
+        sale_price :int = completed_sale.sale_price
+        quantity : int = completed_sale.quantity
+        buy_offer : BuyCommand = completed_sale.buy_command
+        sell_offer : SellCommand = completed_sale.sell_command
+        buyer = buy_offer.user
+        seller = sell_offer.user
+
+        self.log.add_log_message(self.CLASS_NAME, LogMessageType.COMPLETED_SALE, f"{seller.name} sold {buyer.name} {quantity} share(s) of {asset.name} for {sale_price} each in a {market_explanation} Sell Offer = {sell_offer}, Buy Offer = {buy_offer}")
+
+        self.database.add_trade(asset, sale_price, quantity)
+        self.messageManager.send_message_queued(seller, sell_offer, MessageType.SUCCESS, f"Sold {quantity} share(s) of ${asset.name} for {sale_price} each. ({market_explanation})")
+        self.messageManager.send_message_queued(buyer, buy_offer, MessageType.SUCCESS, f"Bought {quantity} share(s) of ${asset.name} for {sale_price} each. ({market_explanation})")
+        self.commandQueue.fill_command(sell_offer, quantity)
+        self.commandQueue.fill_command(buy_offer, quantity)
 
+    '''
+    Matches a command that was just placed against the resting commands, for continuous matching. Returns what happened, for the reply.
+    '''
+    def match_incoming_command(self, command : ExpiringCommand) -> str:
+        to_return = ""
+        #A command that isn't in the book can't be filled, since filling it changes its place in the book
+        if (not self.commandQueue.is_in_book(command)):
+            return to_return
+        completed_sales = self.stockExchange.match_incoming(command, self.commandQueue.get_book(command.asset))
+        for completed_sale in completed_sales:
+            self.settle_sale(command.asset, completed_sale, "Continuous Market. Buyer pays the price of the command that was already listed.")
+            to_return += f" Immediately traded {completed_sale.quantity} share(s) for {completed_sale.sale_price} each."
+        return to_return
+
+    '''
+    Sets this turn's price of every asset to the average price it traded at, or keeps last turn's price if it didn't trade.
+    '''
+    def update_prices(self):
+        current_time = self.database.get_current_time_id()
+        for asset in self.all_assets:
             try:
-                if (not asset_sales['dead_market']):
-                    sale_prices = [i['sale_price'] for i in asset_sales['completed_sales']]
-                    self.priceTracker.set_price(asset, average(sale_prices))
-                else:
-                    self.priceTracker.maintain_price(asset)
+                with self.database.savepoint("price"):
+                    average_price = self.database.get_average_trade_price(current_time, asset)
+                    if (average_price is not None):
+                        self.priceTracker.set_price(asset, average_price)
+                    else:
+                        self.priceTracker.maintain_price(asset)
             except BaseException as e:
-                self.database.rollback()
                 print(f"=====Exception occurred!=====")
                 print(f"While setting the pricepoint for {asset.name}:")
-                pprint(asset_sales)
                 print(f"We got: \"{e}\"")
                 print(traceback.format_exc())
                 self.log.add_log_message(self.CLASS_NAME, LogMessageType.EXCEPTION, str(traceback.format_exc()))
-            else:
-                self.database.commit()
+
+    '''
+    Sends everyone the digest of their queued messages.
+    '''
+    def send_queued_messages(self):
+        for queued_message in self.messageManager.get_all_queued_messages():
+            try:
+                user : User = queued_message['user']
+                message : str = queued_message['message']
+                self.api.send_message(user.name, message)
+            except BaseException as e:
+                print(f"=====Exception occurred!=====")
+                print("While processing sending digest:")
+                pprint(queued_message)
+                print(f"We got: \"{e}\"")
+                print(traceback.format_exc())
+                self.log.add_log_message(self.CLASS_NAME, LogMessageType.EXCEPTION, str(traceback.format_exc()))
+        self.messageManager.clear_queued_messages()
 
     def ipo(self, stock_name : str, amount : int, asking_price : int):
         self.database.add_asset(stock_name.upper())
         hmse_user = User(0, "HMSE")
         self.database.add_or_update_user(hmse_user)
         asset = self.database.get_asset_with_name(stock_name.upper())
-        self.database.set_owned_assets_in_escrow(hmse_user, asset, amount)
-        for i in range(amount):
-            self.commandQueue.add_command(SellCommand(None, 100, hmse_user, asset, asking_price))
+        command = SellCommand(None, 100, hmse_user, asset, asking_price, amount)
+        self.commandQueue.add_command(command)
+        self.bank.issue_asset(hmse_user, asset, amount, command)
         self.database.commit()
 
 
-if (TEST):
-    endpoint = "localhost"
-    auth_token = TEST_AUTH_TOKEN
-    database_filename = "test_db.db"
-    log_filename = "test_log.db"
-else:
-    endpoint = "rdrama.net"
+#Pool workers started with spawn or forkserver import this file again, so the script must only run when it is the program itself.
+if __name__ == '__main__':
+    if (TEST):
+        endpoint = "localhost"
+        auth_token = TEST_AUTH_TOKEN
+        database_filename = "test_db.db"
+        log_filename = "test_log.db"
+    else:
+        endpoint = "rdrama.net"
     
-    with open((get_real_filename("token"))) as file:
-        auth_token = file.read()
-    database_filename = "hmse.db"
-    log_filename = "log.db"
-
-api = RDramaAPIInterface(auth_token, endpoint, TEST, 1.0)
-database = Database(database_filename)
-log = Log(log_filename, database)
-bank = Bank(database, log)
-parser = Parser()
-commandQueue = CommandQueue(database)
-
-hmse = HMSE(api, database, bank, parser, commandQueue, log)
-try:
-    if (sys.argv[1] == 'update'):
-        hmse.update()
-    elif (sys.argv[1] == 'process'):
-        hmse.process()
-    elif (sys.argv[1] == 'test'):
-        print(api.comment_reply_retriever(1550641))
-    elif (sys.argv[1] == 'ipo'):
-        stock_name = sys.argv[2]
-        amount = int(sys.argv[3])
-        asking_price = int(sys.argv[4])
-        hmse.ipo(stock_name, amount, asking_price)
-    elif (sys.argv[1] == 'superfix'):
-        all_notifications = api.get_parsed_notification(1) #Start from the beginning
-        processed_notifications = log.get_log_messages(LogMessageType.PROCESS_NOTIFICATION) #Get all notifications
-
-        processed_notification_ids = []
-        for i in processed_notifications:
-            try:
-                the_id = int(ast.literal_eval(i['message'].replace("'", '"'))['id'])
-                if the_id != 0:
-                    processed_notification_ids.append(the_id)
-            except:
-                print("Unprocessable: ")
-                pprint(i)
-        unprocessed_notifications = [i for i in all_notifications if int(i['id']) not in processed_notification_ids]
+        with open((get_real_filename("token"))) as file:
+            auth_token = file.read()
+        database_filename = "hmse.db"
+        log_filename = "log.db"
+
+    api = RDramaAPIInterface(auth_token, endpoint, TEST, 1.0)
+    database = Database(database_filename)
+    log = Log(log_filename, database)
+    bank = Bank(database, log)
+    parser = Parser()
+    commandQueue = CommandQueue(database)
+
+    hmse = HMSE(api, database, bank, parser, commandQueue, log, CLEARING_PROCESSES, CONTINUOUS_MATCHING)
+    try:
+        if (sys.argv[1] == 'update'):
+            hmse.update()
+        elif (sys.argv[1] == 'process'):
+            hmse.process()
+            database.checkpoint()
+            log.checkpoint()
+        elif (sys.argv[1] == 'reconcile'):
+            problems = bank.reconcile()
+            for problem in problems:
+                print(problem)
+            print(f"Found {len(problems)} problem(s).")
+        elif (sys.argv[1] == 'test'):
+            print(api.comment_reply_retriever(1550641))
+        elif (sys.argv[1] == 'ipo'):
+            stock_name = sys.argv[2]
+            amount = int(sys.argv[3])
+            asking_price = int(sys.argv[4])
+            hmse.ipo(stock_name, amount, asking_price)
+        elif (sys.argv[1] == 'superfix'):
+            all_notifications = api.get_parsed_notification(1) #Start from the beginning
+            hmse.import_logged_notifications()
+            processed_notification_ids = database.get_processed_notification_ids()
+            unprocessed_notifications = [i for i in all_notifications if int(i['id']) not in processed_notification_ids]
+
+            print(f"The unprocessed ids are: {[i['id'] for i in unprocessed_notifications]}")
+            print(f"The processed ids are: {sorted(processed_notification_ids)}")
+            print(f"There are {len(all_notifications)} total notifications. Of those, {len(unprocessed_notifications)} are unprocessed. Continue?")
+            should_cont = input("> ")
+            if (should_cont == "yes"):
+                for notification in unprocessed_notifications:
+                    print(f"Handling notification {notification['id']}")
+                    hmse.handle_notification(notification, special_message="This is part of a fix. So, basically the system got really gummed up so I had to throw together this last-minute fix. 😭 lmao. In my defense the API is really weird. No shade to the devs, I freaking love this site, but the API is wack yo. Anywho, remember that you can always do a withdrawal by calling @hmse withdraw. If that doesn't work, let HeyMoon know! Sorry about this, and may your profit margins be based and redpilled.")
 
-        print(f"The unprocessed ids are: {[i['id'] for i in unprocessed_notifications]}")
-        print(f"The processed ids are: {processed_notification_ids}")
-        print(f"There are {len(all_notifications)} total notifications. Of those, {len(unprocessed_notifications)} are unprocessed. Continue?")
-        should_cont = input("> ")
-        if (should_cont == "yes"):
-            for notification in unprocessed_notifications:
-                print(f"Handling notification {notification['id']}")
-                hmse.handle_notification(notification, special_message="This is part of a fix. So, basically the system got really gummed up so I had to throw together this last-minute fix. 😭 lmao. In my defense the API is really weird. No shade to the devs, I freaking love this site, but the API is wack yo. Anywho, remember that you can always do a withdrawal by calling @hmse withdraw. If that doesn't work, let HeyMoon know! Sorry about this, and may your profit margins be based and redpilled.")
-
-    else:
-        print("lol. lmao.")
-except BaseException as e:
-    print(f"=====Exception occurred!=====")
-    print(f"While performing the script actions, got this error: \"{e}\"")
-    print(traceback.format_exc())
-    log.add_log_message("NONE", LogMessageType.EXCEPTION, traceback.format_exc())
-finally:
-    database.close()
-    log.close()
\ No newline at end of file
+        else:
+            print("lol. lmao.")
+    except BaseException as e:
+        print(f"=====Exception occurred!=====")
+        print(f"While performing the script actions, got this error: \"{e}\"")
+        print(traceback.format_exc())
+        log.add_log_message("NONE", LogMessageType.EXCEPTION, traceback.format_exc())
+    finally:
+        database.close()
+        log.close()
\ No newline at end of file
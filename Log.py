@@ -1,73 +1,52 @@
-import sqlite3
+import atexit
 from Database import Database
 from User import User
 from os.path import exists
 from os.path import exists, join, realpath
 
-from Util import get_real_filename
+from SQLiteDatabase import SQLiteDatabase, TransactionListener
+
+#How many messages are held in memory before they are written anyway
+LOG_BUFFER_SIZE = 1000
+
+#Changes to the schema, oldest first. See Util.migrate. Only ever add to the end.
+#Anything added to setup_logging_database.sql needs a migration too, or databases that are already set up won't get it.
+MIGRATIONS = [
+    #1: Indexes for looking up messages by type and by user.
+    [
+        "CREATE INDEX IF NOT EXISTS log_by_message_type ON log (message_type, time_id)",
+        "CREATE INDEX IF NOT EXISTS log_by_user ON log (user_id)"
+    ]
+]
 
 '''
-Writes messages to the log
+Writes messages to the log.
+Messages are held in memory, and written in one batch whenever the main database commits or rolls back, when there are LOG_BUFFER_SIZE of them, or when the program exits.
 '''
-class Log:
+class Log(SQLiteDatabase):
     def __init__(self, filename : str, database : Database) -> None:
+        super().__init__(filename, "setup_logging_database.sql", MIGRATIONS)
         self.database = database
-        self._con = sqlite3.connect(get_real_filename(filename), timeout=120)
-        with open(get_real_filename("setup_logging_database.sql")) as sql_file:
-            self._con.executescript(sql_file.read())
-        
+        self._buffer : list[tuple[int, int, str, str, str]] = []
+        self._flusher = LogFlusher(self)
+        self.database.add_transaction_listener(self._flusher)
+        #Even if the program dies with an exception, what was logged is kept
+        atexit.register(self.commit)
+
     def commit(self):
-        self.con.commit()
+        self._write_buffer()
+        super().commit()
 
     def close(self):
         self.commit()
-        self.con.close()
-
-    def rollback(self):
-        self.con.rollback()
-    
-    @property
-    def con(self) -> sqlite3.Connection:
-        return self._con
-
-    @property
-    def cursor(self) -> sqlite3.Cursor:
-        return self.con.cursor()
-    
-
-    def unpack_nested_tuple(self, my_tuple):
-        if (len(my_tuple) != 1 or type(my_tuple[0]) is not tuple):
-            return (my_tuple)
-        else:
-            return self.unpack_nested_tuple(my_tuple[0])
-
-    def run_command(self, command, *args):
-        return self.cursor.execute(command, self.unpack_nested_tuple(args))
-    
-    def get_rows(self, command, *args):
-        return self.run_command(command, args).fetchall()
-    
-    def get_only_row(self, command, *args):
-        to_return = self.run_command(command, args).fetchone()
-        return to_return
-    
-    def get_only_cell(self, command, *args):
-        row = self.get_only_row(command, args)
-        if (row is None):
-            return None
-        assert (len(row) == 1)
-        return row[0]
-
-
-    def add_log_message(self, the_class : str, message_type : str, message : str, user : User = None):
-        try:
-            user_id = user.id if user is not None else 0
-        except:
-            user_id = 0
-            message+="(User id getting failed...)"
-        time_id = self.database.get_current_time_id()
+        atexit.unregister(self.commit)
+        self.database.remove_transaction_listener(self._flusher)
+        super().close()
 
-        self.run_command('''INSERT INTO log
+    def _write_buffer(self):
+        if (len(self._buffer) == 0):
+            return
+        self.cursor.executemany('''INSERT INTO log
             (
                 user_id,
                 time_id,
@@ -81,9 +60,23 @@ class Log:
                 ?,
                 ?,
                 ?
-            )''', user_id, time_id, the_class, message_type, message)
+            )''', self._buffer)
+        self._buffer = []
+
+    def add_log_message(self, the_class : str, message_type : str, message : str, user : User = None):
+        try:
+            user_id = user.id if user is not None else 0
+        except:
+            user_id = 0
+            message+="(User id getting failed...)"
+        time_id = self.database.get_current_time_id()
+
+        self._buffer.append((user_id, time_id, the_class, message_type, message))
+        if (len(self._buffer) >= LOG_BUFFER_SIZE):
+            self._write_buffer()
 
     def get_log_messages(self, type : str):
+        self._write_buffer()
         rows = self.get_rows('''
             SELECT
                     user_id,
@@ -110,6 +103,20 @@ class Log:
             )
         return to_return
 
+'''
+Commits the log whenever the main database commits or rolls back, so the log is written at the same points the data it describes is.
+'''
+class LogFlusher(TransactionListener):
+    def __init__(self, log : Log) -> None:
+        self.log = log
+
+    def before_commit(self):
+        self.log.commit()
+
+    def after_rollback(self):
+        #Messages about what was rolled back, exceptions especially, are still worth keeping.
+        self.log.commit()
+
 class LogMessageType:
     EXCEPTION = "EXCEPTION"
     UPDATE = "UPDATE"
@@ -0,0 +1,62 @@
+from dataclasses import dataclass, field
+
+from Command import BuyCommand, SellCommand
+
+'''
+A sale that took place: quantity shares changed hands, for sale_price each.
+A command can be partially filled, so it can show up in several fills.
+'''
+@dataclass(slots=True)
+class Fill:
+    buy_command : BuyCommand
+    sell_command : SellCommand
+    sale_price : int
+    quantity : int
+
+    '''
+    The seller's listed price.
+    '''
+    @property
+    def price(self) -> int:
+        return self.sell_command.price
+
+    '''
+    The maximum the buyer was willing to pay.
+    '''
+    @property
+    def max_price(self) -> int:
+        return self.buy_command.max_price
+
+'''
+The commands that didn't (completely) go through, for various reasons. A partially filled command shows up here too, for its unfilled shares.
+ - outbidded: The buyer's maximum price was too low in a seller's market.
+ - outpriced: The seller's price was too high in a buyer's market.
+ - no_buyers: no one is willing to buy the asset.
+ - no_sellers: no one is willing to sell the asset.
+ - stingy: Buyer's maximum price was too low in a buyer's market.
+'''
+@dataclass(slots=True)
+class FailureBuckets:
+    outbidded : list[BuyCommand] = field(default_factory=list)
+    outpriced : list[SellCommand] = field(default_factory=list)
+    no_buyers : list[SellCommand] = field(default_factory=list)
+    no_sellers : list[BuyCommand] = field(default_factory=list)
+    stingy : list[BuyCommand] = field(default_factory=list)
+
+'''
+How the market for one asset clears.
+ - buy_offers: All attempts to buy the asset.
+ - sell_offers: All attempts to sell the asset.
+ - completed_sales: The sales that actually took place.
+ - dead_market: Whether or not the market is dead, ie, no one is buying or no one is selling.
+ - buyers_market: Whether or not it is a buyer's market, ie, more shares are being sold than bought.
+ - failed_sales: The commands that didn't go through.
+'''
+@dataclass(slots=True)
+class MarketResult:
+    buy_offers : list[BuyCommand]
+    sell_offers : list[SellCommand]
+    completed_sales : list[Fill] = field(default_factory=list)
+    dead_market : bool = False
+    buyers_market : bool = False
+    failed_sales : FailureBuckets = field(default_factory=FailureBuckets)
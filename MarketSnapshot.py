@@ -0,0 +1,55 @@
+from concurrent.futures import Executor
+
+from Asset import Asset
+from CommandQueue import CommandQueue
+from MarketResult import MarketResult
+from OrderBook import OrderBook
+from StockExchange import StockExchange
+
+'''
+How the market clears right now. Each asset is cleared once and shared by everything that needs it, until that asset's order book changes.
+'''
+class MarketSnapshot:
+    def __init__(self, stockExchange : StockExchange, commandQueue : CommandQueue, all_assets : list[Asset]) -> None:
+        self.stockExchange = stockExchange
+        self.commandQueue = commandQueue
+        self.all_assets = all_assets
+        #For each asset, the book and book version it was cleared from, and the result.
+        self._asset_sales : dict[Asset, tuple[OrderBook, int, MarketResult]] = {}
+
+    '''
+    Returns the result of clearing the command queue's order books (see StockExchange.get_sales), for the given assets or for every asset.
+    Only assets whose book changed since the last call are cleared again. If a pool is given, those are cleared in parallel.
+    '''
+    def get_sales(self, assets : list[Asset] = None, pool : Executor = None) -> dict[Asset, MarketResult]:
+        books = self.commandQueue.get_books()
+        if (assets is None):
+            assets = list(books) + [asset for asset in self.all_assets if asset not in books]
+
+        if (pool is not None):
+            stale_assets = [asset for asset in assets if self._get_cached_sales(asset) is None]
+            cleared = self.stockExchange.get_sales_for_assets_parallel(books, stale_assets, pool)
+            for asset, sales in cleared.items():
+                self._cache_sales(asset, sales)
+
+        return {asset : self.get_asset_sales(asset) for asset in assets}
+
+    def get_asset_sales(self, asset : Asset) -> MarketResult:
+        sales = self._get_cached_sales(asset)
+        if (sales is None):
+            sales = self.stockExchange.clear_book(self.commandQueue.get_book(asset))
+            self._cache_sales(asset, sales)
+        return sales
+
+    def _get_cached_sales(self, asset : Asset) -> MarketResult:
+        if (asset not in self._asset_sales):
+            return None
+        cleared_book, cleared_version, sales = self._asset_sales[asset]
+        book = self.commandQueue.get_book(asset)
+        if (cleared_book is not book or cleared_version != book.version):
+            return None
+        return sales
+
+    def _cache_sales(self, asset : Asset, sales : MarketResult):
+        book = self.commandQueue.get_book(asset)
+        self._asset_sales[asset] = (book, book.version, sales)
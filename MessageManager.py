@@ -1,24 +1,53 @@
 from Command import Command
 from Randsey import Randsey
+from SQLiteDatabase import TransactionListener
 from User import User
 
 '''
 Allows for sending multiple messages at once, in a nice, orderly manner
+Messages are about what happened in the database, so they follow its transactions: a message only joins the queue once the database commits, and is thrown away if what it is about is rolled back.
+Register it with Database.add_transaction_listener.
 '''
-class MessageManager:
+class MessageManager(TransactionListener):
     def __init__(self, randsey : Randsey) -> None:
         self.unsent_messages = {}
         self.randsey = randsey
+        #Messages queued since the last commit, oldest first
+        self._uncommitted_messages : list[dict] = []
+        #How many uncommitted messages there were when each open savepoint started
+        self._marks : list[int] = []
     
     def send_message_queued(self, user: User, command : Command, message_type : int, message : str):
-        if (user.id not in self.unsent_messages):
-            self.unsent_messages[user.id] = []
-        self.unsent_messages[user.id].append({
+        self._uncommitted_messages.append({
             'user': user,
             'command': command,
             'message_type': message_type,
             'message': message
         })
+
+    def before_commit(self):
+        for message in self._uncommitted_messages:
+            user_id = message['user'].id
+            if (user_id not in self.unsent_messages):
+                self.unsent_messages[user_id] = []
+            self.unsent_messages[user_id].append(message)
+        self._uncommitted_messages = []
+        self._marks = []
+
+    def after_rollback(self):
+        self._uncommitted_messages = []
+        self._marks = []
+
+    def savepoint_started(self):
+        self._marks.append(len(self._uncommitted_messages))
+
+    def savepoint_released(self):
+        if (len(self._marks) != 0):
+            self._marks.pop()
+
+    def savepoint_rolled_back(self):
+        if (len(self._marks) != 0):
+            del self._uncommitted_messages[self._marks.pop():]
     
     def get_all_queued_messages(self):
         to_return = []
@@ -39,6 +68,9 @@ class MessageManager:
             })
         return to_return
 
+    def clear_queued_messages(self):
+        self.unsent_messages = {}
+
     def collapse_messages(self, messages : list[dict]):
         collapsed_messages = []
         for message in messages:
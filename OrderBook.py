@@ -0,0 +1,158 @@
+from bisect import bisect_left, insort
+from collections import deque
+from dataclasses import dataclass
+from itertools import islice
+from typing import Iterator
+
+from Asset import Asset
+from Command import BuyCommand, ExpiringCommand, SellCommand
+
+'''
+The resting commands at one price, on one side of an order book.
+'''
+@dataclass(slots=True)
+class PriceLevel:
+    price : int
+    quantity : int #Unfilled shares, summed over the commands
+    count : int #Number of commands
+
+'''
+One side (the bids or the asks) of an order book.
+Commands are grouped into price levels. Each level is a queue, so commands with the same price keep the order they were placed in.
+'''
+class OrderBookSide:
+    def __init__(self, highest_first : bool) -> None:
+        self.highest_first = highest_first
+        self._levels : dict[int, deque[ExpiringCommand]] = {}
+        self._prices : list[int] = [] #Ascending, regardless of highest_first
+        self._level_quantities : dict[int, int] = {}
+        self.count = 0
+        self.quantity = 0
+
+    def add(self, price : int, command : ExpiringCommand):
+        if (price not in self._levels):
+            self._levels[price] = deque()
+            self._level_quantities[price] = 0
+            insort(self._prices, price)
+        self._levels[price].append(command)
+        self._level_quantities[price] += command.quantity
+        self.count += 1
+        self.quantity += command.quantity
+
+    def remove(self, price : int, command : ExpiringCommand):
+        level = self._levels[price]
+        level.remove(command)
+        self._level_quantities[price] -= command.quantity
+        if (len(level) == 0):
+            del self._levels[price]
+            del self._level_quantities[price]
+            del self._prices[bisect_left(self._prices, price)]
+        self.count -= 1
+        self.quantity -= command.quantity
+
+    '''
+    Called when a command in this side changes how many shares it has left.
+    '''
+    def change_quantity(self, price : int, difference : int):
+        self._level_quantities[price] += difference
+        self.quantity += difference
+
+    '''
+    Gets the command at the front of the book, or None if the book is empty.
+    '''
+    def best(self) -> ExpiringCommand:
+        if (len(self._prices) == 0):
+            return None
+        best_price = self._prices[-1] if self.highest_first else self._prices[0]
+        return self._levels[best_price][0]
+
+    def get_prices(self) -> list[int]:
+        return self._prices[::-1] if self.highest_first else list(self._prices)
+
+    '''
+    The price levels, best price first. If levels is given, only that many are returned.
+    The totals are kept up to date as commands come and go, so this only costs O(levels returned).
+    '''
+    def get_depth(self, levels : int = None) -> list[PriceLevel]:
+        prices = reversed(self._prices) if self.highest_first else iter(self._prices)
+        return [PriceLevel(price, self._level_quantities[price], len(self._levels[price])) for price in islice(prices, levels)]
+
+    '''
+    Iterates over the commands, best price first.
+    '''
+    def __iter__(self) -> Iterator[ExpiringCommand]:
+        for price in (reversed(self._prices) if self.highest_first else self._prices):
+            yield from self._levels[price]
+
+    def __len__(self) -> int:
+        return self.count
+
+'''
+All of the resting BUY and SELL commands for an asset, kept sorted as commands are added and removed.
+'''
+class OrderBook:
+    def __init__(self, asset : Asset) -> None:
+        self.asset = asset
+        self.bids = OrderBookSide(highest_first=True)
+        self.asks = OrderBookSide(highest_first=False)
+        #Bumped every time the book changes, so anything derived from it knows when it is stale.
+        self.version = 0
+
+    def add(self, command : ExpiringCommand):
+        if (isinstance(command, BuyCommand)):
+            self.bids.add(command.max_price, command)
+        elif (isinstance(command, SellCommand)):
+            self.asks.add(command.price, command)
+        self.version += 1
+
+    def remove(self, command : ExpiringCommand):
+        if (isinstance(command, BuyCommand)):
+            self.bids.remove(command.max_price, command)
+        elif (isinstance(command, SellCommand)):
+            self.asks.remove(command.price, command)
+        self.version += 1
+
+    def change_quantity(self, command : ExpiringCommand, difference : int):
+        if (isinstance(command, BuyCommand)):
+            self.bids.change_quantity(command.max_price, difference)
+        elif (isinstance(command, SellCommand)):
+            self.asks.change_quantity(command.price, difference)
+        self.version += 1
+
+    @property
+    def best_bid(self) -> BuyCommand:
+        return self.bids.best()
+
+    @property
+    def best_ask(self) -> SellCommand:
+        return self.asks.best()
+
+    '''
+    All BUY commands, highest max price first.
+    '''
+    def get_bids(self) -> list[BuyCommand]:
+        return list(self.bids)
+
+    '''
+    All SELL commands, lowest price first.
+    '''
+    def get_asks(self) -> list[SellCommand]:
+        return list(self.asks)
+
+    '''
+    The bid and ask price levels (see OrderBookSide.get_depth), best prices first.
+    '''
+    def get_depth(self, levels : int = None) -> tuple[list[PriceLevel], list[PriceLevel]]:
+        return self.bids.get_depth(levels), self.asks.get_depth(levels)
+
+    '''
+    Whether more shares are being sold than bought.
+    '''
+    def is_buyers_market(self) -> bool:
+        return self.asks.quantity > self.bids.quantity
+
+    '''
+    Whether the best bid is at or above the best ask, so some shares could trade right now.
+    '''
+    def is_crossed(self) -> bool:
+        return self.best_bid is not None and self.best_ask is not None and self.best_bid.max_price >= self.best_ask.price
@@ -41,7 +41,8 @@ class Parser:
                 to_return['asset'] = parameters[2]            
             elif (command_name.upper() == "MARKET"):
                 to_return['type'] = 'MARKET'
-                to_return['asset'] = parameters[2]            
+                to_return['asset'] = parameters[2]
+                to_return['depth'] = named_parameters['DEPTH'] if 'DEPTH' in named_parameters else 5
             elif (command_name.upper() == "BALANCE"):
                 to_return['type'] = "BALANCE"
             elif (command_name.upper() == "WITHDRAW"):
@@ -0,0 +1,44 @@
+from dataclasses import dataclass, field
+
+from Asset import Asset
+
+'''
+How many shares of an asset a user has, and what the asset last traded at (None if it never has).
+'''
+@dataclass(slots=True)
+class Holding:
+    asset : Asset
+    available : int
+    in_escrow : int
+    price : int = None
+
+    @property
+    def total(self) -> int:
+        return self.available + self.in_escrow
+
+    '''
+    What the shares are worth at the latest price. Shares that have never traded are worth nothing.
+    '''
+    @property
+    def value(self) -> int:
+        return self.total * self.price if self.price is not None else 0
+
+'''
+Everything a user has: their coins, and every asset they have at least one share of, in asset order.
+'''
+@dataclass(slots=True)
+class Portfolio:
+    balance : int = 0
+    balance_in_escrow : int = 0
+    holdings : list[Holding] = field(default_factory=list)
+
+    @property
+    def total_balance(self) -> int:
+        return self.balance + self.balance_in_escrow
+
+    '''
+    Coins plus the value of every holding at its latest price.
+    '''
+    @property
+    def value(self) -> int:
+        return self.total_balance + sum(holding.value for holding in self.holdings)
@@ -0,0 +1,150 @@
+import sqlite3
+from contextlib import contextmanager
+
+from Util import get_real_filename, set_up_schema
+
+#Comfortably more than the number of distinct queries we run, so every query is only ever compiled once per connection.
+STATEMENT_CACHE_SIZE = 256
+
+#Set on every connection, before anything else happens on it.
+# - WAL lets BALANCE, MARKET and friends read while process() is writing, instead of waiting for it to finish.
+# - In WAL mode, synchronous = NORMAL only syncs at checkpoints. A power cut can lose the last few commits, but can't corrupt the database.
+# - The rest keeps hot pages in memory: 256MB memory mapped, 16MB of page cache, and temporary tables in memory.
+# - journal_size_limit stops the WAL file from staying huge after a big tick.
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -16384",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA journal_size_limit = 67108864"
+]
+
+'''
+Something that keeps its own copy of data in the database, and so has to know when the database commits or rolls back.
+Register it with SQLiteDatabase.add_transaction_listener.
+'''
+class TransactionListener:
+    '''
+    Called just before every commit, to write anything that is only held in memory.
+    '''
+    def before_commit(self):
+        pass
+
+    def after_rollback(self):
+        pass
+
+    def savepoint_started(self):
+        pass
+
+    def savepoint_released(self):
+        pass
+
+    def savepoint_rolled_back(self):
+        pass
+
+'''
+A connection to an SQLite database, and the helpers for querying it. Database and Log are built on this.
+There is a single cursor per connection, which every query reuses. Parameters are passed straight to sqlite3, so pass them as separate arguments, never as a tuple.
+'''
+class SQLiteDatabase:
+    def __init__(self, filename : str, script_filename : str, migrations : list) -> None:
+        self._con = sqlite3.connect(get_real_filename(filename), timeout=120, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in CONNECTION_PRAGMAS:
+            self._con.execute(pragma)
+        set_up_schema(self._con, script_filename, migrations)
+        self._cursor = self._con.cursor()
+        self._transaction_listeners : list[TransactionListener] = []
+
+    def commit(self):
+        for listener in self._transaction_listeners:
+            listener.before_commit()
+        self.con.commit()
+
+    def rollback(self):
+        self.con.rollback()
+        for listener in self._transaction_listeners:
+            listener.after_rollback()
+
+    def add_transaction_listener(self, listener : TransactionListener):
+        self._transaction_listeners.append(listener)
+
+    def remove_transaction_listener(self, listener : TransactionListener):
+        self._transaction_listeners.remove(listener)
+
+    def close(self):
+        self.con.close()
+
+    '''
+    Runs the block inside a SAVEPOINT of the current transaction, starting a transaction if there isn't one.
+    If the block raises, only what it did is rolled back, and the exception carries on. Either way, the outer transaction stays open until commit or rollback.
+    '''
+    @contextmanager
+    def savepoint(self, name : str = "block"):
+        if (not self.con.in_transaction):
+            #Otherwise, releasing the savepoint would commit.
+            self.run_command("BEGIN")
+        self.run_command(f"SAVEPOINT {name}")
+        for listener in self._transaction_listeners:
+            listener.savepoint_started()
+        try:
+            yield
+        except BaseException:
+            self.run_command(f"ROLLBACK TO {name}")
+            self.run_command(f"RELEASE {name}")
+            for listener in self._transaction_listeners:
+                listener.savepoint_rolled_back()
+            raise
+        else:
+            self.run_command(f"RELEASE {name}")
+            for listener in self._transaction_listeners:
+                listener.savepoint_released()
+
+    '''
+    Starts a transaction that takes the write lock straight away, so nothing else can write until it is committed or rolled back.
+    '''
+    def begin_immediate(self):
+        if (not self.con.in_transaction):
+            self.run_command("BEGIN IMMEDIATE")
+
+    '''
+    Commits, then copies everything in the WAL file into the database and empties it.
+    SQLite already checkpoints as the WAL file grows, so this is only needed after a lot of writing, like at the end of process(), so the next readers start from a small WAL file.
+    '''
+    def checkpoint(self):
+        self.commit()
+        self.con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    @property
+    def con(self) -> sqlite3.Connection:
+        return self._con
+
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        return self._cursor
+
+    '''
+    Runs the command on the shared cursor. The cursor is returned, so its results are only valid until the next query.
+    '''
+    def run_command(self, command : str, *args) -> sqlite3.Cursor:
+        return self._cursor.execute(command, args)
+
+    def get_rows(self, command : str, *args) -> list[tuple]:
+        return self._cursor.execute(command, args).fetchall()
+
+    def get_only_row(self, command : str, *args) -> tuple:
+        return self._cursor.execute(command, args).fetchone()
+
+    def get_only_cell(self, command : str, *args):
+        row = self._cursor.execute(command, args).fetchone()
+        if (row is None):
+            return None
+        assert (len(row) == 1)
+        return row[0]
+
+    def get_only_cell_or_zero(self, command : str, *args):
+        result = self.get_only_cell(command, *args)
+        if (result is None):
+            return 0
+        else:
+            return result
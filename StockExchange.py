@@ -1,138 +1,288 @@
-import copy
-from typing import Callable
+from concurrent.futures import Executor
+from operator import attrgetter
+
+import numpy as np
 
 from Asset import Asset
-from Command import BuyCommand, Command, SellCommand
+from Command import BuyCommand, Command, ExpiringCommand, SellCommand
+from MarketResult import Fill, MarketResult
+from OrderBook import OrderBook
+
+#Books with at least this many orders are matched with NumPy instead of a Python loop.
+VECTORIZED_MATCHING_THRESHOLD = 2000
 
 class StockExchange:
     '''
     Gets how the next market will happen, given the list of commands.
 
-    For each asset given in all_assets, there will be an entry in the returned dictionary. The asset can be used as a key to access the information.
-     - sell_offers: All attempts to buy the asset.
-     - buy_offers: All attempts to sell the asset
-     - completed sales: A list of dictionaries, representing what sales actually took place:
-        - sell_command: The command that is selling the asset.
-        - buy_command: The command that is buying the asset
-        - sale_price: How much it sold for
-        - price: The seller's listed price
-        - max_price: The maximum the seller was willing to pay.
-     - dead_market: Whether or not the market is dead, ie, no sales took place.
-     - buyers_market: Whether or not it is a buyer's market
-     - failed_sales: A dictionary containing lists of failed sales, for various reasons:
-        - outbidded: The buyer's maximum price was too low in a seller's market.
-        - outpriced: The seller's price was too high in a buyer's market.
-        - no_buyers: no one is willing to buy the asset.
-        - no_sellers: no one is willing to sell the asset.
-        - stingy: Buyer's maximum price was too low in a buyer's market.
-    '''
-    def get_sales(self, commands : list[Command], all_assets : list[Asset]) -> dict[Asset, dict]:
-        selling_assets : dict[Asset, list[SellCommand]] = StockExchange._create_sell_command_groups(commands)
-        buying_assets : dict[Asset, list[BuyCommand]] = StockExchange._create_buy_command_groups(commands)
+    For each asset given in all_assets, there will be a MarketResult in the returned dictionary. The asset can be used as a key to access it.
+    See MarketResult for what it contains.
+
+    Each asset is sorted once and then matched in a single pass, so clearing is O(n log n) in the number of orders.
+    If the commands are already in order books, use get_sales_from_books, which skips the sorting.
+    '''
+    def get_sales(self, commands : list[Command], all_assets : list[Asset]) -> dict[Asset, MarketResult]:
+        buying_assets, selling_assets = StockExchange._group_commands(commands)
         
         to_return = {}
 
         for asset, buy_offers in buying_assets.items():
-            to_return[asset] = {}
-            to_return[asset]['sell_offers'] = []
-            to_return[asset]['buy_offers'] = buy_offers
-            to_return[asset]['completed_sales'] = []
-            to_return[asset]['dead_market'] = False
-            to_return[asset]['buyers_market'] = False
-            to_return[asset]['failed_sales'] = {}
-            to_return[asset]['failed_sales']['outbidded'] = []
-            to_return[asset]['failed_sales']['no_sellers'] = []
-            to_return[asset]['failed_sales']['no_buyers'] = []
-            to_return[asset]['failed_sales']['stingy'] = []
-            to_return[asset]['failed_sales']['outpriced'] = []
-            if (asset in selling_assets):
-                to_return[asset]['dead_market'] = False
-                sell_offers = selling_assets[asset]
-                to_return[asset]['sell_offers'] = copy.copy(sell_offers)
-                sell_offers.sort(key = lambda a : a.price)
-                buy_offers.sort(key = lambda a : a.max_price, reverse=True)
-
-                buyers_market : bool
-                if (len(sell_offers) > len(buy_offers)):
-                    buyers_market = True
-                else:
-                    buyers_market = False
-                to_return[asset]['buyers_market'] = buyers_market
-
-                for buy_offer in buy_offers:
-
-                    #Get the cheapest asset in the list
-                    if (len(sell_offers) > 0):
-                        sell_offer = sell_offers[0]
-                    else:
-                        # If there are no more assets to buy, buyer was outbidded
-                        assert not buyers_market
-                        to_return[asset]['failed_sales']['outbidded'].append(buy_offer)
-                        continue
-                    
-                    #Establish sale price. If a buyer's market, we use the seller's min price. If a seller's market, we use buyer's max price.
-                    sale_price: int
-                    if (buyers_market):
-                        sale_price = sell_offer.price
-                        if (sale_price > buy_offer.max_price):
-                            #weird scenario where it's a buyer's market but the price is too low.
-                            to_return[asset]['failed_sales']['stingy'].append(buy_offer)
-                            continue
-                    else:
-                        sale_price = buy_offer.max_price
-
-                    #Can buy
-                    to_return[asset]['completed_sales'].append({
-                        'sell_command' : sell_offer,
-                        'buy_command' : buy_offer,
-                        'sale_price' : sale_price,
-                        'price': sell_offer.price,
-                        'max_price': buy_offer.max_price
-                    })
-
-                    #Remove the seller from the remaining sellers.
-                    sell_offers.pop(0)
-                
-                #If there are any sales left over, those were outpriced - ie, their prices weren't competitive enough for the few buyers on the market.
-                if (len(sell_offers) > 0):
-                    to_return[asset]['failed_sales']['outpriced'] = sell_offers
-            else:
-                #Dead seller's market
-                to_return[asset]['dead_market'] = True
-                to_return[asset]['buyers_market'] = False
-                to_return[asset]['failed_sales']['no_sellers'] = buy_offers
+            to_return[asset] = self.clear_asset(buy_offers, selling_assets.get(asset, []))
 
         for asset in all_assets:
             if (asset not in to_return):
-                #Dead buyer's market
-                to_return[asset] = {}
-                to_return[asset]['buy_offers'] = []
-                to_return[asset]['dead_market'] = True
-                to_return[asset]['buyers_market'] = True
-                to_return[asset]['failed_sales'] = {}
-                to_return[asset]['completed_sales'] = []
-                to_return[asset]['failed_sales']['outbidded'] = []
-                to_return[asset]['failed_sales']['no_sellers'] = []
-                to_return[asset]['failed_sales']['stingy'] = []
-                to_return[asset]['failed_sales']['outpriced'] = []
-                to_return[asset]['failed_sales']['no_buyers'] = selling_assets[asset] if asset in selling_assets else []
-                to_return[asset]['sell_offers'] = selling_assets[asset] if asset in selling_assets else []
+                to_return[asset] = self.clear_asset([], selling_assets.get(asset, []))
         
         return to_return
 
-    def _group_objects(objects_to_group: list[object], is_object_valid : Callable[[object], bool], get_grouping_key: Callable[[object], object]) -> dict[object, list[object]]:
-        objects : list[object] = list(filter(lambda a : is_object_valid(a), objects_to_group))
-        to_return : dict[object, list[object]] = {}
+    '''
+    Same as get_sales, but reads the commands from live order books, which are already sorted.
+    '''
+    def get_sales_from_books(self, books : dict[Asset, OrderBook], all_assets : list[Asset]) -> dict[Asset, MarketResult]:
+        assets = list(books) + [asset for asset in all_assets if asset not in books]
+        return self.get_sales_for_assets(books, assets)
+
+    '''
+    Clears only the given assets, leaving every other book alone. Costs O(orders in those assets), not O(all orders).
+    '''
+    def get_sales_for_assets(self, books : dict[Asset, OrderBook], assets : list[Asset]) -> dict[Asset, MarketResult]:
+        to_return = {}
+
+        for asset in assets:
+            if (asset in books):
+                to_return[asset] = self.clear_book(books[asset])
+            else:
+                to_return[asset] = self.clear_asset([], [])
 
-        for an_object in objects:
-            if (an_object.asset not in to_return):
-                to_return[an_object.asset] = []
-            to_return[an_object.asset].append(an_object)
-        
         return to_return
 
-    def _create_sell_command_groups(commands : list[Command]) -> dict[Asset, list[SellCommand]]:
-        return StockExchange._group_objects(commands, lambda a : isinstance(a, SellCommand), lambda a : a.asset)
-    
-    def _create_buy_command_groups(commands : list[Command]) -> dict[Asset, list[BuyCommand]]:
-        return StockExchange._group_objects(commands, lambda a : isinstance(a, BuyCommand), lambda a : a.asset)
\ No newline at end of file
+    '''
+    Same as get_sales_for_assets, but every asset that has both buyers and sellers is matched in the pool, so assets are matched in parallel.
+    Only prices and quantities are sent to the pool, and results are put back together in the order of assets, so the outcome is the same as get_sales_for_assets.
+    '''
+    def get_sales_for_assets_parallel(self, books : dict[Asset, OrderBook], assets : list[Asset], pool : Executor) -> dict[Asset, MarketResult]:
+        to_return = {}
+        jobs : list[tuple[Asset, list[BuyCommand], list[SellCommand], bool]] = []
+
+        for asset in assets:
+            book = books.get(asset)
+            if (book is None):
+                to_return[asset] = self.clear_asset([], [])
+            elif (book.bids.count == 0 or book.asks.count == 0):
+                to_return[asset] = self.clear_book(book)
+            else:
+                jobs.append((asset, book.get_bids(), book.get_asks(), book.is_buyers_market()))
+
+        arguments = [(*StockExchange._get_prices_and_quantities(bids, asks), buyers_market) for _, bids, asks, buyers_market in jobs]
+        for (asset, bids, asks, buyers_market), matches in zip(jobs, pool.map(_match_prices_job, arguments)):
+            to_return[asset] = StockExchange._create_matched_result(bids, asks, buyers_market, matches)
+
+        return {asset : to_return[asset] for asset in assets}
+
+    '''
+    Clears the market for a single asset, given everyone buying it and everyone selling it. Returns the entry described in get_sales.
+    '''
+    def clear_asset(self, buy_offers : list[BuyCommand], sell_offers : list[SellCommand]) -> MarketResult:
+        #Sorts are stable, so commands with the same price keep the order they were placed in.
+        bids : list[BuyCommand] = sorted(buy_offers, key = attrgetter('max_price'), reverse=True)
+        asks : list[SellCommand] = sorted(sell_offers, key = attrgetter('price'))
+        buyers_market : bool = sum(i.quantity for i in sell_offers) > sum(i.quantity for i in buy_offers)
+        return self._match(bids, asks, buyers_market)
+
+    '''
+    Clears the market for the asset of an order book.
+    '''
+    def clear_book(self, book : OrderBook) -> MarketResult:
+        return self._match(book.get_bids(), book.get_asks(), book.is_buyers_market())
+
+    '''
+    Matches bids (highest max price first) against asks (lowest price first).
+    '''
+    def _match(self, bids : list[BuyCommand], asks : list[SellCommand], buyers_market : bool) -> MarketResult:
+        if (len(bids) == 0 or len(asks) == 0):
+            return StockExchange._create_dead_result(bids, asks)
+
+        matches = match_prices_fastest(*StockExchange._get_prices_and_quantities(bids, asks), buyers_market)
+        return StockExchange._create_matched_result(bids, asks, buyers_market, matches)
+
+    '''
+    Matches a command that was just placed against the resting commands on the other side of its book, for continuous matching.
+    The new command trades with the best prices first, for as long as they are within its limit, and always at the price of the resting command.
+    Returns the sales as Fills, like completed_sales in get_sales. Nothing is changed, so the sales still have to be settled.
+    '''
+    def match_incoming(self, command : ExpiringCommand, book : OrderBook) -> list[Fill]:
+        completed_sales : list[Fill] = []
+        remaining : int = command.quantity
+
+        if (isinstance(command, BuyCommand)):
+            for sell_offer in book.asks:
+                if (remaining == 0 or sell_offer.price > command.max_price):
+                    break
+                quantity = min(remaining, sell_offer.quantity)
+                completed_sales.append(Fill(command, sell_offer, sell_offer.price, quantity))
+                remaining -= quantity
+        elif (isinstance(command, SellCommand)):
+            for buy_offer in book.bids:
+                if (remaining == 0 or buy_offer.max_price < command.price):
+                    break
+                quantity = min(remaining, buy_offer.quantity)
+                completed_sales.append(Fill(buy_offer, command, buy_offer.max_price, quantity))
+                remaining -= quantity
+
+        return completed_sales
+
+    def _get_prices_and_quantities(bids : list[BuyCommand], asks : list[SellCommand]) -> tuple[list[int], list[int], list[int], list[int]]:
+        return [i.max_price for i in bids], [i.quantity for i in bids], [i.price for i in asks], [i.quantity for i in asks]
+
+    '''
+    Turns the output of match_prices back into the entry described in get_sales.
+    '''
+    def _create_matched_result(bids : list[BuyCommand], asks : list[SellCommand], buyers_market : bool, matches : tuple[list[tuple[int, int, int, int]], int, int]) -> MarketResult:
+        fills, first_unfilled_bid, first_unfilled_ask = matches
+        result = MarketResult(bids, asks, buyers_market=buyers_market)
+        result.completed_sales = [Fill(bids[bid_index], asks[ask_index], sale_price, quantity) for bid_index, ask_index, quantity, sale_price in fills]
+
+        #In a buyer's market, the buyers that are left couldn't afford the cheapest seller. Otherwise, the sellers ran out.
+        if (buyers_market):
+            result.failed_sales.stingy = bids[first_unfilled_bid:]
+        else:
+            result.failed_sales.outbidded = bids[first_unfilled_bid:]
+        #If there are any sales left over, those were outpriced - ie, their prices weren't competitive enough for the few buyers on the market.
+        result.failed_sales.outpriced = asks[first_unfilled_ask:]
+        return result
+
+    def _create_dead_result(bids : list[BuyCommand], asks : list[SellCommand]) -> MarketResult:
+        result = MarketResult(bids, asks, dead_market=True)
+        if (len(bids) == 0):
+            #Dead buyer's market
+            result.buyers_market = True
+            result.failed_sales.no_buyers = asks
+        else:
+            #Dead seller's market
+            result.buyers_market = False
+            result.failed_sales.no_sellers = bids
+        return result
+
+    '''
+    Splits the commands into the BUY and SELL commands for each asset, in one pass.
+    '''
+    def _group_commands(commands : list[Command]) -> tuple[dict[Asset, list[BuyCommand]], dict[Asset, list[SellCommand]]]:
+        buying_assets : dict[Asset, list[BuyCommand]] = {}
+        selling_assets : dict[Asset, list[SellCommand]] = {}
+
+        for command in commands:
+            if (isinstance(command, BuyCommand)):
+                buying_assets.setdefault(command.asset, []).append(command)
+            elif (isinstance(command, SellCommand)):
+                selling_assets.setdefault(command.asset, []).append(command)
+
+        return buying_assets, selling_assets
+
+'''
+Matches bids against asks using only their prices and quantities, so it is cheap to send to another process.
+Bids are sorted highest max price first, and asks lowest price first.
+
+Returns:
+ - The fills, as (bid index, ask index, quantity, sale price), in the order they happen.
+ - The index of the first bid that wasn't completely filled (the number of bids if they all were). It and every bid after it failed.
+ - The index of the first ask that wasn't completely filled (the number of asks if they all were). It and every ask after it failed.
+'''
+def match_prices(bid_prices : list[int], bid_quantities : list[int], ask_prices : list[int], ask_quantities : list[int], buyers_market : bool) -> tuple[list[tuple[int, int, int, int]], int, int]:
+    fills : list[tuple[int, int, int, int]] = []
+    number_of_asks = len(ask_prices)
+
+    #The cheapest asset in the list, and how many of its shares are unfilled.
+    ask_index = 0
+    sell_remaining = ask_quantities[0] if number_of_asks > 0 else 0
+
+    for bid_index in range(len(bid_prices)):
+        buy_remaining = bid_quantities[bid_index]
+        while (buy_remaining > 0):
+            if (ask_index == number_of_asks):
+                # If there are no more assets to buy, this buyer and everyone after them were outbidded
+                assert not buyers_market
+                return fills, bid_index, ask_index
+
+            #Establish sale price. If a buyer's market, we use the seller's min price. If a seller's market, we use buyer's max price.
+            sale_price: int
+            if (buyers_market):
+                sale_price = ask_prices[ask_index]
+                if (sale_price > bid_prices[bid_index]):
+                    #weird scenario where it's a buyer's market but the price is too low. Bids are sorted, so everyone after this buyer is even lower.
+                    return fills, bid_index, ask_index
+            else:
+                sale_price = bid_prices[bid_index]
+
+            #Can buy as many shares as both sides have left
+            quantity = min(buy_remaining, sell_remaining)
+            fills.append((bid_index, ask_index, quantity, sale_price))
+            buy_remaining -= quantity
+            sell_remaining -= quantity
+
+            #Move on to the next seller once this one is completely filled.
+            if (sell_remaining == 0):
+                ask_index += 1
+                if (ask_index < number_of_asks):
+                    sell_remaining = ask_quantities[ask_index]
+
+    return fills, len(bid_prices), ask_index
+
+'''
+Runs match_prices_fastest with its arguments packed into one tuple, for Executor.map.
+'''
+def _match_prices_job(arguments : tuple) -> tuple[list[tuple[int, int, int, int]], int, int]:
+    return match_prices_fastest(*arguments)
+'''
+Same as match_prices, but works on whole columns at once with NumPy instead of looping over every order.
+
+Every fill starts and ends where some bid or some ask runs out, so the fills are the gaps between the cumulative quantities of the bids and the asks.
+In a buyer's market, the bids get cheaper and the asks get more expensive as we go, so the fills stop at the first gap where the bid is below the ask.
+'''
+def match_prices_vectorized(bid_prices : list[int], bid_quantities : list[int], ask_prices : list[int], ask_quantities : list[int], buyers_market : bool) -> tuple[list[tuple[int, int, int, int]], int, int]:
+    bid_prices = np.asarray(bid_prices, dtype=np.int64)
+    ask_prices = np.asarray(ask_prices, dtype=np.int64)
+    #Where each bid and ask ends, counting shares from the best price.
+    bid_ends = np.cumsum(np.asarray(bid_quantities, dtype=np.int64))
+    ask_ends = np.cumsum(np.asarray(ask_quantities, dtype=np.int64))
+
+    if (len(bid_ends) == 0 or len(ask_ends) == 0):
+        return [], 0, 0
+
+    #How many shares could change hands, if prices didn't matter
+    shares = min(bid_ends[-1], ask_ends[-1])
+    if (not buyers_market):
+        assert ask_ends[-1] <= bid_ends[-1]
+
+    #Both are already sorted, so a stable sort just merges them. Then drop the duplicates, where a bid and an ask end at the same time.
+    ends = np.sort(np.concatenate((bid_ends, ask_ends)), kind='stable')
+    ends = ends[np.concatenate(([True], ends[1:] != ends[:-1])) & (ends <= shares)]
+    starts = np.concatenate(([0], ends[:-1]))
+    bid_indexes = np.searchsorted(bid_ends, starts, side='right')
+    ask_indexes = np.searchsorted(ask_ends, starts, side='right')
+
+    if (buyers_market):
+        sale_prices = ask_prices[ask_indexes]
+        affordable = sale_prices <= bid_prices[bid_indexes]
+        number_of_fills = len(affordable) if affordable.all() else int(np.argmin(affordable))
+    else:
+        sale_prices = bid_prices[bid_indexes]
+        number_of_fills = len(starts)
+
+    filled_shares = ends[number_of_fills - 1] if number_of_fills > 0 else 0
+    fills = list(zip(
+        bid_indexes[:number_of_fills].tolist(),
+        ask_indexes[:number_of_fills].tolist(),
+        (ends - starts)[:number_of_fills].tolist(),
+        sale_prices[:number_of_fills].tolist()))
+    first_unfilled_bid = int(np.searchsorted(bid_ends, filled_shares, side='right'))
+    first_unfilled_ask = int(np.searchsorted(ask_ends, filled_shares, side='right'))
+    return fills, first_unfilled_bid, first_unfilled_ask
+
+'''
+Uses match_prices_vectorized for deep books, where looping over every order in Python is the bottleneck, and match_prices otherwise.
+'''
+def match_prices_fastest(bid_prices : list[int], bid_quantities : list[int], ask_prices : list[int], ask_quantities : list[int], buyers_market : bool) -> tuple[list[tuple[int, int, int, int]], int, int]:
+    if (len(bid_prices) + len(ask_prices) >= VECTORIZED_MATCHING_THRESHOLD):
+        return match_prices_vectorized(bid_prices, bid_quantities, ask_prices, ask_quantities, buyers_market)
+    else:
+        return match_prices(bid_prices, bid_quantities, ask_prices, ask_quantities, buyers_market)
@@ -1,16 +1,30 @@
 from cgi import test
 import random
+from concurrent.futures import ProcessPoolExecutor
+import sqlite3
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
+from AccountCache import AccountCache
 from Asset import Asset
 from Bank import Bank
 from Command import SellCommand
 from CommandQueue import CommandQueue
 from Command import Command
+from Database import MIGRATIONS, Database
+from HMSE import HMSE, NotificationOutcome
+from Log import Log, LogMessageType
 from Command import BuyCommand
+from MarketResult import Fill
+from MarketSnapshot import MarketSnapshot
 from MessageManager import MessageManager
-from StockExchange import StockExchange
+from OrderBook import OrderBook, PriceLevel
+from Parser import Parser
+from Portfolio import Holding, Portfolio
+from PricePoint import PricePoint
+from PriceTracker import PriceTracker
+from StockExchange import StockExchange, match_prices, match_prices_vectorized
 from User import User
+from Util import get_schema_version, migrate, set_up_schema
 
 def assert_not_called_with(self, *args, **kwargs):
     try:
@@ -30,11 +44,11 @@ def create_asset(name: str = None) -> Asset:
     else:
         return Asset(random.randrange(1, 5000), str(random.randrange(1, 5000)))
 
-def create_sell_command(time_remaining : int = 2, user : User = create_user(), asset : Asset = create_asset(), price: int = 40) -> SellCommand:
-    return SellCommand(random.randrange(1, 5000), time_remaining, user, asset, price)
+def create_sell_command(time_remaining : int = 2, user : User = create_user(), asset : Asset = create_asset(), price: int = 40, quantity : int = 1) -> SellCommand:
+    return SellCommand(random.randrange(1, 5000), time_remaining, user, asset, price, quantity)
 
-def create_buy_command(time_remaining : int = 2, user : User = create_user(), asset : Asset = create_asset(), max_price: int = 500) -> BuyCommand:
-    return BuyCommand(random.randrange(1, 5000), time_remaining, user, asset, max_price)
+def create_buy_command(time_remaining : int = 2, user : User = create_user(), asset : Asset = create_asset(), max_price: int = 500, quantity : int = 1) -> BuyCommand:
+    return BuyCommand(random.randrange(1, 5000), time_remaining, user, asset, max_price, quantity)
 
 def create_command_queue(commands : list[Command]) -> CommandQueue:
     commandQueue : CommandQueue = CommandQueue()
@@ -51,6 +65,43 @@ def create_bank(balance : int = 700, has_asset : bool = True):
     bank.transfer_asset = MagicMock()
     return bank
 
+'''
+An in-memory database with a user who has 100 coins and 4 shares of ZOG, all accounted for, at turn 0.
+'''
+def create_reconciled_bank() -> tuple[Bank, User, Asset]:
+    database = Database(":memory:")
+    bank = Bank(database, MagicMock())
+    user = create_user()
+    database.add_asset("ZOG")
+    asset = database.get_asset_with_name("ZOG")
+    database.set_current_time_id(0)
+    bank.deposit(user, 100)
+    bank.issue_asset(user, asset, 4)
+    bank.transfer_asset_from_escrow(user, asset, 4)
+    database.commit()
+    return bank, user, asset
+
+'''
+An HMSE on an in-memory database, with everything that would talk to the site mocked.
+'''
+def create_hmse(database : Database) -> HMSE:
+    hmse : HMSE = HMSE.__new__(HMSE)
+    hmse.database = database
+    hmse.log = MagicMock()
+    hmse.bank = Bank(database, hmse.log)
+    hmse.api = MagicMock()
+    hmse.randsey = MagicMock()
+    hmse.randsey.get_randsey_says = MagicMock(return_value = "")
+    hmse.commandQueue = CommandQueue(database)
+    hmse.messageManager = MagicMock()
+    hmse.all_assets = database.get_all_assets()
+    hmse.priceTracker = PriceTracker(database)
+    hmse.stockExchange = StockExchange()
+    hmse.marketSnapshot = MarketSnapshot(hmse.stockExchange, hmse.commandQueue, hmse.all_assets)
+    hmse.clearing_processes = None
+    hmse.continuous_matching = False
+    return hmse
+
 class StockExchangeTests(unittest.TestCase):
     def test_sell_with_no_buyers(self):
         my_sell_command : SellCommand = create_sell_command()
@@ -168,5 +219,712 @@ class StockExchangeTests(unittest.TestCase):
         bank.transfer_asset.assert_any_call(seller, low_buyer, asset)
         bank.transfer_asset.assert_not_called_with(seller, high_buyer, asset)
 
+    def test_partial_fill_in_sellers_market(self):
+        asset : Asset = create_asset()
+        buy_command : BuyCommand = create_buy_command(max_price=50, asset=asset, quantity=10)
+        low_sell_command : SellCommand = create_sell_command(price=40, asset=asset, quantity=3)
+        high_sell_command : SellCommand = create_sell_command(price=45, asset=asset, quantity=4)
+
+        sales = StockExchange().get_sales([buy_command, low_sell_command, high_sell_command], [asset])[asset]
+
+        self.assertFalse(sales.buyers_market)
+        self.assertEqual([(i.sell_command, i.quantity, i.sale_price) for i in sales.completed_sales], [(low_sell_command, 3, 50), (high_sell_command, 4, 50)])
+        self.assertEqual(sales.failed_sales.outbidded, [buy_command])
+        self.assertEqual(sales.failed_sales.outpriced, [])
+
+    def test_partial_fill_in_buyers_market(self):
+        asset : Asset = create_asset()
+        buy_command : BuyCommand = create_buy_command(max_price=50, asset=asset, quantity=5)
+        low_sell_command : SellCommand = create_sell_command(price=40, asset=asset, quantity=3)
+        high_sell_command : SellCommand = create_sell_command(price=60, asset=asset, quantity=10)
+
+        sales = StockExchange().get_sales([buy_command, low_sell_command, high_sell_command], [asset])[asset]
+
+        self.assertTrue(sales.buyers_market)
+        self.assertEqual([(i.sell_command, i.quantity, i.sale_price) for i in sales.completed_sales], [(low_sell_command, 3, 40)])
+        self.assertEqual(sales.failed_sales.stingy, [buy_command])
+        self.assertEqual(sales.failed_sales.outpriced, [high_sell_command])
+
+    def test_order_book_is_cleared_like_the_commands(self):
+        asset : Asset = create_asset()
+        commands = [
+            create_buy_command(max_price=50, asset=asset, quantity=2),
+            create_sell_command(price=45, asset=asset, quantity=1),
+            create_buy_command(max_price=60, asset=asset, quantity=1),
+            create_sell_command(price=30, asset=asset, quantity=1),
+            create_sell_command(price=45, asset=asset, quantity=3)
+        ]
+        book : OrderBook = OrderBook(asset)
+        for command in commands:
+            book.add(command)
+
+        self.assertEqual(book.best_bid, commands[2])
+        self.assertEqual(book.best_ask, commands[3])
+        self.assertEqual(book.get_asks(), [commands[3], commands[1], commands[4]])
+        self.assertEqual(book.asks.quantity, 5)
+
+        from_book = StockExchange().get_sales_from_books({asset: book}, [asset])[asset]
+        from_commands = StockExchange().get_sales(commands, [asset])[asset]
+        self.assertEqual(from_book.completed_sales, from_commands.completed_sales)
+        self.assertEqual(from_book.failed_sales, from_commands.failed_sales)
+
+        book.remove(commands[3])
+        self.assertEqual(book.best_ask, commands[1])
+        self.assertEqual(book.asks.count, 2)
+
+    def test_order_book_depth_is_aggregated_by_price(self):
+        asset : Asset = create_asset()
+        book : OrderBook = OrderBook(asset)
+        first_sell_command = create_sell_command(price=45, asset=asset, quantity=1)
+        second_sell_command = create_sell_command(price=45, asset=asset, quantity=3)
+        book.add(first_sell_command)
+        book.add(second_sell_command)
+        book.add(create_sell_command(price=30, asset=asset, quantity=2))
+        book.add(create_buy_command(max_price=20, asset=asset, quantity=4))
+
+        bids, asks = book.get_depth()
+        self.assertEqual(bids, [PriceLevel(20, 4, 1)])
+        self.assertEqual(asks, [PriceLevel(30, 2, 1), PriceLevel(45, 4, 2)])
+
+        book.change_quantity(second_sell_command, -2)
+        second_sell_command.quantity = 1
+        book.remove(first_sell_command)
+        self.assertEqual(book.asks.get_depth(1), [PriceLevel(30, 2, 1)])
+        self.assertEqual(book.asks.get_depth(), [PriceLevel(30, 2, 1), PriceLevel(45, 1, 1)])
+
+    def test_vectorized_matching_is_the_same_as_the_loop(self):
+        for _ in range(500):
+            bid_prices = sorted([random.randrange(1, 10) for _ in range(random.randrange(1, 8))], reverse=True)
+            bid_quantities = [random.randrange(1, 5) for _ in bid_prices]
+            ask_prices = sorted([random.randrange(1, 10) for _ in range(random.randrange(1, 8))])
+            ask_quantities = [random.randrange(1, 5) for _ in ask_prices]
+            buyers_market = sum(ask_quantities) > sum(bid_quantities)
+
+            self.assertEqual(
+                match_prices_vectorized(bid_prices, bid_quantities, ask_prices, ask_quantities, buyers_market),
+                match_prices(bid_prices, bid_quantities, ask_prices, ask_quantities, buyers_market))
+
+    def test_parallel_clearing_is_the_same_as_serial(self):
+        dead_asset : Asset = create_asset()
+        one_sided_asset : Asset = create_asset()
+        assets : list[Asset] = [create_asset() for _ in range(4)]
+        books : dict[Asset, OrderBook] = {asset : OrderBook(asset) for asset in assets + [one_sided_asset]}
+        for asset in assets:
+            for _ in range(random.randrange(1, 6)):
+                books[asset].add(create_buy_command(max_price=random.randrange(1, 10), asset=asset, quantity=random.randrange(1, 5)))
+            for _ in range(random.randrange(1, 6)):
+                books[asset].add(create_sell_command(price=random.randrange(1, 10), asset=asset, quantity=random.randrange(1, 5)))
+        books[one_sided_asset].add(create_sell_command(price=5, asset=one_sided_asset))
+        all_assets = [dead_asset, one_sided_asset] + assets
+
+        serial = StockExchange().get_sales_for_assets(books, all_assets)
+        with ProcessPoolExecutor(2) as pool:
+            parallel = StockExchange().get_sales_for_assets_parallel(books, all_assets, pool)
+
+        self.assertEqual(list(parallel), all_assets)
+        self.assertEqual(parallel, serial)
+
+    def test_incoming_buy_trades_at_resting_prices(self):
+        asset : Asset = create_asset()
+        book : OrderBook = OrderBook(asset)
+        cheap_sell_command : SellCommand = create_sell_command(price=40, asset=asset, quantity=2)
+        pricey_sell_command : SellCommand = create_sell_command(price=45, asset=asset, quantity=2)
+        too_pricey_sell_command : SellCommand = create_sell_command(price=60, asset=asset, quantity=2)
+        for command in [too_pricey_sell_command, pricey_sell_command, cheap_sell_command]:
+            book.add(command)
+
+        buy_command : BuyCommand = create_buy_command(max_price=50, asset=asset, quantity=5)
+        sales = StockExchange().match_incoming(buy_command, book)
+
+        self.assertEqual([(i.sell_command, i.quantity, i.sale_price) for i in sales], [(cheap_sell_command, 2, 40), (pricey_sell_command, 2, 45)])
+
+    def test_portfolio_is_worth_its_coins_and_shares_at_latest_prices(self):
+        traded_asset : Asset = create_asset()
+        untraded_asset : Asset = create_asset()
+        portfolio = Portfolio(100, 20, [Holding(traded_asset, 3, 2, 15), Holding(untraded_asset, 4, 0, None)])
+
+        self.assertEqual(portfolio.total_balance, 120)
+        self.assertEqual([i.value for i in portfolio.holdings], [75, 0])
+        self.assertEqual(portfolio.value, 195)
+
+class DatabaseTests(unittest.TestCase):
+    def test_migrations_bring_an_old_database_up_to_date(self):
+        connection = sqlite3.connect(":memory:")
+        #The schema from before there were migrations
+        connection.executescript('''
+            CREATE TABLE owned_assets (user_id integer, asset_id integer, amount integer, amount_in_escrow integer, PRIMARY KEY (user_id, asset_id));
+            CREATE TABLE commands (command_id integer PRIMARY KEY, user_id integer, command_type integer, amount integer, asset_id integer, expiring_in integer);
+            CREATE TABLE users (user_id integer PRIMARY KEY, user_name string, balance integer, balance_in_escrow integer);
+            CREATE TABLE state (id integer PRIMARY KEY, last_processed_notification_id integer, current_time_id integer);
+            INSERT INTO commands VALUES (1, 5, 1, 40, 3, 2);
+            INSERT INTO users VALUES (5, 'Eggbert', 100, 40);
+            INSERT INTO owned_assets VALUES (5, 3, 2, 1);
+            INSERT INTO state VALUES (0, 0, 10);''')
+
+        set_up_schema(connection, "setup_database.sql", MIGRATIONS)
+
+        self.assertEqual(get_schema_version(connection), len(MIGRATIONS))
+        self.assertEqual(connection.execute("SELECT quantity FROM commands").fetchall(), [(1,)])
+        self.assertEqual(connection.execute("SELECT time_id, user_id, asset_id, available, escrow FROM balance_snapshots ORDER BY asset_id").fetchall(), [(9, 5, 0, 100, 40), (9, 5, 3, 2, 1)])
+        self.assertIn("commands_by_asset", [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")])
+        self.assertEqual(connection.execute("SELECT last_command_id FROM state").fetchall(), [(1,)])
+
+    def test_failed_migration_is_rolled_back_and_retried(self):
+        connection = sqlite3.connect(":memory:")
+        migrations = [["CREATE TABLE first (x integer)"], ["CREATE TABLE second (x integer)", "INSERT INTO nowhere VALUES (1)"]]
+
+        self.assertRaises(sqlite3.OperationalError, migrate, connection, migrations)
+        self.assertEqual(get_schema_version(connection), 1)
+        self.assertEqual(connection.execute("SELECT count(*) FROM sqlite_master WHERE name = 'second'").fetchone(), (0,))
+
+        migrations[1] = ["CREATE TABLE second (x integer)"]
+        migrate(connection, migrations)
+        self.assertEqual(get_schema_version(connection), 2)
+
+    def test_up_to_date_schema_is_not_set_up_again(self):
+        connection = sqlite3.connect(":memory:")
+        set_up_schema(connection, "setup_database.sql", MIGRATIONS)
+
+        #The script isn't even opened
+        set_up_schema(connection, "no_such_script.sql", MIGRATIONS)
+        self.assertEqual(get_schema_version(connection), len(MIGRATIONS))
+
+        connection.execute(f"PRAGMA user_version = {len(MIGRATIONS) - 1}")
+        self.assertRaises(FileNotFoundError, set_up_schema, connection, "no_such_script.sql", MIGRATIONS)
+
+    def test_commands_added_in_bulk_get_the_ids_they_are_stored_with(self):
+        bank, user, asset = create_reconciled_bank()
+        commandQueue = CommandQueue(bank.database)
+        describe = lambda commands: [(i.id, type(i), i.price if isinstance(i, SellCommand) else i.max_price, i.quantity, i.time_remaining) for i in commands]
+
+        first_ids = commandQueue.add_commands([create_buy_command(user=user, asset=asset, max_price=10), create_sell_command(user=user, asset=asset, price=20, quantity=3), create_buy_command(user=user, asset=asset, max_price=30)])
+        commands = commandQueue.get_commands()
+        self.assertEqual([i.id for i in commands], first_ids)
+        self.assertEqual(describe(CommandQueue(bank.database).get_commands()), describe(commands))
+        commandQueue.delete_command(commands[1])
+        #The highest id is gone, but isn't handed out again
+        commandQueue.delete_command(commands[2])
+        second_ids = commandQueue.add_commands([create_sell_command(user=user, asset=asset, price=40), create_buy_command(user=user, asset=asset, max_price=50, quantity=2)])
+        bank.database.commit()
+
+        self.assertGreater(min(second_ids), max(first_ids))
+        self.assertEqual([i.id for i in commandQueue.get_commands()], first_ids[:1] + second_ids)
+        self.assertEqual(describe(CommandQueue(bank.database).get_commands()), describe(commandQueue.get_commands()))
+
+    def test_expired_commands_leave_the_books_until_they_are_deleted(self):
+        bank, user, asset = create_reconciled_bank()
+        commandQueue = CommandQueue(bank.database)
+        commands = [create_buy_command(time_remaining=1, user=user, asset=asset), create_sell_command(time_remaining=2, user=user, asset=asset), create_buy_command(time_remaining=3, user=user, asset=asset)]
+        commandQueue.add_commands(commands)
+
+        self.assertEqual(commandQueue.expire_commands(), [commands[0]])
+        self.assertEqual(commandQueue.get_commands(), commands)
+        self.assertEqual(commandQueue.get_book(asset).get_bids(), [commands[2]])
+        self.assertEqual([(i.id, i.time_remaining) for i in CommandQueue(bank.database).get_commands()], [(commands[0].id, 0), (commands[1].id, 1), (commands[2].id, 2)])
+        self.assertEqual([i.id for i in CommandQueue(bank.database).get_book(asset).get_bids()], [commands[2].id])
+
+        #Until it is deleted, it is returned again every turn
+        self.assertEqual(commandQueue.expire_commands(), commands[:2])
+        self.assertEqual(commandQueue.get_book(asset).get_asks(), [])
+        commandQueue.delete_commands(commands[:2])
+        self.assertEqual(commandQueue.get_commands(), commands[2:])
+        self.assertEqual([i.id for i in CommandQueue(bank.database).get_commands()], [commands[2].id])
+
+    def test_balance_changes_create_the_user_and_never_go_negative(self):
+        database = Database(":memory:")
+        user = create_user()
+
+        self.assertIsNone(database.change_balance(user, balance_difference=-1))
+        self.assertEqual(database.change_balance(user, balance_difference=100), (100, 0))
+        self.assertEqual(database.get_only_cell("SELECT user_name FROM users WHERE user_id = ?", user.id), user.name)
+        self.assertEqual(database.change_balance(user, balance_difference=-30, escrow_difference=30), (70, 30))
+        self.assertIsNone(database.change_balance(user, escrow_difference=-31))
+        self.assertIsNone(database.change_balance(user, balance_difference=-70, minimum_balance=1))
+        self.assertEqual(database.change_balance(user, balance_difference=-70), (0, 30))
+        self.assertEqual(database.get_balances(user), (0, 30))
+
+    def test_holding_changes_create_the_row_and_never_go_negative(self):
+        database = Database(":memory:")
+        user = create_user()
+        asset = create_asset()
+
+        self.assertIsNone(database.change_owned_assets(user, asset, escrow_difference=-1))
+        self.assertEqual(database.get_only_cell("SELECT count(*) FROM owned_assets"), 0)
+        self.assertEqual(database.change_owned_assets(user, asset, escrow_difference=5), (0, 5))
+        self.assertEqual(database.change_owned_assets(user, asset, difference=3, escrow_difference=-3), (3, 2))
+        self.assertIsNone(database.change_owned_assets(user, asset, difference=-4))
+        self.assertIsNone(database.change_owned_assets(user, asset, difference=1, escrow_difference=-3))
+        self.assertEqual(database.get_owned_asset_balances(user, asset), (3, 2))
+
+    def test_portfolio_is_read_with_latest_prices(self):
+        database = Database(":memory:")
+        bank = Bank(database, MagicMock())
+        user = create_user()
+        for name in ["TRADED", "UNTRADED", "SOLD"]:
+            database.add_asset(name)
+        traded_asset, untraded_asset, sold_asset = [database.get_asset_with_name(name) for name in ["TRADED", "UNTRADED", "SOLD"]]
+        bank.deposit(user, 100)
+        bank.transfer_to_escrow(user, 20)
+        bank.issue_asset(user, traded_asset, 3)
+        bank.transfer_asset_from_escrow(user, traded_asset, 2)
+        bank.issue_asset(user, untraded_asset, 4)
+        bank.issue_asset(user, sold_asset, 1)
+        bank.transfer_asset(user, create_user(), sold_asset)
+        database.set_current_time_id(2)
+        for time_id, price in [(1, 10), (2, 15), (3, 99)]:
+            database.set_price(PricePoint(time_id, traded_asset, price, price, price, price))
+        database.commit()
+
+        portfolio = bank.get_portfolio(user)
+
+        self.assertEqual((portfolio.balance, portfolio.balance_in_escrow), (80, 20))
+        self.assertEqual([(i.asset.id, i.available, i.in_escrow, i.price) for i in portfolio.holdings], [(traded_asset.id, 2, 1, 15), (untraded_asset.id, 0, 4, None)])
+        self.assertEqual(portfolio.value, 145)
+
+class MarketSnapshotTests(unittest.TestCase):
+    def test_market_snapshot_only_clears_assets_whose_book_changed(self):
+        bank, user, asset = create_reconciled_bank()
+        bank.database.add_asset("PUTIN")
+        other_asset = bank.database.get_asset_with_name("PUTIN")
+        commandQueue = CommandQueue(bank.database)
+        commandQueue.add_commands([create_sell_command(user=user, asset=asset, price=10), create_buy_command(user=user, asset=other_asset, max_price=10)])
+        stockExchange = StockExchange()
+        stockExchange.clear_book = MagicMock(wraps=stockExchange.clear_book)
+        marketSnapshot = MarketSnapshot(stockExchange, commandQueue, [asset, other_asset])
+
+        sales = marketSnapshot.get_sales()
+        self.assertEqual(stockExchange.clear_book.call_count, 2)
+        commandQueue.add_command(create_buy_command(user=user, asset=asset, max_price=10))
+
+        asset_sales = marketSnapshot.get_asset_sales(asset)
+        self.assertIsNot(asset_sales, sales[asset])
+        self.assertEqual([(i.sale_price, i.quantity) for i in asset_sales.completed_sales], [(10, 1)])
+        self.assertIs(marketSnapshot.get_sales([other_asset])[other_asset], sales[other_asset])
+        self.assertIs(marketSnapshot.get_sales()[asset], asset_sales)
+        self.assertEqual([i.args[0].asset for i in stockExchange.clear_book.call_args_list], [asset, other_asset, asset])
+
+class BankTests(unittest.TestCase):
+    def test_rolled_back_savepoint_undoes_cached_changes(self):
+        database = Database(":memory:")
+        bank = Bank(database, MagicMock())
+        user = create_user()
+        asset = create_asset()
+        bank.deposit(user, 100)
+        bank.issue_asset(user, asset, 5)
+        bank.transfer_asset_from_escrow(user, asset, 5)
+        database.commit()
+
+        with bank.cached_accounts():
+            bank.transfer_to_escrow(user, 30)
+            try:
+                with database.savepoint("sale"):
+                    bank.transfer_to_escrow(user, 50)
+                    bank.transfer_asset_to_escrow(user, asset, 4)
+                    raise Exception("Sale failed")
+            except Exception:
+                pass
+            self.assertEqual(bank.get_balance(user), 70)
+            self.assertEqual(bank.get_number_of_assets(user, asset), 5)
+            bank.transfer_asset_to_escrow(user, asset, 1)
+            database.commit()
+
+        self.assertEqual(database.get_balances(user), (70, 30))
+        self.assertEqual(database.get_owned_asset_balances(user, asset), (4, 1))
+        self.assertEqual(database.get_rows("SELECT asset_id, sum(delta) FROM ledger WHERE account = 'ESCROW' GROUP BY asset_id ORDER BY asset_id"), [(0, 30), (asset.id, 1)])
+
+    def test_cached_changes_are_only_journaled_inside_a_savepoint(self):
+        database = Database(":memory:")
+        cache = AccountCache(database)
+        user = create_user()
+
+        cache.change(user, None, 100)
+        self.assertEqual(cache._journal, [])
+        cache.savepoint_started()
+        cache.change(user, None, -30, 30)
+        self.assertEqual(len(cache._journal), 1)
+        cache.savepoint_released()
+        self.assertEqual(cache._journal, [])
+        self.assertEqual(cache.get_balances(user), (70, 30))
+
+    def test_rollback_forgets_cached_changes(self):
+        database = Database(":memory:")
+        bank = Bank(database, MagicMock())
+        user = create_user()
+        bank.deposit(user, 100)
+        database.commit()
+
+        with bank.cached_accounts():
+            bank.transfer_to_escrow(user, 30)
+            database.rollback()
+            self.assertEqual(bank.get_balance(user), 100)
+
+        self.assertEqual(database.get_balances(user), (100, 0))
+        self.assertEqual(database.get_only_cell("SELECT count(*) FROM ledger WHERE account = 'ESCROW'"), 0)
+
+    def test_failed_fills_change_nothing(self):
+        database = Database(":memory:")
+        bank = Bank(database, MagicMock())
+        buyer = User(1, "Buyer")
+        seller = User(2, "Seller")
+        asset = create_asset()
+        bank.deposit(buyer, 100)
+        bank.transfer_to_escrow(buyer, 60)
+        bank.issue_asset(seller, asset, 3)
+        database.commit()
+        buy_command = create_buy_command(user=buyer, asset=asset, max_price=30, quantity=2)
+        sell_command = create_sell_command(user=seller, asset=asset, price=20, quantity=3)
+        fills = [Fill(buy_command, sell_command, 20, 2), Fill(buy_command, sell_command, 20, 2), Fill(buy_command, sell_command, 20, 1)]
+        #The first fill fails halfway through, for a reason that isn't an AssertionError
+        bank.log.add_log_message = MagicMock(side_effect = [Exception("Log is down"), None])
+
+        with bank.cached_accounts():
+            bank.load_accounts(fills)
+            self.assertRaises(Exception, bank.settle_fill, fills[0])
+            bank.settle_fill(fills[1])
+            #More than the buyer has left in escrow
+            self.assertRaises(AssertionError, bank.settle_fill, fills[2])
+            database.commit()
+
+        self.assertEqual(database.get_balances(buyer), (60, 0))
+        self.assertEqual(database.get_owned_asset_balances(buyer, asset), (2, 0))
+        self.assertEqual(database.get_balances(seller), (40, 0))
+        self.assertEqual(database.get_owned_asset_balances(seller, asset), (0, 1))
+        self.assertEqual(database.get_only_cell("SELECT count(*) FROM ledger WHERE reason = 'SALE'"), 4)
+
+    def test_fills_are_settled_together_or_not_at_all(self):
+        database = Database(":memory:")
+        bank = Bank(database, MagicMock())
+        buyer = User(1, "Buyer")
+        seller = User(2, "Seller")
+        asset = create_asset()
+        bank.deposit(buyer, 100)
+        bank.transfer_to_escrow(buyer, 60)
+        bank.issue_asset(seller, asset, 3)
+        database.commit()
+        buy_command = create_buy_command(user=buyer, asset=asset, max_price=30, quantity=2)
+        sell_command = create_sell_command(user=seller, asset=asset, price=20, quantity=3)
+
+        with bank.cached_accounts():
+            #Each fill is fine on its own, but together they need 90 coins of the buyer's 60 in escrow
+            self.assertRaises(AssertionError, bank.settle_fills, [Fill(buy_command, sell_command, 20, 2), Fill(buy_command, sell_command, 20, 1)])
+            self.assertEqual(bank.get_balance(buyer), 40)
+            bank.settle_fills([Fill(buy_command, sell_command, 20, 1), Fill(buy_command, sell_command, 20, 1)])
+            database.commit()
+
+        self.assertEqual(database.get_balances(buyer), (60, 0))
+        self.assertEqual(database.get_owned_asset_balances(buyer, asset), (2, 0))
+        self.assertEqual(database.get_balances(seller), (40, 0))
+        self.assertEqual(database.get_owned_asset_balances(seller, asset), (0, 1))
+        self.assertEqual(database.get_only_cell("SELECT count(*) FROM ledger WHERE reason = 'SALE'"), 8)
+
+    def test_balances_are_replayed_from_the_ledger_across_snapshots(self):
+        database = Database(":memory:")
+        bank = Bank(database, MagicMock())
+        user = create_user()
+        asset = create_asset()
+        database.set_current_time_id(0)
+        bank.deposit(user, 100)
+        bank.issue_asset(user, asset, 4)
+        database.take_balance_snapshot(0)
+        database.set_current_time_id(1)
+        bank.transfer_to_escrow(user, 30)
+        bank.transfer_asset_from_escrow(user, asset, 3)
+        database.set_current_time_id(2)
+        #Changes that bypass the ledger don't make it into the snapshot
+        database.run_command("UPDATE users SET balance_in_escrow = 999 WHERE user_id = ?", user.id)
+        database.take_balance_snapshot(2)
+        database.set_current_time_id(3)
+        bank.transfer_from_escrow(user, 10)
+        database.commit()
+
+        self.assertEqual(database.get_rows("SELECT time_id, asset_id, available, escrow FROM balance_snapshots WHERE user_id = ? ORDER BY time_id, asset_id", user.id),
+            [(0, 0, 100, 0), (0, asset.id, 0, 4), (2, 0, 70, 30), (2, asset.id, 3, 1)])
+        self.assertEqual([database.get_balances_at(user, None, time_id) for time_id in range(4)], [(100, 0), (70, 30), (70, 30), (80, 20)])
+        self.assertEqual([database.get_balances_at(user, asset, time_id) for time_id in range(4)], [(0, 4), (3, 1), (3, 1), (3, 1)])
+
+    def test_reconcile_finds_nothing_wrong_with_a_clean_database(self):
+        bank, _, _ = create_reconciled_bank()
+        bank.database.set_current_time_id(2)
+
+        self.assertEqual(bank.reconcile(), [])
+        self.assertEqual(bank.database.get_last_reconciled_time_id(), 1)
+
+    def test_reconcile_finds_coins_created_out_of_nothing(self):
+        bank, user, _ = create_reconciled_bank()
+        bank.database.add_ledger_entries([(0, user.id, 0, "AVAILABLE", 5, "DEPOSIT", None)])
+        bank.database.run_command("UPDATE users SET balance = balance + 5 WHERE user_id = ?", user.id)
+
+        self.assertEqual(bank.reconcile(), ["During turn 0, 5 coins were created out of nothing."])
+        self.assertEqual(bank.database.get_last_reconciled_time_id(), -1)
+
+    def test_reconcile_finds_shares_created_out_of_nothing(self):
+        bank, user, asset = create_reconciled_bank()
+        bank.database.add_ledger_entries([(0, user.id, asset.id, "AVAILABLE", 2, "SALE", None)])
+        bank.database.run_command("UPDATE owned_assets SET amount = amount + 2 WHERE user_id = ? AND asset_id = ?", user.id, asset.id)
+
+        self.assertEqual(bank.reconcile(), ["During turn 0, 2 ZOG were created out of nothing."])
+
+    def test_reconcile_finds_balances_that_dont_match_the_ledger(self):
+        bank, user, _ = create_reconciled_bank()
+        bank.database.run_command("UPDATE users SET balance = balance + 7 WHERE user_id = ?", user.id)
+        #Older than the latest snapshot, which mustn't hide it
+        bank.database.take_balance_snapshot(0)
+        bank.database.set_current_time_id(1)
+        bank.database.take_balance_snapshot(1)
+
+        self.assertEqual(bank.reconcile(), [f"User {user.id} has 7 more coins available and 0 more in escrow than the ledger says."])
+
+    def test_reconcile_finds_escrow_that_doesnt_match_the_commands(self):
+        bank, user, asset = create_reconciled_bank()
+        bank.transfer_asset_to_escrow(user, asset, 1)
+        bank.database.commit()
+
+        self.assertEqual(bank.reconcile(), [f"User {user.id} has 1 more ZOG in escrow than their commands account for."])
+
+class LogTests(unittest.TestCase):
+    def test_log_is_written_when_the_database_commits_or_rolls_back(self):
+        database = Database(":memory:")
+        log = Log(":memory:", database)
+        count_written = lambda: log.get_only_cell("SELECT count(*) FROM log")
+
+        for i in range(3):
+            log.add_log_message("TEST", LogMessageType.BANK, str(i))
+        self.assertEqual(count_written(), 0)
+        database.commit()
+        self.assertEqual(count_written(), 3)
+        self.assertFalse(log.con.in_transaction)
+
+        log.add_log_message("TEST", LogMessageType.EXCEPTION, "Rolled back")
+        database.rollback()
+        self.assertEqual(count_written(), 4)
+        self.assertFalse(log.con.in_transaction)
+        log.close()
+
+    def test_full_log_buffer_is_written_without_a_commit(self):
+        database = Database(":memory:")
+        log = Log(":memory:", database)
+
+        with patch("Log.LOG_BUFFER_SIZE", 2):
+            log.add_log_message("TEST", LogMessageType.BANK, "First")
+            self.assertEqual(log.get_only_cell("SELECT count(*) FROM log"), 0)
+            log.add_log_message("TEST", LogMessageType.BANK, "Second")
+            self.assertEqual(log.get_only_cell("SELECT count(*) FROM log"), 2)
+        self.assertEqual([i['message'] for i in log.get_log_messages(LogMessageType.BANK)], ["First", "Second"])
+        log.close()
+
+class HMSETests(unittest.TestCase):
+    def test_expired_commands_are_refunded_once_per_user(self):
+        bank, user, asset = create_reconciled_bank()
+        other_user = User(user.id + 1, "Other")
+        hmse = create_hmse(bank.database)
+        hmse.bank = bank
+        bank.deposit(other_user, 10)
+        commands = [create_buy_command(time_remaining=1, user=user, asset=asset, max_price=10, quantity=2), create_buy_command(time_remaining=1, user=user, asset=asset, max_price=5, quantity=1),
+            create_sell_command(time_remaining=1, user=user, asset=asset, quantity=3), create_buy_command(time_remaining=1, user=other_user, asset=asset, max_price=7, quantity=1)]
+        bank.transfer_to_escrow(user, 25)
+        bank.transfer_asset_to_escrow(user, asset, 3)
+        bank.transfer_to_escrow(other_user, 7)
+        hmse.commandQueue.add_commands(commands)
+        bank.database.commit()
+        count_refunds = lambda: bank.database.get_only_cell("SELECT count(*) FROM ledger WHERE reason = 'FROM_ESCROW'")
+        refunds_before = count_refunds()
+
+        hmse.refund_expired_commands(hmse.commandQueue.expire_commands())
+        bank.database.commit()
+
+        self.assertEqual(bank.database.get_balances(user), (100, 0))
+        self.assertEqual(bank.database.get_owned_asset_balances(user, asset), (4, 0))
+        self.assertEqual(bank.database.get_balances(other_user), (10, 0))
+        #One pair of entries for each of: user's coins, user's shares, and other_user's coins
+        self.assertEqual(count_refunds() - refunds_before, 6)
+        self.assertEqual(hmse.messageManager.send_message_queued.call_count, 4)
+        self.assertEqual(bank.reconcile(), [])
+
+    def test_failed_refund_is_retried_next_turn(self):
+        bank, user, asset = create_reconciled_bank()
+        hmse = create_hmse(bank.database)
+        hmse.bank = bank
+        command = create_buy_command(time_remaining=1, user=user, asset=asset, max_price=10, quantity=2)
+        bank.transfer_to_escrow(user, 20)
+        hmse.commandQueue.add_commands([command])
+        bank.database.commit()
+
+        with patch.object(bank, "transfer_from_escrow", side_effect = Exception("Refund failed")):
+            hmse.refund_expired_commands(hmse.commandQueue.expire_commands())
+        bank.database.commit()
+
+        self.assertEqual(bank.database.get_balances(user), (80, 20))
+        self.assertEqual(hmse.commandQueue.get_commands(), [command])
+        #It doesn't stop the user from selling in the meantime
+        self.assertFalse(hmse.commandQueue.is_buying_asset(user, asset))
+        self.assertEqual(hmse.commandQueue.get_book(asset).get_bids(), [])
+        self.assertEqual([i.id for i in CommandQueue(bank.database).get_commands()], [command.id])
+        self.assertEqual(CommandQueue(bank.database).get_book(asset).get_bids(), [])
+        self.assertEqual(bank.reconcile(), [])
+
+        hmse.refund_expired_commands(hmse.commandQueue.expire_commands())
+        bank.database.commit()
+
+        self.assertEqual(bank.database.get_balances(user), (100, 0))
+        self.assertEqual(hmse.commandQueue.get_commands(), [])
+        self.assertEqual(CommandQueue(bank.database).get_commands(), [])
+        self.assertEqual(bank.reconcile(), [])
+
+    def test_failed_sale_is_undone_and_the_rest_of_the_tick_is_kept(self):
+        bank, seller, asset = create_reconciled_bank()
+        hmse = create_hmse(bank.database)
+        hmse.bank = bank
+        hmse.messageManager = MessageManager(hmse.randsey)
+        bank.database.add_transaction_listener(hmse.messageManager)
+        buyers = [User(seller.id + i, f"Buyer{i}") for i in range(1, 4)]
+        failing_buyer = buyers[1]
+        for buyer in buyers:
+            bank.deposit(buyer, 50)
+            bank.transfer_to_escrow(buyer, 10)
+        bank.transfer_asset_to_escrow(seller, asset, 3)
+        hmse.commandQueue.add_commands([create_sell_command(user=seller, asset=asset, price=10, quantity=3)] + [create_buy_command(time_remaining=5, user=buyer, asset=asset, max_price=10) for buyer in buyers])
+        bank.database.commit()
+        #Fails once everything about the sale has been done, so all of it has to be undone
+        record_sale = hmse.record_sale
+        def record_sale_then_fail(asset, completed_sale, market_explanation):
+            record_sale(asset, completed_sale, market_explanation)
+            if (completed_sale.buy_command.user == failing_buyer):
+                raise Exception("Crashed")
+        hmse.record_sale = record_sale_then_fail
+
+        hmse.process()
+
+        self.assertEqual(bank.database.get_current_time_id(), 1)
+        self.assertEqual([bank.database.get_owned_asset_balances(buyer, asset) for buyer in buyers], [(1, 0), (0, 0), (1, 0)])
+        self.assertEqual([bank.database.get_balances(buyer) for buyer in buyers], [(40, 0), (40, 10), (40, 0)])
+        self.assertEqual(bank.database.get_balances(seller), (120, 0))
+        self.assertEqual(bank.database.get_owned_asset_balances(seller, asset), (1, 1))
+        self.assertEqual(bank.database.get_only_cell("SELECT count(*) FROM ledger WHERE reason = 'SALE' AND user_id = ?", failing_buyer.id), 0)
+        self.assertEqual(bank.database.get_only_cell("SELECT sum(quantity) FROM trades"), 2)
+        self.assertEqual([(i.user, i.quantity) for i in hmse.commandQueue.get_commands()], [(seller, 1), (failing_buyer, 1)])
+        self.assertEqual([(i.user, i.quantity) for i in bank.database.get_commands()], [(seller, 1), (failing_buyer, 1)])
+        self.assertNotIn(failing_buyer.name, [i.args[0] for i in hmse.api.send_message.call_args_list])
+        self.assertEqual(bank.reconcile(), [])
+
+    def test_incoming_command_is_settled_like_a_batch_sale(self):
+        bank, seller, asset = create_reconciled_bank()
+        hmse = create_hmse(bank.database)
+        hmse.bank = bank
+        buyer = User(seller.id + 1, "Buyer")
+        bank.deposit(buyer, 100)
+        bank.transfer_asset_to_escrow(seller, asset, 3)
+        hmse.commandQueue.add_command(create_sell_command(user=seller, asset=asset, price=10, quantity=3))
+        buy_command = create_buy_command(user=buyer, asset=asset, max_price=15, quantity=2)
+        bank.transfer_to_escrow(buyer, 30)
+        hmse.commandQueue.add_command(buy_command)
+
+        hmse.match_incoming_command(buy_command)
+        bank.database.commit()
+
+        self.assertEqual(bank.database.get_balances(buyer), (80, 0))
+        self.assertEqual(bank.database.get_owned_asset_balances(buyer, asset), (2, 0))
+        self.assertEqual(bank.database.get_balances(seller), (120, 0))
+        self.assertEqual(bank.database.get_owned_asset_balances(seller, asset), (1, 1))
+        self.assertEqual([(i.user, i.quantity) for i in bank.database.get_commands()], [(seller, 1)])
+        self.assertEqual(bank.reconcile(), [])
+
+    def test_orders_that_dont_last_a_turn_are_never_matched(self):
+        bank, seller, asset = create_reconciled_bank()
+        hmse = create_hmse(bank.database)
+        hmse.bank = bank
+        hmse.parser = Parser()
+        hmse.continuous_matching = True
+        buyer = User(seller.id + 1, "Buyer")
+        bank.deposit(buyer, 100)
+        bank.transfer_asset_to_escrow(seller, asset, 1)
+        hmse.commandQueue.add_command(create_sell_command(user=seller, asset=asset, price=10, quantity=1))
+
+        self.assertEqual(hmse.handle_command(buyer, "@hmse buy ZOG 10 count=2 time=0"), "Orders have to last at least 1 turn.")
+        self.assertEqual(hmse.handle_command(seller, "@hmse sell ZOG 10 time=-1"), "Orders have to last at least 1 turn.")
+        #Placed some other way, it still isn't matched
+        expired_command = create_buy_command(time_remaining=0, user=buyer, asset=asset, max_price=10, quantity=2)
+        bank.transfer_to_escrow(buyer, 20)
+        hmse.commandQueue.add_command(expired_command)
+        self.assertEqual(hmse.match_incoming_command(expired_command), "")
+        self.assertEqual(bank.database.get_owned_asset_balances(buyer, asset), (0, 0))
+        self.assertEqual(hmse.commandQueue.get_book(asset).asks.quantity, 1)
+
+    def test_market_depth_that_isnt_a_number_is_refused(self):
+        bank, _, _ = create_reconciled_bank()
+        hmse = create_hmse(bank.database)
+        hmse.parser = Parser()
+        user = create_user()
+
+        response = hmse.handle_command(user, "@hmse market ZOG depth=lots")
+
+        self.assertEqual(response, "The depth has to be a whole number of price levels, like depth=5. \"LOTS\" isn't one.")
+        for depth in ["--5", "²", "5.0"]:
+            self.assertTrue(hmse.handle_command(user, f"@hmse market ZOG depth={depth}").startswith("The depth has to be a whole number"))
+        self.assertTrue(hmse.handle_command(user, "@hmse market ZOG depth=-3").startswith("There are 0 sellers"))
+        self.assertNotIn(LogMessageType.EXCEPTION, [i.args[1] for i in hmse.log.add_log_message.call_args_list])
+
+    def test_replayed_notification_does_nothing(self):
+        database = Database(":memory:")
+        hmse = create_hmse(database)
+        user = create_user()
+        notification = {'id': 7, 'type': 'transfer', 'user_id': user.id, 'user_name': user.name, 'amount': 100}
+
+        hmse.handle_notification(notification)
+        hmse.handle_notification(notification)
+
+        self.assertEqual(database.get_balances(user), (100, 0))
+        hmse.api.send_message.assert_called_once()
+        self.assertEqual(database.get_only_cell("SELECT outcome FROM processed_notifications WHERE notification_id = 7"), NotificationOutcome.HANDLED)
+
+    def test_notification_is_journaled_when_its_command_commits(self):
+        database = Database(":memory:")
+        hmse = create_hmse(database)
+        user = create_user()
+        notification = {'id': 8, 'type': 'direct_message', 'user_id': user.id, 'user_name': user.name, 'message_html': "!deposit"}
+        def handle_command(user, message, special_message = ""):
+            hmse.bank.deposit(user, 50)
+            database.commit()
+            return "Done"
+        hmse.handle_command = MagicMock(side_effect = handle_command)
+        #What a crash right after the command was committed would leave behind
+        committed_when_replying = []
+        hmse.api.reply_to_direct_message = MagicMock(side_effect = lambda *args: committed_when_replying.append(not database.con.in_transaction and database.is_notification_processed(8)))
+
+        hmse.handle_notification(notification)
+        hmse.handle_notification(notification)
+
+        self.assertEqual(committed_when_replying, [True])
+        self.assertEqual(database.get_balances(user), (50, 0))
+        hmse.handle_command.assert_called_once()
+
+    def test_read_only_notification_is_answered_before_anything_is_written(self):
+        database = Database(":memory:")
+        hmse = create_hmse(database)
+        hmse.parser = Parser()
+        user = create_user()
+        notification = {'id': 10, 'type': 'direct_message', 'user_id': user.id, 'user_name': user.name, 'message_html': "@hmse balance"}
+        #Writing anything would mean waiting for the write lock, which a tick can hold for a while
+        written_when_replying = []
+        hmse.api.reply_to_direct_message = MagicMock(side_effect = lambda *args: written_when_replying.append(database.con.in_transaction or database.is_notification_processed(10)))
+
+        hmse.handle_notification(notification)
+
+        self.assertEqual(written_when_replying, [False])
+        self.assertEqual(database.get_only_cell("SELECT outcome FROM processed_notifications WHERE notification_id = 10"), NotificationOutcome.HANDLED)
+
+    def test_failed_notification_is_rolled_back_and_not_replayed(self):
+        database = Database(":memory:")
+        hmse = create_hmse(database)
+        user = create_user()
+        notification = {'id': 9, 'type': 'transfer', 'user_id': user.id, 'user_name': user.name, 'amount': 100}
+        hmse.api.send_message = MagicMock(side_effect = Exception("Site is down"))
+
+        hmse.handle_notification(notification)
+        hmse.handle_notification(notification)
+
+        self.assertEqual(database.get_balances(user), (0, 0))
+        hmse.api.send_message.assert_called_once()
+        self.assertEqual(database.get_only_cell("SELECT outcome FROM processed_notifications WHERE notification_id = 9"), NotificationOutcome.EXCEPTION)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
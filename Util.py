@@ -1,6 +1,51 @@
+import sqlite3
 from os.path import exists, join, realpath, split
 
 def get_real_filename(filename : str):
+    #SQLite's in-memory databases, used by the tests, aren't files
+    if (filename == ":memory:"):
+        return filename
     path_to_script = realpath(__file__)
     path_to_script_directory, _ = split(path_to_script)
-    return join(path_to_script_directory, filename)
\ No newline at end of file
+    return join(path_to_script_directory, filename)
+
+'''
+Creates the schema from the .sql file and migrates it, unless the database is already at the latest version, in which case nothing has to be done.
+That is the case on almost every start, so starting up only costs opening the connection and reading the version.
+'''
+def set_up_schema(connection : sqlite3.Connection, script_filename : str, migrations : list) -> None:
+    if (get_schema_version(connection) == len(migrations)):
+        return
+    with open(get_real_filename(script_filename)) as sql_file:
+        connection.executescript(sql_file.read())
+    migrate(connection, migrations)
+
+def get_schema_version(connection : sqlite3.Connection) -> int:
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+'''
+Brings a database's schema up to date, using PRAGMA user_version to remember how far it got.
+migrations[i] takes the schema from version i to version i + 1, so migrations must only ever be added to the end of the list.
+A migration is either a list of SQL statements, or a function that is given the connection.
+Each migration runs in its own transaction, together with the version bump, so a failed migration is retried from scratch next time.
+'''
+def migrate(connection : sqlite3.Connection, migrations : list) -> None:
+    version = get_schema_version(connection)
+    for new_version, migration in enumerate(migrations[version:], start=version + 1):
+        connection.execute("BEGIN")
+        try:
+            if (callable(migration)):
+                migration(connection)
+            else:
+                for statement in migration:
+                    connection.execute(statement)
+            connection.execute(f"PRAGMA user_version = {new_version}")
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+def add_column_if_does_not_exist(connection : sqlite3.Connection, table : str, column : str, definition : str) -> None:
+    columns = [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+    if (column not in columns):
+        connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
@@ -24,13 +24,15 @@ CREATE TABLE IF NOT EXISTS assets (
 -- - 1, it is a SELL command
 --  - amount is the max price
 --  - asset_id is the asset to buy
+--quantity is the number of shares that are still unfilled. Partial fills decrease it, and the command is deleted once it hits 0.
 CREATE TABLE IF NOT EXISTS commands (
     command_id integer PRIMARY KEY,
     user_id integer,
     command_type integer,
     amount integer,
     asset_id integer,
-    expiring_in integer);
+    expiring_in integer,
+    quantity integer NOT NULL DEFAULT 1);
 
 --Stores all users, and their names, and potentially more information if needed
 --Note about user_name: This should be updated every time a new piece of correspondence arrives with the username on it
@@ -52,9 +54,63 @@ CREATE TABLE IF NOT EXISTS prices (
     PRIMARY KEY (time_id, asset_id)
 );
 
+--Every sale that happened, so the price of an asset can be worked out from what it traded at during a turn.
+--price is per share.
+CREATE TABLE IF NOT EXISTS trades (
+    time_id integer,
+    asset_id integer,
+    price integer,
+    quantity integer
+);
+
+--Every change to a balance or holding, never updated or deleted.
+--asset_id is 0 for coins.
+--account is AVAILABLE, ESCROW or OUTSIDE (see Bank.LedgerAccount). Entries are written in pairs that add up to zero.
+--command_id is the command the change was made for, if there was one.
+CREATE TABLE IF NOT EXISTS ledger (
+    entry_id integer PRIMARY KEY,
+    time_id integer,
+    user_id integer,
+    asset_id integer,
+    account string,
+    delta integer,
+    reason string,
+    command_id integer
+);
+
+--Everyone's balances and holdings at the end of a turn, taken every few turns.
+--A balance at any turn is the latest snapshot before it, plus the ledger entries since.
+--asset_id is 0 for coins.
+CREATE TABLE IF NOT EXISTS balance_snapshots (
+    time_id integer,
+    user_id integer,
+    asset_id integer,
+    available integer,
+    escrow integer,
+    PRIMARY KEY (time_id, user_id, asset_id)
+);
+
+--Every notification that has been handled, so none is ever handled twice.
+--outcome is HANDLED, or EXCEPTION if handling it failed and was rolled back.
+--payload is the notification itself, as JSON.
+CREATE TABLE IF NOT EXISTS processed_notifications (
+    notification_id integer PRIMARY KEY,
+    type string,
+    user_id integer,
+    outcome string,
+    payload string,
+    time_id integer
+);
+
 --Various information about the state of the system.
+--last_reconciled_time_id is the last turn that the reconcile job checked the ledger up to.
+--imported_logged_notifications is whether the notifications that were handled before processed_notifications existed have been copied into it from the log.
+--last_command_id is the last id given to a command. Ids are never reused, so the ledger's command_id always means one command.
 CREATE TABLE IF NOT EXISTS state (
     id integer PRIMARY KEY,
     last_processed_notification_id integer,
-    current_time_id integer
+    current_time_id integer,
+    last_reconciled_time_id integer,
+    imported_logged_notifications integer NOT NULL DEFAULT 0,
+    last_command_id integer NOT NULL DEFAULT 0
 );
\ No newline at end of file